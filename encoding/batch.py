@@ -0,0 +1,37 @@
+import numpy as np
+
+# Размер батча по умолчанию для model.encode
+BATCH_SIZE = 64
+
+
+def product_text(product):
+    """ Собирает текст товара, который подаётся на вход модели """
+    return f"{product.get('name', '')} {product.get('brand', '')} {product.get('description', '')} " \
+           f"{product.get('categories', '')} {product.get('params_str', '')}"
+
+
+def token_lengths(model, texts):
+    """ Считает длину каждого текста в токенах с учётом обрезки до max_seq_length модели """
+    encoded = model.tokenizer(texts, add_special_tokens=True, truncation=True,
+                              max_length=model.max_seq_length)
+    return np.fromiter((len(ids) for ids in encoded['input_ids']), dtype=np.int64, count=len(texts))
+
+
+def length_sorted_batches(lengths, batch_size):
+    """ Разбивает индексы текстов на батчи из текстов близкой длины (от длинных к коротким) """
+    order = np.argsort(-lengths, kind='stable')
+    return [order[start:start + batch_size] for start in range(0, len(order), batch_size)]
+
+
+def encode_texts(model, texts, batch_size=BATCH_SIZE):
+    """ Кодирует список текстов батчами, сгруппированными по длине, и возвращает матрицу (len(texts), dim) """
+    embeddings = np.empty((len(texts), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    if not texts:
+        return embeddings
+
+    # Тексты одной длины попадают в один батч, поэтому на паддинг почти не тратится вычислений
+    for batch_idx in length_sorted_batches(token_lengths(model, texts), batch_size):
+        batch = [texts[i] for i in batch_idx]
+        embeddings[batch_idx] = model.encode(batch, batch_size=len(batch), convert_to_numpy=True,
+                                             show_progress_bar=False)
+    return embeddings
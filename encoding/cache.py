@@ -0,0 +1,86 @@
+import hashlib
+import os
+
+import numpy as np
+
+from encoding.batch import BATCH_SIZE, encode_texts
+from encoding.store import EmbeddingStore
+
+KEY_SIZE = 16
+
+
+def text_key(text):
+    """ Хэш текста товара, по которому ищется эмбеддинг в кэше """
+    return hashlib.blake2b(text.encode('utf-8'), digest_size=KEY_SIZE).hexdigest()
+
+
+class EmbeddingCache:
+    """
+    Дисковый кэш эмбеддингов одной модели, ключ -- хэш текста товара.
+
+    Векторы и ключи хранятся в EmbeddingStore (float32), который только дописывается и читается через
+    np.memmap. Записи, которые не понадобились за прогон, удаляются методом compact().
+    """
+
+    def __init__(self, cache_dir, model_name, dim):
+        self.path = os.path.join(cache_dir, model_name)
+        self.dim = dim
+        self.store = EmbeddingStore(self.path, dim=dim, dtype='float32')
+        self._used = np.zeros(len(self.store), dtype=bool)
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self.store)
+
+    @property
+    def hit_rate(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.
+
+    def lookup(self, keys):
+        """ Возвращает матрицу найденных векторов и маску промахов """
+        embeddings = np.empty((len(keys), self.dim), dtype=np.float32)
+        missing = np.ones(len(keys), dtype=bool)
+        rows = np.fromiter((self.store.rows.get(key, -1) for key in keys), dtype=np.int64, count=len(keys))
+        found = rows >= 0
+        if found.any():
+            embeddings[found] = self.store.vectors[rows[found]]
+            self._used[rows[found]] = True
+            missing[found] = False
+        self.hits += int(found.sum())
+        self.misses += int(missing.sum())
+        return embeddings, missing
+
+    def add(self, keys, embeddings):
+        """ Дописывает новые векторы в конец кэша """
+        new = {}
+        for key, embedding in zip(keys, embeddings):
+            if key not in self.store.rows and key not in new:
+                new[key] = embedding
+        if not new:
+            return
+        self.store.append(list(new), list(new.values()))
+        self._used = np.concatenate([self._used, np.ones(len(new), dtype=bool)])
+
+    def compact(self, max_dead_fraction=0.3):
+        """ Переписывает кэш без записей, которые не использовались с момента открытия """
+        size = len(self.store)
+        dead = size - int(self._used.sum())
+        if size == 0 or dead / size <= max_dead_fraction:
+            return False
+        self.store.compact(np.flatnonzero(self._used))
+        self._used = np.ones(len(self.store), dtype=bool)
+        return True
+
+
+def encode_with_cache(model, texts, cache, batch_size=BATCH_SIZE):
+    """ Кодирует только тексты, которых нет в кэше, и дописывает их эмбеддинги в кэш """
+    keys = [text_key(text) for text in texts]
+    embeddings, missing = cache.lookup(keys)
+    if missing.any():
+        miss_idx = np.flatnonzero(missing)
+        encoded = encode_texts(model, [texts[i] for i in miss_idx], batch_size=batch_size)
+        embeddings[miss_idx] = encoded
+        cache.add([keys[i] for i in miss_idx], encoded)
+    return embeddings
@@ -0,0 +1,97 @@
+# Режимы инференса энкодеров запросов на CPU: fp32, динамическое int8-квантование линейных слоёв
+# и ONNX Runtime (нужен пакет optimum[onnxruntime]). Сравнение с fp32 по косинусу и задержке:
+#     python -m encoding.cpu --models mpnet minilm --mode int8
+import argparse
+import time
+
+import numpy as np
+import torch
+from sentence_transformers import SentenceTransformer
+
+CPU_MODES = ('fp32', 'int8', 'onnx')
+# Если косинус эмбеддингов ускоренной и исходной модели на какой-то проверочной фразе ниже MIN_COSINE,
+# используется исходная модель
+MIN_COSINE = 0.98
+CHECK_TEXTS = [
+    'wireless headphones', 'running shoes for men', 'kitchen knife set', 'iphone 13 case', 'gaming laptop 16gb',
+    'coffee maker with grinder', 'yoga mat', 'led desk lamp', 'travel backpack', 'bluetooth speaker waterproof',
+    'детская коляска', 'зимняя куртка', 'электрический чайник', 'набор отвёрток', 'корм для кошек'
+]
+
+
+def quantize_model(model):
+    """ Копия модели, в которой веса линейных слоёв хранятся в int8, а активации квантуются на лету """
+    return torch.ao.quantization.quantize_dynamic(model.cpu(), {torch.nn.Linear}, dtype=torch.qint8)
+
+
+def cosine_report(reference, candidate):
+    reference = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    candidate = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cosine = (reference * candidate).sum(axis=1)
+    return {'mean_cosine': float(cosine.mean()), 'min_cosine': float(cosine.min())}
+
+
+def timed_encode(model, texts, repeats=3):
+    """ Эмбеддинги текстов и среднее время кодирования одного текста в миллисекундах """
+    # Запросы в сервисе кодируются по одному, поэтому и задержка измеряется на одиночных текстах
+    model.encode(texts[:1], show_progress_bar=False)
+    started = time.perf_counter()
+    for _ in range(repeats):
+        for text in texts:
+            model.encode(text, show_progress_bar=False)
+    latency = 1000 * (time.perf_counter() - started) / (repeats * len(texts))
+    return np.asarray(model.encode(texts, show_progress_bar=False), dtype=np.float32), latency
+
+
+def prepare_cpu_model(model_path, model, mode, check_texts=CHECK_TEXTS, min_cosine=MIN_COSINE):
+    """
+    Готовит модель к инференсу на CPU в режиме mode и сравнивает её эмбеддинги с исходной на check_texts.
+
+    :param model_path: путь или имя модели (нужен для загрузки ONNX-версии).
+    :param model: исходная fp32-модель.
+    :return: (модель, отчёт). Если проверка не пройдена, возвращается исходная модель.
+    """
+    if mode not in CPU_MODES:
+        raise ValueError(f"mode={mode} is not supported")
+    if mode == 'fp32':
+        return model, {'mode': mode}
+
+    reference, reference_latency = timed_encode(model, check_texts)
+    if mode == 'int8':
+        candidate = quantize_model(model)
+    else:
+        candidate = SentenceTransformer(model_path, backend='onnx', device='cpu')
+    embeddings, latency = timed_encode(candidate, check_texts)
+
+    report = dict(cosine_report(reference, embeddings), mode=mode, fp32_ms=reference_latency, ms=latency,
+                  speedup=reference_latency / latency)
+    report['accepted'] = report['min_cosine'] >= min_cosine
+    return (candidate if report['accepted'] else model), report
+
+
+def format_report(model_name, report):
+    if report['mode'] == 'fp32':
+        return f"{model_name}: fp32"
+    return (f"{model_name}: {report['mode']} косинус с fp32 средний {report['mean_cosine']:.4f}, "
+            f"минимальный {report['min_cosine']:.4f}; {report['fp32_ms']:.1f} -> {report['ms']:.1f} мс на запрос "
+            f"(x{report['speedup']:.1f}){'' if report['accepted'] else ', проверка не пройдена -- используется fp32'}")
+
+
+if __name__ == '__main__':
+    from encoding.registry import MODELS
+
+    parser = argparse.ArgumentParser(description="Косинус и задержка энкодеров на CPU по сравнению с fp32")
+    parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS))
+    parser.add_argument('--mode', default='int8', choices=CPU_MODES)
+    parser.add_argument('--texts', help="файл с проверочными текстами, по одному на строку")
+    parser.add_argument('--min-cosine', type=float, default=MIN_COSINE)
+    args = parser.parse_args()
+
+    texts = CHECK_TEXTS
+    if args.texts:
+        with open(args.texts, encoding='utf-8') as f:
+            texts = [line.strip() for line in f if line.strip()]
+    for name in args.models:
+        _, model_report = prepare_cpu_model(MODELS[name], SentenceTransformer(MODELS[name], device='cpu'), args.mode,
+                                            check_texts=texts, min_cosine=args.min_cosine)
+        print(format_report(name, model_report))
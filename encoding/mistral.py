@@ -0,0 +1,205 @@
+# Кодирование каталога моделью Salesforce/SFR-Embedding-Mistral (вместо цикла из ноутбука
+# salesforce-sfr-embedding-mistral.ipynb). Вход -- CSV с заголовком (как catalog_evropa.csv из ноутбука) или JSON
+# по товару в строке, выход -- шарды эмбеддингов в каталоге; повторный запуск с теми же аргументами продолжает
+# с последнего сохранённого шарда:
+#     python -m encoding.mistral catalog_evropa.csv mistral_shards --id-field nm_id --text-field imt_name
+# Со --store готовые шарды дописываются в EmbeddingStore:
+#     python -m encoding.mistral dataset.json mistral_shards --store mistral_store --dtype float16
+import argparse
+import csv
+import glob
+import json
+import os
+
+import numpy as np
+import torch
+import torch.nn.functional as F
+from tqdm import tqdm
+
+from encoding.store import DTYPES, EmbeddingStore
+
+MODEL_NAME = 'Salesforce/SFR-Embedding-Mistral'
+MAX_LENGTH = 4096
+# Сколько токенов (с учётом паддинга до самого длинного текста батча) обрабатывается за один forward
+TOKEN_BUDGET = 16384
+MAX_BATCH_SIZE = 128
+SHARD_SIZE = 10000
+
+
+def last_token_pool(last_hidden_states, attention_mask):
+    """ Эмбеддинг каждого текста батча -- скрытое состояние его последнего (не паддингового) токена """
+    left_padding = (attention_mask[:, -1].sum() == attention_mask.shape[0])
+    if left_padding:
+        return last_hidden_states[:, -1]
+    sequence_lengths = attention_mask.sum(dim=1) - 1
+    batch_size = last_hidden_states.shape[0]
+    return last_hidden_states[torch.arange(batch_size, device=last_hidden_states.device), sequence_lengths]
+
+
+def get_detailed_instruct(task_description, query):
+    """ Запросы (в отличие от товаров) кодируются вместе с описанием задачи """
+    return f'Instruct: {task_description}\nQuery: {query}'
+
+
+def load_model(model_name=MODEL_NAME, device=None):
+    from transformers import AutoModel, AutoTokenizer
+
+    device = device or ('cuda' if torch.cuda.is_available() else 'cpu')
+    tokenizer = AutoTokenizer.from_pretrained(model_name)
+    tokenizer.add_eos_token = True
+    dtype = torch.float16 if device.startswith('cuda') else torch.float32
+    model = AutoModel.from_pretrained(model_name, torch_dtype=dtype).to(device).eval()
+    return tokenizer, model
+
+
+def token_budget_batches(lengths, token_budget=TOKEN_BUDGET, max_batch_size=MAX_BATCH_SIZE):
+    """
+    Разбивает индексы текстов на батчи близкой длины (от длинных к коротким) так, чтобы
+    число_текстов * длина_самого_длинного не превышало token_budget.
+    """
+    order = np.argsort(-np.asarray(lengths), kind='stable')
+    batches, start = [], 0
+    while start < len(order):
+        # Самый длинный текст батча -- первый, поэтому размер батча определяется его длиной
+        size = max(1, min(max_batch_size, token_budget // max(int(lengths[order[start]]), 1)))
+        batches.append(order[start:start + size])
+        start += size
+    return batches
+
+
+def encode_batch(tokenizer, model, texts, max_length=MAX_LENGTH):
+    """ Нормированные эмбеддинги батча текстов, float32 """
+    batch_dict = tokenizer(texts, max_length=max_length - 1, padding=True, truncation=True, return_tensors='pt')
+    batch_dict = batch_dict.to(model.device)
+    with torch.inference_mode():
+        outputs = model(**batch_dict)
+        embeddings = last_token_pool(outputs.last_hidden_state, batch_dict['attention_mask'])
+        embeddings = F.normalize(embeddings.float(), p=2, dim=1)
+    return embeddings.cpu().numpy()
+
+
+def encode_texts(tokenizer, model, texts, max_length=MAX_LENGTH, token_budget=TOKEN_BUDGET,
+                 max_batch_size=MAX_BATCH_SIZE):
+    """ Кодирует тексты батчами по бюджету токенов и возвращает матрицу в исходном порядке """
+    lengths = [len(ids) for ids in tokenizer(texts, max_length=max_length - 1, truncation=True)['input_ids']]
+    embeddings = None
+    pending = token_budget_batches(lengths, token_budget, max_batch_size)
+    while pending:
+        batch_idx = pending.pop()
+        try:
+            batch = encode_batch(tokenizer, model, [texts[i] for i in batch_idx], max_length)
+        except torch.cuda.OutOfMemoryError:
+            # Бюджет оказался велик для этой длины: батч делится пополам
+            if len(batch_idx) == 1:
+                raise
+            torch.cuda.empty_cache()
+            pending.extend(np.array_split(batch_idx, 2))
+            continue
+        if embeddings is None:
+            embeddings = np.empty((len(texts), batch.shape[1]), dtype=np.float32)
+        embeddings[batch_idx] = batch
+    return embeddings
+
+
+def iter_products(path):
+    """ Товары из CSV с заголовком (по расширению .csv) или из файла с JSON-объектом в каждой строке """
+    with open(path, encoding='utf-8', newline='') as f:
+        if path.lower().endswith('.csv'):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def read_products(path, id_field, text_field):
+    """ id и тексты товаров; товары без текста пропускаются """
+    ids, texts = [], []
+    for product in iter_products(path):
+        if product.get(text_field):
+            ids.append(str(product[id_field]))
+            texts.append(str(product[text_field]))
+    return ids, texts
+
+
+def shard_paths(out_dir):
+    """ Готовые шарды по порядку. Шард готов, когда записан его файл векторов """
+    return sorted(glob.glob(os.path.join(out_dir, 'shard-*.npy')))
+
+
+def read_shard(path):
+    with open(path[:-len('.npy')] + '.ids.json', encoding='utf-8') as f:
+        return json.load(f), np.load(path, mmap_mode='r')
+
+
+def write_shard(out_dir, number, doc_ids, embeddings):
+    """ Записывает шард через временные файлы: после падения остаются только целые шарды """
+    base = os.path.join(out_dir, f'shard-{number:05d}')
+    with open(base + '.ids.json.tmp', 'w', encoding='utf-8') as f:
+        json.dump(doc_ids, f)
+    with open(base + '.npy.tmp', 'wb') as f:
+        np.save(f, embeddings)
+    os.replace(base + '.ids.json.tmp', base + '.ids.json')
+    os.replace(base + '.npy.tmp', base + '.npy')
+
+
+def encode_catalog(dataset_path, out_dir, id_field='nm_id', text_field='imt_name', model_name=MODEL_NAME,
+                   max_length=MAX_LENGTH, token_budget=TOKEN_BUDGET, max_batch_size=MAX_BATCH_SIZE,
+                   shard_size=SHARD_SIZE, device=None):
+    """ Кодирует товары, которых ещё нет в готовых шардах out_dir, и дописывает новые шарды """
+    os.makedirs(out_dir, exist_ok=True)
+    done = set()
+    for path in shard_paths(out_dir):
+        done.update(read_shard(path)[0])
+    ids, texts = read_products(dataset_path, id_field, text_field)
+    pending = [i for i, doc_id in enumerate(ids) if doc_id not in done]
+    print(f"Готово {len(done)} товаров, осталось {len(pending)}")
+    if not pending:
+        return
+
+    tokenizer, model = load_model(model_name, device)
+    number = len(shard_paths(out_dir))
+    for start in tqdm(range(0, len(pending), shard_size)):
+        chunk = pending[start:start + shard_size]
+        embeddings = encode_texts(tokenizer, model, [texts[i] for i in chunk], max_length, token_budget,
+                                  max_batch_size)
+        write_shard(out_dir, number, [ids[i] for i in chunk], embeddings)
+        number += 1
+
+
+def merge_shards(out_dir, store_path, dtype='float32'):
+    """ Дописывает в EmbeddingStore векторы из шардов, которых в нём ещё нет """
+    store = None
+    for path in shard_paths(out_dir):
+        doc_ids, embeddings = read_shard(path)
+        # Не `store or ...`: пустое хранилище ложно (len == 0) и открывалось бы заново на каждом шарде
+        if store is None:
+            store = EmbeddingStore(store_path, dim=embeddings.shape[1], dtype=dtype)
+        new = [i for i, doc_id in enumerate(doc_ids) if doc_id not in store]
+        if new:
+            store.append([doc_ids[i] for i in new], embeddings[new])
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Кодирование каталога моделью SFR-Embedding-Mistral")
+    parser.add_argument('dataset', help="CSV с заголовком или файл с JSON-объектом товара в каждой строке")
+    parser.add_argument('out_dir', help="каталог шардов")
+    parser.add_argument('--id-field', default='nm_id')
+    parser.add_argument('--text-field', default='imt_name')
+    parser.add_argument('--model', default=MODEL_NAME)
+    parser.add_argument('--max-length', type=int, default=MAX_LENGTH)
+    parser.add_argument('--token-budget', type=int, default=TOKEN_BUDGET)
+    parser.add_argument('--max-batch-size', type=int, default=MAX_BATCH_SIZE)
+    parser.add_argument('--shard-size', type=int, default=SHARD_SIZE)
+    parser.add_argument('--device')
+    parser.add_argument('--store', help="каталог EmbeddingStore, в который дописываются готовые шарды")
+    parser.add_argument('--dtype', default='float32', choices=DTYPES)
+    args = parser.parse_args()
+
+    encode_catalog(args.dataset, args.out_dir, id_field=args.id_field, text_field=args.text_field,
+                   model_name=args.model, max_length=args.max_length, token_budget=args.token_budget,
+                   max_batch_size=args.max_batch_size, shard_size=args.shard_size, device=args.device)
+    if args.store:
+        store = merge_shards(args.out_dir, args.store, dtype=args.dtype)
+        print(f"В хранилище {args.store} {len(store) if store is not None else 0} векторов")
@@ -0,0 +1,10 @@
+# Список моделей отдельно от encoding.registry: его можно импортировать без torch и sentence_transformers,
+# например в parse.py, который заново импортируется каждым процессом-кодировщиком (encoding/pipeline.py)
+
+# Список моделей для эмбеддингов
+MODELS = {
+    'mpnet': 'sentence-transformers/all-mpnet-base-v2',
+    'minilm': 'sentence-transformers/all-MiniLM-L6-v2',
+    'qa-mpnet': 'sentence-transformers/multi-qa-mpnet-base-dot-v1',
+    'multilingual': 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
+}
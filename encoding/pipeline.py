@@ -0,0 +1,266 @@
+# Многопроцессное кодирование товаров на CPU: читатель (вызывающий поток) раздаёт тексты процессам-кодировщикам,
+# каждый из которых держит одну модель и фиксированное число потоков, а писатель (поток основного процесса)
+# собирает векторы пачки от всех моделей и передаёт их дальше, например в BulkWriter.
+import multiprocessing
+import os
+import queue
+import threading
+import traceback
+
+import numpy as np
+
+from encoding.batch import BATCH_SIZE, encode_texts
+from encoding.cache import text_key
+
+THREADS_PER_WORKER = 4
+# Сколько текстов отправляется процессу за раз: пачка делится между процессами одной модели
+TASK_SIZE = 256
+# Сколько пачек может одновременно находиться в обработке; ограничивает память под ожидающие векторы
+MAX_PENDING = 4
+# Как часто заблокированные очереди проверяют, не остановлен ли конвейер
+POLL_INTERVAL = 0.1
+
+
+class PipelineError(RuntimeError):
+    pass
+
+
+def worker_cpus(worker_index, threads):
+    """ Ядра, к которым привязывается процесс: подряд идущие блоки по threads ядер из доступных """
+    if not hasattr(os, 'sched_getaffinity'):
+        return None
+    cpus = sorted(os.sched_getaffinity(0))
+    start = worker_index * threads
+    # Если процессов больше, чем блоков ядер, привязка не делается -- их распределит планировщик
+    if start + threads > len(cpus):
+        return None
+    return cpus[start:start + threads]
+
+
+def encode_worker(model_name, model_path, threads, cpus, batch_size, tasks, results):
+    """ Процесс-кодировщик: загружает модель и кодирует тексты из tasks, пока не получит None """
+    try:
+        if cpus:
+            os.sched_setaffinity(0, cpus)
+        # torch импортируется после привязки к ядрам, чтобы пулы потоков создавались уже на них. При spawn процесс
+        # сначала заново импортирует основной модуль (например, parse.py), поэтому тот не должен импортировать torch
+        # на уровне модуля, иначе пулы потоков создаются до привязки
+        import torch
+        from sentence_transformers import SentenceTransformer
+
+        torch.set_num_threads(threads)
+        model = SentenceTransformer(model_path, device='cpu')
+        results.put(('ready', model_name, model.get_sentence_embedding_dimension()))
+        while True:
+            task = tasks.get()
+            if task is None:
+                return
+            chunk_id, start, texts = task
+            results.put(('done', chunk_id, model_name, start, encode_texts(model, texts, batch_size=batch_size)))
+    except Exception:
+        results.put(('error', model_name, traceback.format_exc()))
+
+
+class EncodingPipeline:
+    """
+    Пул процессов-кодировщиков, по одному или нескольку на модель. Очереди ограничены, поэтому читатель
+    ждёт, если кодировщики не успевают, а ошибка в любом процессе или в обработчике останавливает весь конвейер.
+    """
+
+    def __init__(self, models, workers, threads_per_worker=THREADS_PER_WORKER, batch_size=BATCH_SIZE,
+                 task_size=TASK_SIZE, max_pending=MAX_PENDING, pin_cpus=True):
+        """
+        :param models: словарь имя -> путь модели.
+        :param workers: общее число процессов (делится между моделями поровну) или словарь имя -> число процессов.
+        :param threads_per_worker: число потоков torch в каждом процессе.
+        :param batch_size: размер батча для model.encode внутри процесса.
+        :param task_size: сколько текстов отправляется процессу за раз.
+        :param max_pending: сколько пачек может одновременно находиться в обработке.
+        :param pin_cpus: привязывать ли процессы к своим ядрам.
+        """
+        if isinstance(workers, int):
+            workers = {name: workers // len(models) + (i < workers % len(models)) for i, name in enumerate(models)}
+        if any(workers.get(name, 0) < 1 for name in models):
+            raise ValueError("Каждой модели нужен хотя бы один процесс")
+        self.models = models
+        self.workers = workers
+        self.threads_per_worker = threads_per_worker
+        self.batch_size = batch_size
+        self.task_size = task_size
+        self.pin_cpus = pin_cpus
+        self.dims = {}
+
+        # spawn: дочерний процесс не наследует потоки и состояние torch основного процесса
+        self._context = multiprocessing.get_context('spawn')
+        self._tasks = {name: self._context.Queue(maxsize=2 * workers[name]) for name in models}
+        self._results = self._context.Queue(maxsize=4 * sum(workers.values()))
+        self._processes = []
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._cache_lock = threading.Lock()
+        self._failed = threading.Event()
+        self._error = None
+
+    def __enter__(self):
+        self.start()
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(terminate=exc_type is not None or self._failed.is_set())
+
+    def start(self):
+        """ Запускает процессы и ждёт, пока каждый загрузит свою модель """
+        try:
+            self._start_workers()
+        except BaseException:
+            self.close(terminate=True)
+            raise
+
+    def _start_workers(self):
+        for name in self.models:
+            for _ in range(self.workers[name]):
+                cpus = worker_cpus(len(self._processes), self.threads_per_worker) if self.pin_cpus else None
+                process = self._context.Process(
+                    target=encode_worker, daemon=True,
+                    args=(name, self.models[name], self.threads_per_worker, cpus, self.batch_size, self._tasks[name],
+                          self._results))
+                process.start()
+                self._processes.append(process)
+
+        for _ in self._processes:
+            message = self._get_result()
+            if message[0] == 'error':
+                raise PipelineError(f"Ошибка при загрузке модели {message[1]}:\n{message[2]}")
+            self.dims[message[1]] = message[2]
+
+    def run(self, chunks, handle, caches=None):
+        """
+        Кодирует пачки всеми моделями.
+
+        :param chunks: итерируемый набор пар (данные пачки, список текстов).
+        :param handle: handle(данные пачки, {модель: матрица векторов}) вызывается в потоке писателя
+            по мере готовности пачек, не обязательно в исходном порядке.
+        :param caches: словарь модель -> EmbeddingCache; кодируются только тексты, которых нет в кэше.
+        """
+        caches = caches or {}
+        writer = threading.Thread(target=self._write, args=(handle, caches), daemon=True)
+        writer.start()
+        try:
+            for chunk_id, (data, texts) in enumerate(chunks):
+                self._acquire_slot()
+                self._submit(chunk_id, data, texts, caches)
+            # None в очереди результатов -- все пачки отправлены
+            self._put(self._results, None)
+        except BaseException as e:
+            self._fail(e)
+        writer.join()
+        if self._error is not None:
+            raise self._error
+
+    def close(self, terminate=False):
+        """ Останавливает процессы: при нормальном завершении дожидается их, при ошибке завершает принудительно """
+        if not terminate:
+            for name in self.models:
+                for _ in range(self.workers[name]):
+                    self._tasks[name].put(None)
+        for process in self._processes:
+            if terminate:
+                process.terminate()
+            process.join()
+        for q in list(self._tasks.values()) + [self._results]:
+            # Иначе выход может зависнуть на недоставленных в очередь данных
+            q.cancel_join_thread()
+            q.close()
+        self._processes = []
+
+    def _submit(self, chunk_id, data, texts, caches):
+        embeddings, missing = {}, {}
+        keys = [text_key(text) for text in texts] if caches else None
+        for name in self.models:
+            if name in caches:
+                with self._cache_lock:
+                    embeddings[name], mask = caches[name].lookup(keys)
+                missing[name] = np.flatnonzero(mask)
+            else:
+                embeddings[name] = np.empty((len(texts), self.dims[name]), dtype=np.float32)
+                missing[name] = np.arange(len(texts))
+
+        # Задание -- отрезок списка некэшированных текстов модели, start -- его начало в этом списке
+        tasks = [(name, start) for name in self.models for start in range(0, len(missing[name]), self.task_size)]
+        with self._lock:
+            self._pending[chunk_id] = {'data': data, 'keys': keys, 'embeddings': embeddings, 'missing': missing,
+                                       'remaining': len(tasks)}
+        if not tasks:
+            # Все векторы взяты из кэша: пачка сразу передаётся писателю
+            self._put(self._results, ('cached', chunk_id))
+        for name, start in tasks:
+            idx = missing[name][start:start + self.task_size]
+            self._put(self._tasks[name], (chunk_id, start, [texts[i] for i in idx]))
+
+    def _write(self, handle, caches):
+        try:
+            finished = False
+            while not finished or self._pending:
+                message = self._get_result()
+                if message is None:
+                    finished = True
+                    continue
+                if message[0] == 'error':
+                    raise PipelineError(f"Ошибка в процессе модели {message[1]}:\n{message[2]}")
+                chunk_id = message[1]
+                with self._lock:
+                    chunk = self._pending[chunk_id]
+                    if message[0] == 'done':
+                        _, _, name, start, encoded = message
+                        idx = chunk['missing'][name][start:start + len(encoded)]
+                        chunk['embeddings'][name][idx] = encoded
+                        chunk['remaining'] -= 1
+                    if chunk['remaining']:
+                        continue
+                    del self._pending[chunk_id]
+                self._finish(chunk, handle, caches)
+                self._slots.release()
+        except BaseException as e:
+            self._fail(e)
+
+    def _finish(self, chunk, handle, caches):
+        for name, cache in caches.items():
+            missing = chunk['missing'][name]
+            if len(missing):
+                with self._cache_lock:
+                    cache.add([chunk['keys'][i] for i in missing], chunk['embeddings'][name][missing])
+        handle(chunk['data'], chunk['embeddings'])
+
+    def _acquire_slot(self):
+        while not self._slots.acquire(timeout=POLL_INTERVAL):
+            self._check()
+
+    def _put(self, q, item):
+        while True:
+            try:
+                q.put(item, timeout=POLL_INTERVAL)
+                return
+            except queue.Full:
+                self._check()
+
+    def _get_result(self):
+        while True:
+            try:
+                return self._results.get(timeout=POLL_INTERVAL)
+            except queue.Empty:
+                self._check()
+
+    def _check(self):
+        """ Прерывает ожидание, если конвейер остановлен или какой-то процесс завершился аварийно """
+        if self._failed.is_set():
+            raise PipelineError("Конвейер остановлен из-за ошибки")
+        for process in self._processes:
+            if process.exitcode not in (None, 0):
+                raise PipelineError(f"Процесс {process.name} завершился с кодом {process.exitcode}")
+
+    def _fail(self, error):
+        with self._lock:
+            if self._error is None:
+                self._error = error
+        self._failed.set()
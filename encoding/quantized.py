@@ -0,0 +1,169 @@
+# Поиск по сжатым эмбеддингам (int8 или бинарным) с пересчётом лучших кандидатов по исходным векторам.
+# Отчёт recall / память / задержка для хранилища EmbeddingStore:
+#     python -m encoding.quantized embeddings_store --k 10 --queries 200
+import argparse
+import os
+import time
+
+import faiss
+import numpy as np
+
+from encoding.store import EmbeddingStore
+
+MODES = ('int8', 'binary')
+TRAIN_SAMPLE = 100000
+
+
+class QuantizedIndex:
+    """
+    Двухфазный поиск по скалярному произведению.
+
+    Первая фаза ищет k * rescore_factor кандидатов по сжатым векторам, которые лежат в памяти.
+    Вторая пересчитывает их оценки по исходным float-векторам (например, np.memmap из
+    EmbeddingStore), так что в память читаются только строки кандидатов.
+    """
+
+    def __init__(self, vectors, mode='int8', rescore_factor=4, codes=None, thresholds=None):
+        """
+        :param vectors: исходные векторы формы (N, dim), можно np.memmap.
+        :param mode: 'int8' -- скалярное квантование по измерениям, 'binary' -- один бит на измерение.
+        :param rescore_factor: во сколько раз больше кандидатов, чем k, пересчитывается по исходным векторам.
+        :param codes: готовый индекс faiss со сжатыми векторами (используется при загрузке с диска).
+        :param thresholds: пороги бинаризации для готового бинарного индекса.
+        """
+        if mode not in MODES:
+            raise ValueError(f"mode={mode} is not supported")
+        self.vectors = vectors
+        self.mode = mode
+        self.rescore_factor = rescore_factor
+        self.thresholds = thresholds
+        if codes is not None:
+            self.index = codes
+            return
+
+        dim = vectors.shape[1]
+        if mode == 'int8':
+            self.index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        else:
+            self.index = faiss.IndexBinaryFlat(dim)
+        if len(vectors):
+            # Диапазоны и пороги оцениваются по выборке, чтобы не читать весь каталог в память
+            sample_rows = np.linspace(0, len(vectors) - 1, min(len(vectors), TRAIN_SAMPLE)).astype(np.int64)
+            self.train(np.asarray(vectors[np.unique(sample_rows)], dtype=np.float32))
+        for start in range(0, len(vectors), 65536):
+            self.add_codes(vectors[start:start + 65536])
+
+    @property
+    def is_trained(self):
+        return self.index.is_trained if self.mode == 'int8' else self.thresholds is not None
+
+    def train(self, sample):
+        if self.mode == 'int8':
+            self.index.train(np.ascontiguousarray(sample, dtype=np.float32))
+        else:
+            # Порог по каждому измерению -- среднее значение, чтобы биты делили данные примерно пополам
+            self.thresholds = np.asarray(sample, dtype=np.float32).mean(axis=0)
+
+    def add_codes(self, vectors):
+        """ Добавляет сжатые векторы; исходные векторы этих строк должны быть дописаны в self.vectors """
+        self.index.add(self._encode(vectors))
+
+    def _encode(self, vectors):
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        if self.mode == 'int8':
+            return vectors
+        return np.packbits(vectors > self.thresholds, axis=1)
+
+    @property
+    def memory_bytes(self):
+        """ Размер сжатых векторов в памяти """
+        if self.mode == 'int8':
+            return self.index.ntotal * self.index.sa_code_size()
+        return self.index.ntotal * self.index.code_size
+
+    def search(self, query, k):
+        """ Возвращает (оценки, номера строк) k лучших векторов по скалярному произведению """
+        query = np.asarray(query, dtype=np.float32).reshape(1, -1)
+        if self.index.ntotal == 0:
+            return np.empty(0, dtype=np.float32), np.empty(0, dtype=np.int64)
+        _, candidates = self.index.search(self._encode(query), min(k * self.rescore_factor, self.index.ntotal))
+        candidates = np.sort(candidates[0][candidates[0] >= 0]).astype(np.int64)
+
+        scores = np.asarray(self.vectors[candidates], dtype=np.float32) @ query[0]
+        top = np.argsort(-scores)[:k]
+        return scores[top], candidates[top]
+
+    def write(self, path):
+        """ Сохраняет сжатые векторы (и пороги бинаризации) в каталог path; исходные векторы не сохраняются """
+        if self.mode == 'int8':
+            faiss.write_index(self.index, os.path.join(path, 'codes.faiss'))
+        else:
+            faiss.write_index_binary(self.index, os.path.join(path, 'codes.faiss'))
+            np.save(os.path.join(path, 'thresholds.npy'), self.thresholds)
+
+    @classmethod
+    def read(cls, path, vectors, mode, rescore_factor=4):
+        if mode == 'int8':
+            return cls(vectors, mode, rescore_factor, codes=faiss.read_index(os.path.join(path, 'codes.faiss')))
+        return cls(vectors, mode, rescore_factor, codes=faiss.read_index_binary(os.path.join(path, 'codes.faiss')),
+                   thresholds=np.load(os.path.join(path, 'thresholds.npy')))
+
+
+def exact_search(vectors, query, k):
+    scores = np.asarray(vectors, dtype=np.float32) @ np.asarray(query, dtype=np.float32)
+    top = np.argsort(-scores)[:k]
+    return scores[top], top
+
+
+def without_row(rows, row, k):
+    """ Первые k строк результата без строки row -- самого запроса, если он взят из индексированных векторов """
+    return rows[rows != row][:k]
+
+
+def evaluate(vectors, queries, k=10, rescore_factor=4, query_rows=None):
+    """
+    Сравнивает recall@k, размер индекса и задержку сжатых индексов с точным поиском.
+
+    :param query_rows: если запросы -- векторы из vectors, их номера строк. Строка самого запроса исключается
+        из результатов, иначе он всегда находит себя и recall завышен.
+    """
+    # Ищем на одну строку больше, чтобы после исключения запроса осталось k
+    extra = 0 if query_rows is None else 1
+    query_rows = [None] * len(queries) if query_rows is None else query_rows
+    dense = np.asarray(vectors, dtype=np.float32)
+    started = time.perf_counter()
+    exact = [without_row(exact_search(dense, query, k + extra)[1], row, k) for query, row in zip(queries, query_rows)]
+    report = {'float32': {
+        'recall': 1.,
+        'memory_bytes': vectors.shape[0] * vectors.shape[1] * 4,
+        'latency_ms': 1000 * (time.perf_counter() - started) / len(queries)
+    }}
+
+    for mode in MODES:
+        index = QuantizedIndex(vectors, mode=mode, rescore_factor=rescore_factor)
+        started = time.perf_counter()
+        found = [index.search(query, k + extra)[1] for query in queries]
+        latency = (time.perf_counter() - started) / len(queries)
+        found = [without_row(rows, row, k) for rows, row in zip(found, query_rows)]
+        recall = np.mean([len(np.intersect1d(f, e)) / len(e) for f, e in zip(found, exact)])
+        report[mode] = {'recall': float(recall), 'memory_bytes': index.memory_bytes, 'latency_ms': 1000 * latency}
+    return report
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Recall, память и задержка поиска по сжатым эмбеддингам")
+    parser.add_argument('store_path', help="каталог EmbeddingStore")
+    parser.add_argument('--k', type=int, default=10)
+    parser.add_argument('--queries', type=int, default=200,
+                        help="сколько векторов хранилища использовать как запросы (сами они исключаются из выдачи)")
+    parser.add_argument('--rescore-factor', type=int, default=4)
+    args = parser.parse_args()
+
+    store = EmbeddingStore(args.store_path)
+    rng = np.random.default_rng(0)
+    rows = np.sort(rng.choice(len(store), min(args.queries, len(store)), replace=False))
+    queries = np.asarray(store.vectors[rows], dtype=np.float32)
+    report = evaluate(store.vectors, queries, k=args.k, rescore_factor=args.rescore_factor, query_rows=rows)
+    for mode, stats in report.items():
+        print(f"{mode:>8}: recall@{args.k} {stats['recall']:.3f}, "
+              f"память {stats['memory_bytes'] / 2 ** 20:.1f} МБ, задержка {stats['latency_ms']:.2f} мс")
@@ -0,0 +1,120 @@
+import os
+import threading
+from collections import OrderedDict
+
+import torch
+from sentence_transformers import SentenceTransformer
+
+from encoding.cpu import format_report, prepare_cpu_model
+from encoding.models import MODELS
+
+
+def onnx_files_size(model):
+    """
+    Размер ONNX-файлов модели (вместе с внешними данными весов) в байтах: ONNX Runtime загружает веса
+    в сессию целиком, а параметров torch у такой модели почти нет. None, если модель не ONNX.
+    """
+    size = None
+    for module in model:
+        auto_model = getattr(module, 'auto_model', None)
+        # В разных версиях optimum сессия ONNX Runtime хранится в session или в model
+        session = getattr(auto_model, 'session', None) or getattr(auto_model, 'model', None)
+        onnx_path = getattr(session, '_model_path', None)
+        if not isinstance(onnx_path, (str, os.PathLike)):
+            continue
+        onnx_path = os.fspath(onnx_path)
+        paths = (onnx_path, onnx_path + '_data', onnx_path + '.data')
+        size = (size or 0) + sum(os.path.getsize(path) for path in paths if os.path.exists(path))
+    return size
+
+
+def model_size(model):
+    """ Объём памяти, занимаемый весами и буферами модели, в байтах """
+    tensors = list(model.parameters()) + list(model.buffers())
+    for value in model.state_dict().values():
+        # Веса динамически квантованных слоёв хранятся не в параметрах, а упакованными в state_dict
+        if isinstance(value, tuple):
+            tensors.extend(tensor for tensor in value if isinstance(tensor, torch.Tensor))
+    return sum(tensor.numel() * tensor.element_size() for tensor in tensors) + (onnx_files_size(model) or 0)
+
+
+class ModelRegistry:
+    """ Загружает модели при первом обращении и выгружает давно не используемые при превышении бюджета памяти """
+
+    def __init__(self, models=None, memory_budget=None, cpu_mode='fp32'):
+        """
+        :param models: словарь имя -> путь модели, по умолчанию MODELS.
+        :param memory_budget: сколько байт могут занимать загруженные модели. None -- без ограничения.
+        :param cpu_mode: режим инференса без GPU из encoding.cpu.CPU_MODES: 'fp32', 'int8' или 'onnx'.
+        """
+        self.models = MODELS if models is None else models
+        self.memory_budget = memory_budget
+        self.cpu_mode = cpu_mode
+        self.cpu_reports = {}
+        self._loaded = OrderedDict()
+        self._sizes = {}
+        self._lock = threading.Lock()
+        self._load_locks = {name: threading.Lock() for name in self.models}
+
+    def __contains__(self, model_name):
+        return model_name in self.models
+
+    def get(self, model_name):
+        """ Возвращает модель, при необходимости загружая её """
+        if model_name not in self.models:
+            raise KeyError(f'Model {model_name} not found')
+        with self._lock:
+            if model_name in self._loaded:
+                self._loaded.move_to_end(model_name)
+                return self._loaded[model_name]
+
+        # Загрузка идёт вне общей блокировки, чтобы не задерживать запросы к уже загруженным моделям
+        with self._load_locks[model_name]:
+            with self._lock:
+                if model_name in self._loaded:
+                    self._loaded.move_to_end(model_name)
+                    return self._loaded[model_name]
+
+            print(f"Загрузка модели {model_name}...")
+            model = SentenceTransformer(self.models[model_name])
+            size = model_size(model)
+            if torch.cuda.is_available():
+                model = model.to('cuda')
+            elif self.cpu_mode != 'fp32':
+                model, report = prepare_cpu_model(self.models[model_name], model, self.cpu_mode)
+                self.cpu_reports[model_name] = report
+                print(format_report(model_name, report))
+                # Если путь к ONNX-файлу узнать не удалось, берётся размер fp32-весов: он близок к размеру
+                # ONNX-модели в fp32, иначе модель занимала бы в бюджете почти 0 байт и никогда не выгружалась
+                if self.cpu_mode != 'onnx' or not report['accepted'] or onnx_files_size(model) is not None:
+                    size = model_size(model)
+
+            with self._lock:
+                self._sizes[model_name] = size
+                self._loaded[model_name] = model
+                self._evict()
+            return model
+
+    def warmup(self, model_names):
+        """ Загружает заданные модели заранее, например при старте сервиса """
+        for model_name in model_names:
+            self.get(model_name)
+
+    def loaded(self):
+        """ Имена загруженных моделей от давно использованной к недавней """
+        with self._lock:
+            return list(self._loaded)
+
+    def memory_usage(self):
+        with self._lock:
+            return sum(self._sizes[name] for name in self._loaded)
+
+    def _evict(self):
+        # Последняя загруженная модель не выгружается, даже если одна не помещается в бюджет
+        if self.memory_budget is None:
+            return
+        while len(self._loaded) > 1 and sum(self._sizes[name] for name in self._loaded) > self.memory_budget:
+            model_name, _ = self._loaded.popitem(last=False)
+            print(f"Выгрузка модели {model_name}")
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
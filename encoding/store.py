@@ -0,0 +1,179 @@
+# Бинарное хранилище эмбеддингов вместо embeddings.json.
+# Конвертация существующего файла:
+#     python -m encoding.store embeddings.json embeddings_store --dtype float16
+import argparse
+import json
+import os
+
+import numpy as np
+
+DTYPES = ('float32', 'float16')
+
+
+class EmbeddingStore:
+    """
+    Матрица эмбеддингов в файле vectors.bin и список id в ids.txt (строка i -- id вектора i).
+
+    Векторы открываются через np.memmap без копирования, новые векторы дописываются в конец
+    обоих файлов без перезаписи. Если id добавлен повторно, действует последний вектор.
+    compact() переписывает хранилище в новое поколение файлов (vectors.N.bin, ids.N.txt), а переключение
+    на него -- одна атомарная замена meta.json, поэтому id и векторы разных поколений не смешиваются.
+    """
+
+    def __init__(self, path, dim=None, dtype='float32'):
+        """
+        :param path: каталог хранилища. Создаётся, если его нет.
+        :param dim: размерность векторов; обязательна только при создании нового хранилища.
+        :param dtype: float32 или float16; используется только при создании нового хранилища.
+        """
+        self.path = path
+        self._meta_path = os.path.join(path, 'meta.json')
+
+        if os.path.exists(self._meta_path):
+            with open(self._meta_path) as f:
+                meta = json.load(f)
+            if dim is not None and dim != meta['dim']:
+                raise ValueError(f"Хранилище {path} содержит векторы размерности {meta['dim']}, а не {dim}")
+            self.dim, self.dtype = meta['dim'], np.dtype(meta['dtype'])
+            self._generation = meta.get('generation', 0)
+            self._vectors_path, self._ids_path = self._files(self._generation)
+        else:
+            if dim is None:
+                raise ValueError(f"Хранилище {path} не найдено, для создания нужно указать dim")
+            if dtype not in DTYPES:
+                raise ValueError(f"dtype={dtype} is not supported")
+            os.makedirs(path, exist_ok=True)
+            self.dim, self.dtype = dim, np.dtype(dtype)
+            self._generation = 0
+            self._vectors_path, self._ids_path = self._files(0)
+            open(self._vectors_path, 'wb').close()
+            open(self._ids_path, 'w').close()
+            self._write_meta()
+        self._remove_other_generations()
+
+        self.ids = self._load_ids()
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._vectors = None
+
+    def _files(self, generation):
+        suffix = f'.{generation}' if generation else ''
+        return os.path.join(self.path, f'vectors{suffix}.bin'), os.path.join(self.path, f'ids{suffix}.txt')
+
+    def _write_meta(self):
+        # os.replace атомарен: после сбоя meta.json указывает либо на старое, либо на новое поколение
+        with open(self._meta_path + '.tmp', 'w') as f:
+            json.dump({'dim': self.dim, 'dtype': self.dtype.name, 'generation': self._generation}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self._meta_path + '.tmp', self._meta_path)
+
+    def _remove_other_generations(self):
+        """ Удаляет файлы прерванного или завершённого сжатия, на которые не указывает meta.json """
+        current = {os.path.basename(self._vectors_path), os.path.basename(self._ids_path)}
+        for name in os.listdir(self.path):
+            if name.startswith(('vectors', 'ids')) and name not in current:
+                os.remove(os.path.join(self.path, name))
+
+    def _load_ids(self):
+        with open(self._ids_path, encoding='utf-8') as f:
+            text = f.read()
+        # Строка без перевода строки в конце -- недописанный при падении id, её вектор отбрасывается вместе с ней
+        complete = not text or text.endswith('\n')
+        ids = text.splitlines() if complete else text.splitlines()[:-1]
+        row_bytes = self.dim * self.dtype.itemsize
+        # Векторы пишутся раньше id, поэтому после аварийной остановки лишними могут оказаться векторы в конце
+        size = min(len(ids), os.path.getsize(self._vectors_path) // row_bytes)
+        if size < len(ids) or not complete or size * row_bytes < os.path.getsize(self._vectors_path):
+            ids = ids[:size]
+            os.truncate(self._vectors_path, size * row_bytes)
+            with open(self._ids_path, 'w', encoding='utf-8') as f:
+                f.writelines(doc_id + '\n' for doc_id in ids)
+        return ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return str(doc_id) in self.rows
+
+    @property
+    def vectors(self):
+        """ Все векторы хранилища как np.memmap формы (len(self), dim) """
+        if self._vectors is None or len(self._vectors) != len(self.ids):
+            if not self.ids:
+                return np.empty((0, self.dim), dtype=self.dtype)
+            self._vectors = np.memmap(self._vectors_path, dtype=self.dtype, mode='r', shape=(len(self.ids), self.dim))
+        return self._vectors
+
+    def get(self, doc_ids):
+        """ Векторы для списка id в том же порядке """
+        return self.vectors[[self.rows[str(doc_id)] for doc_id in doc_ids]]
+
+    def append(self, doc_ids, vectors):
+        """ Дописывает векторы в конец хранилища """
+        doc_ids = [str(doc_id) for doc_id in doc_ids]
+        if any('\n' in doc_id for doc_id in doc_ids):
+            raise ValueError("id не может содержать перевод строки")
+        vectors = np.asarray(vectors, dtype=self.dtype).reshape(len(doc_ids), self.dim)
+
+        # Сначала векторы, потом id: при падении между записями лишние векторы отбросятся при открытии
+        with open(self._vectors_path, 'ab') as f:
+            f.write(vectors.tobytes())
+        with open(self._ids_path, 'a', encoding='utf-8') as f:
+            f.writelines(doc_id + '\n' for doc_id in doc_ids)
+        for doc_id in doc_ids:
+            self.rows[doc_id] = len(self.ids)
+            self.ids.append(doc_id)
+
+    def compact(self, rows):
+        """ Оставляет в хранилище только строки rows (в этом порядке) """
+        rows = np.asarray(rows, dtype=np.int64)
+        ids = [self.ids[row] for row in rows.tolist()]
+        vectors = np.asarray(self.vectors[rows])
+        self._vectors = None
+
+        # Новое поколение записывается целиком и только потом становится текущим
+        generation = self._generation + 1
+        vectors_path, ids_path = self._files(generation)
+        with open(vectors_path, 'wb') as f:
+            f.write(vectors.tobytes())
+            f.flush()
+            os.fsync(f.fileno())
+        with open(ids_path, 'w', encoding='utf-8') as f:
+            f.writelines(doc_id + '\n' for doc_id in ids)
+            f.flush()
+            os.fsync(f.fileno())
+        old_paths = (self._vectors_path, self._ids_path)
+        self._generation, self._vectors_path, self._ids_path = generation, vectors_path, ids_path
+        self._write_meta()
+        for path in old_paths:
+            os.remove(path)
+
+        self.ids = ids
+        self.rows = {doc_id: row for row, doc_id in enumerate(ids)}
+
+
+def convert_json(json_path, store_path, dtype='float32', batch_size=1024):
+    """ Переносит эмбеддинги из JSON вида {id: [float, ...]} в EmbeddingStore """
+    with open(json_path) as f:
+        embeddings = json.load(f)
+    doc_ids = list(embeddings)
+    if not doc_ids:
+        raise ValueError(f"{json_path} не содержит эмбеддингов")
+
+    store = EmbeddingStore(store_path, dim=len(embeddings[doc_ids[0]]), dtype=dtype)
+    for start in range(0, len(doc_ids), batch_size):
+        batch = doc_ids[start:start + batch_size]
+        store.append(batch, [embeddings[doc_id] for doc_id in batch])
+    return store
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Конвертация embeddings.json в бинарное хранилище")
+    parser.add_argument('json_path')
+    parser.add_argument('store_path')
+    parser.add_argument('--dtype', default='float32', choices=DTYPES)
+    args = parser.parse_args()
+
+    store = convert_json(args.json_path, args.store_path, dtype=args.dtype)
+    print(f"Сохранено {len(store)} векторов размерности {store.dim} в {args.store_path}")
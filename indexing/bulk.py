@@ -0,0 +1,156 @@
+import json
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+# Статусы элементов и запросов, которые имеет смысл повторить
+RETRY_STATUSES = {429, 502, 503, 504}
+
+
+class BulkWriter:
+    """ Отправляет документы в Elasticsearch через Bulk API несколькими параллельными запросами """
+
+    def __init__(self, url, max_actions=500, max_bytes=10 * 1024 * 1024, max_in_flight=4,
+                 max_retries=5, backoff=0.5, max_backoff=30., timeout=1000, session=None):
+        """
+        :param url: адрес Elasticsearch, например http://localhost:9200.
+        :param max_actions: максимальное число документов в одном bulk-запросе.
+        :param max_bytes: максимальный размер тела bulk-запроса в байтах.
+        :param max_in_flight: сколько bulk-запросов может выполняться одновременно. Если все заняты, add() ждёт.
+        :param max_retries: сколько раз повторять отклонённые документы.
+        :param backoff: начальная задержка перед повтором в секундах, удваивается с каждой попыткой.
+        :param max_backoff: верхняя граница задержки перед повтором.
+        :param timeout: таймаут одного HTTP-запроса в секундах.
+        :param session: requests.Session для переиспользования соединений.
+        """
+        self.url = url.rstrip('/') + '/_bulk'
+        self.max_actions = max_actions
+        self.max_bytes = max_bytes
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.timeout = timeout
+        self.session = session or requests.Session()
+
+        self._buffer = []
+        self._buffer_bytes = 0
+        self._slots = threading.BoundedSemaphore(max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=max_in_flight)
+        self._futures = []
+        self._lock = threading.Lock()
+        self._success = defaultdict(int)
+        self._failed = defaultdict(int)
+        self._errors = defaultdict(list)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def add(self, index, doc_id, doc):
+        """ Добавляет документ в очередь на индексацию """
+        action = json.dumps({"index": {"_index": index, "_id": doc_id}}, ensure_ascii=False)
+        line = (action + '\n' + json.dumps(doc, ensure_ascii=False) + '\n').encode('utf-8')
+        if self._buffer and self._buffer_bytes + len(line) > self.max_bytes:
+            self.flush()
+        self._buffer.append((index, doc_id, line))
+        self._buffer_bytes += len(line)
+        if len(self._buffer) >= self.max_actions:
+            self.flush()
+
+    def flush(self):
+        """ Отправляет накопленные документы. Блокируется, пока все слоты для запросов заняты """
+        if not self._buffer:
+            return
+        chunk, self._buffer, self._buffer_bytes = self._buffer, [], 0
+        # Обратное давление: кодировщик ждёт, пока освободится один из параллельных запросов
+        self._slots.acquire()
+        future = self._executor.submit(self._send, chunk)
+        future.add_done_callback(lambda _: self._slots.release())
+        # Завершившиеся с исключением запросы остаются в списке, чтобы close() его выбросил
+        self._futures = [f for f in self._futures if not f.done() or f.exception() is not None] + [future]
+
+    def close(self):
+        """ Дожидается отправки всех документов и возвращает отчёт по индексам """
+        self.flush()
+        for future in self._futures:
+            future.result()
+        self._futures = []
+        self._executor.shutdown()
+        return self.report()
+
+    def report(self):
+        """ Число успешных и неудачных документов по каждому индексу и примеры ошибок """
+        with self._lock:
+            return {
+                index: {
+                    'success': self._success[index],
+                    'failed': self._failed[index],
+                    'errors': list(self._errors[index])
+                }
+                for index in set(self._success) | set(self._failed)
+            }
+
+    def _send(self, chunk):
+        for attempt in range(self.max_retries + 1):
+            last_attempt = attempt == self.max_retries
+            try:
+                response = self.session.post(self.url, data=b''.join(line for _, _, line in chunk),
+                                             headers={'Content-Type': 'application/x-ndjson'},
+                                             timeout=self.timeout)
+            except requests.RequestException as e:
+                error, status = str(e), None
+            else:
+                error, status = response.text[:200], response.status_code
+
+            if status == 200:
+                try:
+                    items = response.json()['items']
+                except (ValueError, KeyError, TypeError) as e:
+                    items, error = None, f'Invalid bulk response: {e!r}: {error}'
+                if items is None or len(items) != len(chunk):
+                    # Без результата по каждому документу нельзя понять, какие из них записаны
+                    self._record_failures(chunk, error if items is None else
+                                          f'Bulk response has {len(items)} items for {len(chunk)} documents')
+                    return
+                chunk = self._collect(chunk, items, last_attempt)
+                if not chunk:
+                    return
+            elif last_attempt or (status is not None and status not in RETRY_STATUSES):
+                # Весь запрос отклонён без возможности повтора
+                self._record_failures(chunk, f'HTTP {status}: {error}' if status else error)
+                return
+
+            if not last_attempt:
+                time.sleep(min(self.backoff * 2 ** attempt, self.max_backoff))
+
+    def _collect(self, chunk, items, last_attempt):
+        """ Учитывает результат bulk-запроса и возвращает документы, которые нужно повторить """
+        retry = []
+        with self._lock:
+            for entry, item in zip(chunk, items):
+                index = entry[0]
+                result = next(iter(item.values()))
+                status = result.get('status', 500)
+                if status < 300:
+                    self._success[index] += 1
+                elif status in RETRY_STATUSES and not last_attempt:
+                    retry.append(entry)
+                else:
+                    self._add_failure(index, entry[1], result.get('error', status))
+        return retry
+
+    def _record_failures(self, chunk, error):
+        with self._lock:
+            for index, doc_id, _ in chunk:
+                self._add_failure(index, doc_id, error)
+
+    def _add_failure(self, index, doc_id, error):
+        self._failed[index] += 1
+        # Храним только первые ошибки, чтобы отчёт не разрастался
+        if len(self._errors[index]) < 10:
+            self._errors[index].append({'_id': doc_id, 'error': error})
@@ -0,0 +1,124 @@
+# Переиндексация без простоя: товары загружаются в новый индекс products_{model}_{версия} с настройками
+# для быстрой записи (без refresh и реплик), затем индекс готовится к поиску, и алиас products_{model},
+# к которому обращается web/app.py, атомарно переключается на него
+import time
+
+import numpy as np
+
+# Параметры графа HNSW для поля embedding
+HNSW_M = 16
+HNSW_EF_CONSTRUCTION = 100
+SERVING_REPLICAS = 1
+WARMUP_QUERIES = 50
+# Таймаут долгих операций (force merge, ожидание реплик) в секундах
+LONG_TIMEOUT = 3600
+
+
+def alias_name(model_name):
+    return f"products_{model_name}"
+
+
+def version_index_name(model_name):
+    return f"{alias_name(model_name)}_{time.strftime('%Y%m%d%H%M%S')}"
+
+
+def embedding_mapping(dims, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    return {
+        "type": "dense_vector",
+        "dims": dims,
+        "index": True,
+        "similarity": "cosine",
+        "index_options": {"type": "hnsw", "m": m, "ef_construction": ef_construction}
+    }
+
+
+def create_build_index(es, model_name, dims, m=HNSW_M, ef_construction=HNSW_EF_CONSTRUCTION):
+    """ Создает новый версионированный индекс для загрузки и возвращает его имя """
+    index_name = version_index_name(model_name)
+    es.indices.create(
+        index=index_name,
+        body={
+            # Пока идёт загрузка, сегменты не открываются для поиска и не копируются на реплики
+            "settings": {"index": {"number_of_replicas": 0, "refresh_interval": "-1"}},
+            "mappings": {"properties": {"embedding": embedding_mapping(dims, m, ef_construction)}}
+        }, request_timeout=1000
+    )
+    return index_name
+
+
+def prepare_for_serving(es, index_name, replicas=SERVING_REPLICAS):
+    """ Возвращает индексу настройки для поиска и сливает сегменты """
+    es.indices.put_settings(index=index_name, body={"index": {"refresh_interval": None}}, request_timeout=1000)
+    es.indices.refresh(index=index_name, request_timeout=LONG_TIMEOUT)
+    # Слияние до добавления реплик: реплики копируют уже слитые сегменты, а не сливают их сами
+    es.indices.forcemerge(index=index_name, max_num_segments=1, request_timeout=LONG_TIMEOUT)
+    if replicas:
+        es.indices.put_settings(index=index_name, body={"index": {"number_of_replicas": replicas}},
+                                request_timeout=1000)
+        health = es.cluster.health(index=index_name, wait_for_status='green', timeout=f'{LONG_TIMEOUT}s',
+                                   request_timeout=LONG_TIMEOUT + 60, ignore=408)
+        if health.get('timed_out'):
+            print(f"Реплики индекса {index_name} не размещены, статус {health.get('status')}")
+
+
+def warm_up(es, index_name, queries=WARMUP_QUERIES, seed=0):
+    """ Прогоняет kNN-запросы по новому индексу, чтобы граф HNSW и векторы оказались в памяти до переключения """
+    mapping = es.indices.get_mapping(index=index_name)[index_name]['mappings']
+    dims = mapping['properties']['embedding']['dims']
+    rng = np.random.default_rng(seed)
+    for vector in rng.standard_normal((queries, dims)):
+        es.search(index=index_name, body={
+            "knn": {"field": "embedding", "query_vector": vector.tolist(), "k": 10, "num_candidates": 100},
+            "size": 10,
+            "_source": False
+        }, request_timeout=1000)
+
+
+def is_concrete_index(es, model_name):
+    """ products_{model} -- обычный индекс, а не алиас: переиндексация с --build ещё не выполнялась """
+    alias = alias_name(model_name)
+    return not es.indices.exists_alias(name=alias) and bool(es.indices.exists(index=alias))
+
+
+def check_concrete_index(es, model_name, delete_old):
+    """
+    Алиас не может называться так же, как существующий индекс, поэтому при первом переключении обычный индекс
+    products_{model} удаляется, и откатиться на него нельзя. Это делается только с явным delete_old.
+    """
+    if not delete_old and is_concrete_index(es, model_name):
+        raise ValueError(f"{alias_name(model_name)} -- обычный индекс: при переключении на алиас он будет удалён "
+                         "без возможности отката. Чтобы это разрешить, запустите с --delete-old")
+
+
+def swap_alias(es, model_name, index_name, delete_old=False):
+    """
+    Одним запросом переключает алиас products_{model} на index_name и возвращает индексы, на которые он указывал.
+    Если products_{model} -- обычный индекс (до первой переиндексации), он удаляется тем же запросом,
+    но только при delete_old=True, иначе ValueError.
+    """
+    alias = alias_name(model_name)
+    actions, old_indexes = [], []
+    if es.indices.exists_alias(name=alias):
+        old_indexes = [index for index in es.indices.get_alias(name=alias) if index != index_name]
+        actions += [{"remove": {"index": index, "alias": alias}} for index in old_indexes]
+    elif es.indices.exists(index=alias):
+        check_concrete_index(es, model_name, delete_old)
+        actions.append({"remove_index": {"index": alias}})
+    actions.append({"add": {"index": index_name, "alias": alias}})
+    es.indices.update_aliases(body={"actions": actions}, request_timeout=1000)
+    return old_indexes
+
+
+def finish_build(es, model_name, index_name, replicas=SERVING_REPLICAS, delete_old=False):
+    """ Готовит загруженный индекс к поиску и переключает на него алиас """
+    print(f"{index_name}: подготовка к поиску")
+    prepare_for_serving(es, index_name, replicas)
+    warm_up(es, index_name)
+    old_indexes = swap_alias(es, model_name, index_name, delete_old=delete_old)
+    print(f"{alias_name(model_name)} -> {index_name}")
+    for index in old_indexes:
+        if delete_old:
+            es.indices.delete(index=index, request_timeout=1000)
+            print(f"Удалён индекс {index}")
+        else:
+            print(f"Предыдущий индекс {index} оставлен для отката")
@@ -0,0 +1,98 @@
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+from indexing.bulk import BulkWriter
+
+
+class StubBulkHandler(BaseHTTPRequestHandler):
+    """ Отвечает на _bulk функцией server.respond(документы запроса) -> (HTTP-статус, тело) """
+
+    def do_POST(self):
+        lines = self.rfile.read(int(self.headers['Content-Length'])).decode('utf-8').splitlines()
+        docs = [(json.loads(action)['index'], json.loads(doc)) for action, doc in zip(lines[::2], lines[1::2])]
+        self.server.requests.append(docs)
+        status, body = self.server.respond(docs)
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+@pytest.fixture
+def server():
+    server = ThreadingHTTPServer(('127.0.0.1', 0), StubBulkHandler)
+    server.requests = []
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+def bulk_response(statuses):
+    """ Ответ _bulk с заданным статусом каждого документа """
+    items = [{'index': {'status': status, **({'error': {'type': 'error_' + str(status)}} if status >= 300 else {})}}
+             for status in statuses]
+    return 200, json.dumps({'errors': any(status >= 300 for status in statuses), 'items': items}).encode('utf-8')
+
+
+def write(server, docs, **kwargs):
+    with BulkWriter(f'http://127.0.0.1:{server.server_port}', backoff=0., **kwargs) as writer:
+        for index, doc_id in docs:
+            writer.add(index, doc_id, {'id': doc_id})
+    return writer.report()
+
+
+def test_item_429_is_retried(server):
+    # Первый раз документ 'b' отклоняется с 429, при повторе записывается
+    server.respond = lambda docs: bulk_response([429 if doc['id'] == 'b' and len(server.requests) == 1 else 201
+                                                 for _, doc in docs])
+    report = write(server, [('products', 'a'), ('products', 'b'), ('products', 'c')])
+
+    assert report == {'products': {'success': 3, 'failed': 0, 'errors': []}}
+    assert [[doc['id'] for _, doc in docs] for docs in server.requests] == [['a', 'b', 'c'], ['b']]
+
+
+def test_item_400_is_not_retried(server):
+    server.respond = lambda docs: bulk_response([400 if doc['id'] == 'b' else 201 for _, doc in docs])
+    report = write(server, [('products', 'a'), ('products', 'b')])
+
+    assert report == {'products': {'success': 1, 'failed': 1,
+                                   'errors': [{'_id': 'b', 'error': {'type': 'error_400'}}]}}
+    assert len(server.requests) == 1
+
+
+def test_item_429_fails_after_retries(server):
+    server.respond = lambda docs: bulk_response([429] * len(docs))
+    report = write(server, [('products', 'a')], max_retries=2)
+
+    assert report['products']['failed'] == 1
+    assert len(server.requests) == 3
+
+
+def test_report_per_index(server):
+    server.respond = lambda docs: bulk_response([400 if meta['_index'] == 'products_minilm' and doc['id'] == '2'
+                                                 else 201 for meta, doc in docs])
+    docs = [(index, str(i)) for i in range(5) for index in ('products_mpnet', 'products_minilm')]
+    report = write(server, docs, max_actions=3)
+
+    assert {index: (stats['success'], stats['failed']) for index, stats in report.items()} == {
+        'products_mpnet': (5, 0), 'products_minilm': (4, 1)}
+    assert report['products_minilm']['errors'][0]['_id'] == '2'
+    assert len(server.requests) == 4
+
+
+@pytest.mark.parametrize('body', [b'not json', b'{"took": 1}'])
+def test_invalid_response_counts_as_failure(server, body):
+    server.respond = lambda docs: (200, body)
+    report = write(server, [('products', 'a'), ('products', 'b')])
+
+    assert report['products']['success'] == 0
+    assert report['products']['failed'] == 2
+    assert 'Invalid bulk response' in report['products']['errors'][0]['error']
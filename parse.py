@@ -1,29 +1,41 @@
-from datasets import load_dataset
-from elasticsearch import Elasticsearch
-from sentence_transformers import SentenceTransformer
+import argparse
+from functools import lru_cache
+
 from tqdm import tqdm
-import torch
-
-MODELS = {
-    'mpnet': 'sentence-transformers/all-mpnet-base-v2',
-    'minilm': 'sentence-transformers/all-MiniLM-L6-v2',
-    'qa-mpnet': 'sentence-transformers/multi-qa-mpnet-base-dot-v1',
-    'multilingual': 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
-}
-# Подключение к Elasticsearch
-es = Elasticsearch(["http://localhost:9200"])
-
-# Проверка соединения с Elasticsearch
-if not es.ping():
-    raise ValueError("Ошибка подключения к Elasticsearch")
-
-# Загрузка моделей
-models = {}
-for model_name, model_path in MODELS.items():
-    print(f"Загрузка модели {model_name}...")
-    models[model_name] = SentenceTransformer(model_path)
-    if torch.cuda.is_available():
-        models[model_name] = models[model_name].to('cuda')
+
+from encoding.batch import BATCH_SIZE, product_text
+from encoding.cache import EmbeddingCache, encode_with_cache
+from encoding.pipeline import THREADS_PER_WORKER, EncodingPipeline
+from encoding.models import MODELS
+from indexing.bulk import BulkWriter
+from indexing.reindex import SERVING_REPLICAS, check_concrete_index, create_build_index, finish_build
+
+# Сколько товаров собирается перед кодированием всеми моделями
+CHUNK_SIZE = 4096
+# Каталог кэша эмбеддингов: повторно кодируются только товары с изменившимся текстом
+CACHE_DIR = 'embedding_cache'
+PICTURE_URL = 'https://www.google.com/url?sa=i&url=https%3A%2F%2Fwww.pixsy.com%2Fimage-theft%2Fverify-image-source-copyright-owner&psig=AOvVaw3sptq6uKBUX8dL051JtPC8&ust=1741552195372000&source=images&cd=vfe&opi=89978449&ved=0CBQQjRxqFwoTCKC90veo-4sDFQAAAAAdAAAAABAO'
+
+# Параметры отправки в Bulk API
+BULK_ACTIONS = 500
+BULK_BYTES = 10 * 1024 * 1024
+BULK_IN_FLIGHT = 4
+
+ES_URL = "http://localhost:9200"
+
+# Модуль заново импортируется процессами-кодировщиками (encoding/pipeline.py) до привязки к ядрам, поэтому
+# elasticsearch, torch и sentence_transformers импортируются только при первом обращении в основном процессе
+@lru_cache(maxsize=None)
+def get_es():
+    """ Подключение к Elasticsearch """
+    from elasticsearch import Elasticsearch
+    return Elasticsearch([ES_URL])
+
+@lru_cache(maxsize=None)
+def get_registry():
+    """ Реестр моделей: модели загружаются при первом обращении; при индексации нужны все, бюджета памяти нет """
+    from encoding.registry import ModelRegistry
+    return ModelRegistry()
 
 def encode_text(text, model):
     """ Кодирует текст в эмбеддинг с использованием указанной модели """
@@ -32,12 +44,17 @@ def encode_text(text, model):
 
 def encode_product(product, model):
     """ Кодирует текстовую информацию о товаре в эмбеддинг """
-    text_data = f"{product.get('name', '')} {product.get('brand', '')} {product.get('description', '')} " \
-                f"{product.get('categories', '')} {product.get('params_str', '')}"
-    return encode_text(text_data, model)
+    return encode_text(product_text(product), model)
 
-def create_index(model_name):
-    """ Создает индекс с dense_vector для указанной модели """
+def create_index(model_name, dims=None, build=False):
+    """
+    Создает индекс с dense_vector для указанной модели и возвращает имя индекса для записи.
+    При build=True создается новый версионированный индекс, на который после загрузки переключается алиас
+    """
+    dims = dims or get_registry().get(model_name).get_sentence_embedding_dimension()
+    es = get_es()
+    if build:
+        return create_build_index(es, model_name, dims)
     index_name = f"products_{model_name}"
     if not es.indices.exists(index=index_name):
         es.indices.create(
@@ -45,58 +62,155 @@ def create_index(model_name):
             body={
                 "mappings": {
                     "properties": {
-                        "embedding": {"type": "dense_vector", "dims": models[model_name].get_sentence_embedding_dimension()}
+                        "embedding": {"type": "dense_vector", "dims": dims}
                     }
                 }
             }, request_timeout=1000
         )
+    return index_name
 
-def load_and_index_dataset():
-    """ Загружает датасет и индексирует товары в Elasticsearch с использованием Bulk API """
-    # Загрузка датасета
-    print('load_dataset')
-    dataset = load_dataset("breadlicker45/products", split='train')
-    print('end load_dataset')
+def build_product_dict(product, index):
+    """ Приводит запись датасета к документу для индексации """
+    return {
+        "id": product.get('uniq_id', index),
+        "name": product.get('product_name', ''),
+        "brand": product.get('manufacturer', ''),
+        "description": product.get('description', ''),
+        "categories": product.get('amazon_category_and_sub_category', ''),
+        "params_str": product.get('product_information', ''),
+        "picture": PICTURE_URL
+    }
 
-    # Создание индексов для каждой модели
-    for model_name in MODELS.keys():
-        create_index(model_name)
-    bulk_data = []
-    i = 1
+def read_chunks(dataset, chunk_size):
+    """ Пачки пар (номер товара, документ) по chunk_size товаров """
+    chunk = []
     for index, product in enumerate(tqdm(dataset, desc="Подготовка данных для индексации")):
         try:
-            product_dict = {
-                "id": product.get('uniq_id', index),
-                "name": product.get('product_name', ''),
-                "brand": product.get('manufacturer', ''),
-                "description": product.get('description', ''),
-                "categories": product.get('amazon_category_and_sub_category', ''),
-                "params_str": product.get('product_information', ''),
-                "picture": 'https://www.google.com/url?sa=i&url=https%3A%2F%2Fwww.pixsy.com%2Fimage-theft%2Fverify-image-source-copyright-owner&psig=AOvVaw3sptq6uKBUX8dL051JtPC8&ust=1741552195372000&source=images&cd=vfe&opi=89978449&ved=0CBQQjRxqFwoTCKC90veo-4sDFQAAAAAdAAAAABAO'
-            }
-
-            # Индексируем товар для каждой модели
-            for model_name, model in models.items():
-                payload = product_dict.copy()
-                payload["embedding"] = encode_product(product_dict, model)
-
-                # Добавляем действие для Bulk API
-                bulk_data.append(
-                    {
-                        "index": {
-                            "_index": f"products_{model_name}",
-                            "_id": i
-                        }
-                    },
-                )
-                bulk_data.append(payload)
-                i += 1
-            if len(bulk_data) > 500:
-                es.bulk(body=bulk_data, request_timeout=1000)
-                bulk_data = []
+            chunk.append((index, build_product_dict(product, index)))
         except Exception as e:
             print(f"Ошибка при подготовке товара {index}: {e}")
-    print(es.bulk(body=bulk_data,request_timeout=1000)['errors'])
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+def index_chunk(chunk, batch_size, writer, caches, index_names):
+    """ Кодирует пачку товаров всеми моделями и ставит документы в очередь Bulk API """
+    # Текст товара строится один раз и переиспользуется всеми моделями
+    texts = [product_text(product_dict) for _, product_dict in chunk]
+    embeddings = {model_name: encode_with_cache(get_registry().get(model_name), texts, caches[model_name],
+                                                batch_size=batch_size)
+                  for model_name in MODELS}
+    write_chunk(chunk, embeddings, writer, index_names)
+
+def write_chunk(chunk, embeddings, writer, index_names):
+    """ Ставит документы пачки с эмбеддингами всех моделей в очередь Bulk API """
+    for pos, (index, product_dict) in enumerate(chunk):
+        for model_pos, model_name in enumerate(MODELS):
+            payload = product_dict.copy()
+            payload["embedding"] = embeddings[model_name][pos].tolist()
+            writer.add(index_names[model_name], index * len(MODELS) + model_pos + 1, payload)
+
+def index_dataset(dataset, batch_size, chunk_size, cache_dir, build):
+    """ Кодирует товары моделями по очереди в текущем процессе """
+    # Создание индексов для каждой модели
+    index_names = {model_name: create_index(model_name, build=build) for model_name in MODELS.keys()}
+    caches = {model_name: EmbeddingCache(cache_dir, model_name,
+                                         get_registry().get(model_name).get_sentence_embedding_dimension())
+              for model_name in MODELS}
+    writer = BulkWriter(ES_URL, max_actions=BULK_ACTIONS, max_bytes=BULK_BYTES, max_in_flight=BULK_IN_FLIGHT)
+    for chunk in read_chunks(dataset, chunk_size):
+        index_chunk(chunk, batch_size, writer, caches, index_names)
+    return writer, caches, index_names
+
+def index_dataset_parallel(dataset, batch_size, chunk_size, cache_dir, build, workers, threads_per_worker):
+    """ Кодирует товары процессами-кодировщиками, все модели одновременно """
+    with EncodingPipeline(MODELS, workers, threads_per_worker=threads_per_worker, batch_size=batch_size) as pipeline:
+        index_names = {model_name: create_index(model_name, pipeline.dims[model_name], build=build)
+                       for model_name in MODELS.keys()}
+        caches = {model_name: EmbeddingCache(cache_dir, model_name, pipeline.dims[model_name])
+                  for model_name in MODELS}
+        writer = BulkWriter(ES_URL, max_actions=BULK_ACTIONS, max_bytes=BULK_BYTES, max_in_flight=BULK_IN_FLIGHT)
+        chunks = ((chunk, [product_text(product_dict) for _, product_dict in chunk])
+                  for chunk in read_chunks(dataset, chunk_size))
+        pipeline.run(chunks, lambda chunk, embeddings: write_chunk(chunk, embeddings, writer, index_names), caches)
+    return writer, caches, index_names
+
+def load_and_index_dataset(batch_size=BATCH_SIZE, chunk_size=CHUNK_SIZE, cache_dir=CACHE_DIR, workers=0,
+                           threads_per_worker=THREADS_PER_WORKER, build=False, replicas=SERVING_REPLICAS,
+                           delete_old=False):
+    """
+    Загружает датасет и индексирует товары в Elasticsearch с использованием Bulk API.
+    При build=True товары пишутся в новые индексы, которые после загрузки подменяют текущие через алиасы
+    """
+    # Проверка соединения с Elasticsearch
+    es = get_es()
+    if not es.ping():
+        raise ValueError("Ошибка подключения к Elasticsearch")
+    if build:
+        # Проверка до загрузки: иначе отказ переключить алиас обнаружился бы только после индексации всех товаров
+        for model_name in MODELS:
+            check_concrete_index(es, model_name, delete_old)
+
+    # Загрузка датасета
+    from datasets import load_dataset
+    print('load_dataset')
+    dataset = load_dataset("breadlicker45/products", split='train')
+    print('end load_dataset')
+
+    if workers:
+        writer, caches, index_names = index_dataset_parallel(dataset, batch_size, chunk_size, cache_dir, build,
+                                                             workers, threads_per_worker)
+    else:
+        writer, caches, index_names = index_dataset(dataset, batch_size, chunk_size, cache_dir, build)
+
+    # Отчёт по каждому индексу: сколько документов записано и какие ошибки вернул Elasticsearch
+    report = writer.close()
+    for index_name, stats in sorted(report.items()):
+        print(f"{index_name}: успешно {stats['success']}, ошибок {stats['failed']}")
+        for error in stats['errors']:
+            print(f"    {error['_id']}: {error['error']}")
+
+    if build:
+        for model_name, index_name in index_names.items():
+            # Неполный индекс не подменяет рабочий: алиас остаётся на прежнем
+            if report.get(index_name, {}).get('failed'):
+                print(f"{index_name}: есть ошибки загрузки, алиас products_{model_name} не переключен")
+                continue
+            finish_build(es, model_name, index_name, replicas=replicas, delete_old=delete_old)
+
+    # Товары, которых больше нет в датасете, удаляются из кэша
+    for model_name, cache in caches.items():
+        print(f"Кэш {model_name}: попаданий {cache.hits}, промахов {cache.misses} ({cache.hit_rate:.1%})")
+        cache.compact()
+
+def parse_workers(values):
+    """ '16' -> 16, ['mpnet=6', 'minilm=2'] -> {'mpnet': 6, 'minilm': 2} """
+    if len(values) == 1 and '=' not in values[0]:
+        return int(values[0])
+    return {name: int(count) for name, count in (value.split('=', 1) for value in values)}
+
 # Запуск процесса загрузки и индексации
 if __name__ == "__main__":
-    load_and_index_dataset()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="Индексация товаров в Elasticsearch")
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help="размер батча для model.encode")
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE,
+                        help="сколько товаров кодируется за один проход всеми моделями")
+    parser.add_argument('--cache-dir', default=CACHE_DIR, help="каталог кэша эмбеддингов")
+    parser.add_argument('--workers', nargs='+', default=['0'],
+                        help="число процессов-кодировщиков (делится между моделями) или пары модель=число; "
+                             "0 -- кодирование в основном процессе")
+    parser.add_argument('--threads-per-worker', type=int, default=THREADS_PER_WORKER,
+                        help="число потоков torch в каждом процессе-кодировщике")
+    parser.add_argument('--build', action='store_true',
+                        help="писать в новые индексы и после загрузки переключить на них алиасы products_{model}")
+    parser.add_argument('--replicas', type=int, default=SERVING_REPLICAS,
+                        help="число реплик нового индекса после загрузки (с --build)")
+    parser.add_argument('--delete-old', action='store_true',
+                        help="удалить индексы, с которых переключены алиасы. При первом --build обязателен: "
+                             "обычный индекс products_{model} заменяется алиасом и удаляется без возможности отката")
+    args = parser.parse_args()
+    load_and_index_dataset(batch_size=args.batch_size, chunk_size=args.chunk_size, cache_dir=args.cache_dir,
+                           workers=parse_workers(args.workers), threads_per_worker=args.threads_per_worker,
+                           build=args.build, replicas=args.replicas, delete_old=args.delete_old)
@@ -0,0 +1,108 @@
+import argparse
+import json
+
+import torch
+
+from model import RankFormer
+
+
+class ListScorer(torch.nn.Module):
+    """
+    Inference-only view of a RankFormer that scores a single list.
+
+    A single list needs no splitting, padding or padding mask, so the forward pass only consists of tensor
+    operations and can be traced with a dynamic list length. The listwide score head is dropped.
+    """
+
+    def __init__(self, model):
+        super().__init__()
+        self.transformer = model.transformer
+        self.rank_score_net = model.rank_score_net
+        self.list_emb = model.list_emb
+        self.concat_list_emb = model.list_pred_strength > 0.
+
+    def forward(self, feat):
+        """
+        :param feat: Tensor of shape (N, input_dim) with the features of the N list elements.
+        :return: Tensor of shape (N,) with the predicted score of each list element.
+        """
+        feat = feat.unsqueeze(0)
+        if self.list_emb is not None:
+            feat = torch.cat([self.list_emb.weight[:1].unsqueeze(0), feat], dim=1)
+
+        tf_embs = self.transformer(feat)
+
+        if self.list_emb is not None:
+            tf_list_emb = tf_embs[:, 0]
+            tf_embs = tf_embs[:, 1:]
+            if self.concat_list_emb:
+                tf_embs = torch.cat([tf_embs, tf_list_emb.unsqueeze(1).expand(-1, tf_embs.shape[1], -1)], dim=-1)
+
+        return self.rank_score_net(tf_embs[0])
+
+
+def export(model, path, features=None, first_stage=None, example_length=32):
+    """
+    Saves a frozen TorchScript module that maps a (N, input_dim) feature matrix to N scores.
+
+    The model is put in eval mode before tracing, and freezing inlines the parameters and removes the (then inactive)
+    dropout layers. The input dimensionality, feature names and first stage are stored in the 'meta.json' extra file,
+    so that the serving side can check them against the features it computes and the search it reranks.
+
+    :param model: a trained RankFormer.
+    :param path: output file.
+    :param features: optional list of feature names, in the order of the input columns.
+    :param first_stage: optional dict with the 'backend', 'mode' and 'fusion' of the search that produced the training
+        candidates. Score features of different first stages are on different scales, so the service only reranks
+        matching requests by default.
+    :param example_length: list length used for tracing. The traced module accepts lists of any length.
+    :return: the exported module.
+    """
+    input_dim = model.transformer.layers[0].self_attn.embed_dim
+    if features is not None and len(features) != input_dim:
+        raise ValueError(f'{len(features)} feature names were given for input_dim={input_dim}')
+
+    scorer = ListScorer(model.cpu()).eval()
+    example = torch.randn(example_length, input_dim)
+    with torch.no_grad():
+        traced = torch.jit.trace(scorer, example)
+        frozen = torch.jit.optimize_for_inference(torch.jit.freeze(traced))
+
+        # The traced module must not depend on the list length it was traced with
+        for length in (1, example_length + 7):
+            check = torch.randn(length, input_dim)
+            if not torch.allclose(frozen(check), scorer(check), atol=1e-5):
+                raise RuntimeError(f'Exported scores differ from the model for a list of length {length}')
+
+    meta = {'input_dim': input_dim, 'features': features, 'first_stage': first_stage}
+    torch.jit.save(frozen, path, _extra_files={'meta.json': json.dumps(meta)})
+    return frozen
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Export a trained RankFormer checkpoint for CPU inference")
+    parser.add_argument('checkpoint', help="checkpoint saved by main.py")
+    parser.add_argument('out', help="output TorchScript file")
+    parser.add_argument('--input-dim', type=int, required=True)
+    parser.add_argument('--max-target', type=int, default=4)
+    parser.add_argument('--tf-dim-feedforward', type=int, default=512)
+    parser.add_argument('--tf-nhead', type=int, default=1)
+    parser.add_argument('--tf-num-layers', type=int, default=3)
+    parser.add_argument('--head-hidden-layers', type=int, nargs='+', default=[128])
+    parser.add_argument('--list-pred-strength', type=float, default=1.)
+    parser.add_argument('--features', help="comma-separated feature names, in the order of the input columns")
+    parser.add_argument('--backend', default='elasticsearch', choices=['elasticsearch', 'ann'],
+                        help="first-stage search backend the training candidates came from")
+    parser.add_argument('--mode', default='script_score', choices=['script_score', 'hybrid'],
+                        help="first-stage search mode the training candidates came from")
+    parser.add_argument('--fusion', default='rrf', choices=['rrf', 'minmax'], help="first-stage fusion in hybrid mode")
+    args = parser.parse_args()
+
+    model = RankFormer(input_dim=args.input_dim, max_target=args.max_target,
+                       tf_dim_feedforward=args.tf_dim_feedforward, tf_nhead=args.tf_nhead,
+                       tf_num_layers=args.tf_num_layers, head_hidden_layers=args.head_hidden_layers,
+                       list_pred_strength=args.list_pred_strength)
+    checkpoint = torch.load(args.checkpoint, map_location='cpu')
+    model.load_state_dict(checkpoint['model_state'])
+    export(model, args.out, features=args.features.split(',') if args.features else None,
+           first_stage={'backend': args.backend, 'mode': args.mode, 'fusion': args.fusion})
@@ -0,0 +1,180 @@
+import json
+import os
+import re
+
+import numpy as np
+import pandas as pd
+
+NUM_FEATURES = 136
+# Number of bytes read from the file at once
+CHUNK_BYTES = 64 * 1024 * 1024
+
+_COMMENT = re.compile(rb'#[^\n]*')
+
+
+def read_chunks(path, chunk_bytes=CHUNK_BYTES):
+    """
+    Reads the file in blocks of about chunk_bytes that end on a line boundary.
+    """
+    with open(path, 'rb') as f:
+        remainder = b''
+        while True:
+            block = f.read(chunk_bytes)
+            if not block:
+                break
+            block = remainder + block
+            end = block.rfind(b'\n') + 1
+            remainder = block[end:]
+            if end:
+                yield block[:end]
+        if remainder.strip():
+            yield remainder + b'\n'
+
+
+def parse_chunk(text, num_features=NUM_FEATURES):
+    """
+    Parses complete lines of a dense LETOR file, i.e. '<label> qid:<qid> 1:<value> ... <num_features>:<value>'.
+
+    The 'qid:' prefix is dropped and the remaining colons are replaced by spaces, after which the whole chunk is parsed
+    as one flat sequence of numbers: the label and qid, followed by (index, value) pairs. Chunks where some line does
+    not list exactly the features 1 to num_features in order are handled by a slower per-line fallback.
+
+    :return: a tuple of labels (n,), qids (n,) and features (n, num_features).
+    """
+    if b'#' in text:
+        text = _COMMENT.sub(b'', text)
+    values = np.fromstring(text.replace(b'qid:', b'').replace(b':', b' '), sep=' ')
+    row_size = 2 + 2 * num_features
+    if values.shape[0] != row_size * text.count(b'\n'):
+        return parse_sparse_lines(text, num_features)
+    values = values.reshape(-1, row_size)
+    if not (values[:, 2::2] == np.arange(1, num_features + 1)).all():
+        return parse_sparse_lines(text, num_features)
+    return values[:, 0].astype(np.int32), values[:, 1].astype(np.int64), values[:, 3::2].astype(np.float32)
+
+
+def parse_sparse_lines(text, num_features=NUM_FEATURES):
+    """ Per-line parser for LETOR files where absent features are omitted (they are set to 0). """
+    labels, qids, rows = [], [], []
+    for line in text.splitlines():
+        tokens = line.split()
+        if not tokens:
+            continue
+        labels.append(int(float(tokens[0])))
+        qids.append(int(tokens[1].split(b':')[1]))
+        row = np.zeros(num_features, dtype=np.float32)
+        for token in tokens[2:]:
+            index, value = token.split(b':')
+            row[int(index) - 1] = float(value)
+        rows.append(row)
+    features = np.stack(rows) if rows else np.empty((0, num_features), dtype=np.float32)
+    return np.asarray(labels, dtype=np.int32), np.asarray(qids, dtype=np.int64), features
+
+
+def parse_letor(path, num_features=NUM_FEATURES, max_rows=None, chunk_bytes=CHUNK_BYTES):
+    """
+    Streams the file chunk by chunk, so that only one chunk of text is held in memory at a time.
+
+    :return: a generator of (labels, qids, features) tuples, together holding at most max_rows rows.
+    """
+    num_rows = 0
+    for text in read_chunks(path, chunk_bytes):
+        labels, qids, features = parse_chunk(text, num_features)
+        if max_rows is not None and num_rows + labels.shape[0] >= max_rows:
+            end = max_rows - num_rows
+            yield labels[:end], qids[:end], features[:end]
+            return
+        num_rows += labels.shape[0]
+        yield labels, qids, features
+
+
+def build_cache(path, cache_dir, num_features=NUM_FEATURES, chunk_bytes=CHUNK_BYTES):
+    """
+    Writes labels (int32), qids (int64) and features (float32, row-major) as raw binary files in cache_dir, plus a
+    meta.json with the number of rows and the size and modification time of the source file. The meta file is written
+    last, so an interrupted build is never mistaken for a complete cache.
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+    files = {name: open(os.path.join(cache_dir, f'{name}.bin.tmp'), 'wb') for name in ('labels', 'qids', 'features')}
+    num_rows = 0
+    try:
+        for labels, qids, features in parse_letor(path, num_features, chunk_bytes=chunk_bytes):
+            labels.tofile(files['labels'])
+            qids.tofile(files['qids'])
+            features.tofile(files['features'])
+            num_rows += labels.shape[0]
+    finally:
+        for f in files.values():
+            f.close()
+    for name in files:
+        os.replace(os.path.join(cache_dir, f'{name}.bin.tmp'), os.path.join(cache_dir, f'{name}.bin'))
+    with open(meta_path, 'w') as f:
+        json.dump({'num_rows': num_rows, 'num_features': num_features, 'source': source_signature(path)}, f)
+
+
+def source_signature(path):
+    stat = os.stat(path)
+    return {'size': stat.st_size, 'mtime': stat.st_mtime}
+
+
+def load_cache(path, cache_dir, num_features=NUM_FEATURES):
+    """
+    Memory-maps the cached arrays without reading them. Returns None if there is no complete cache for the current
+    version of the source file.
+    """
+    meta_path = os.path.join(cache_dir, 'meta.json')
+    if not os.path.exists(meta_path):
+        return None
+    with open(meta_path) as f:
+        meta = json.load(f)
+    if meta['num_features'] != num_features or meta['source'] != source_signature(path):
+        return None
+
+    num_rows = meta['num_rows']
+    if num_rows == 0:
+        return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64),
+                np.empty((0, num_features), dtype=np.float32))
+    return (np.memmap(os.path.join(cache_dir, 'labels.bin'), dtype=np.int32, mode='r', shape=(num_rows,)),
+            np.memmap(os.path.join(cache_dir, 'qids.bin'), dtype=np.int64, mode='r', shape=(num_rows,)),
+            np.memmap(os.path.join(cache_dir, 'features.bin'), dtype=np.float32, mode='r',
+                      shape=(num_rows, num_features)))
+
+
+def load_letor(path, num_features=NUM_FEATURES, cache_dir=None, max_rows=None):
+    """
+    Loads a LETOR/SVMlight ranking file (e.g. MSLR-WEB30K) as arrays.
+
+    The first full load parses the file and writes a binary cache (by default next to the file, in '<path>.cache'),
+    later loads memory-map that cache. Loads with max_rows only parse the start of the file and skip the cache.
+
+    :return: a tuple of labels (N,), qids (N,) and features (N, num_features).
+    """
+    if max_rows is not None:
+        chunks = list(parse_letor(path, num_features, max_rows=max_rows))
+        if not chunks:
+            return (np.empty(0, dtype=np.int32), np.empty(0, dtype=np.int64),
+                    np.empty((0, num_features), dtype=np.float32))
+        return tuple(np.concatenate(arrays) for arrays in zip(*chunks))
+
+    cache_dir = cache_dir or f'{path}.cache'
+    arrays = load_cache(path, cache_dir, num_features)
+    if arrays is None:
+        print(f"Parsing {path} into {cache_dir}...")
+        build_cache(path, cache_dir, num_features)
+        arrays = load_cache(path, cache_dir, num_features)
+    return arrays
+
+
+def letor_dataframe(path, num_features=NUM_FEATURES, cache_dir=None, max_rows=None):
+    """
+    :return: a DataFrame with 'target' and 'qid' columns (int) and features 'feat_1' to 'feat_<num_features>'
+    (float32), as expected by LearningToRankDataset.
+    """
+    labels, qids, features = load_letor(path, num_features, cache_dir=cache_dir, max_rows=max_rows)
+    df = pd.DataFrame(features, columns=[f'feat_{i}' for i in range(1, num_features + 1)], copy=False)
+    df.insert(0, 'qid', qids)
+    df.insert(0, 'target', labels)
+    return df
@@ -1,22 +1,51 @@
 import torch
 
 
+def segment_ids(length, total_length):
+    """
+    :param length: Tensor of shape (B,) with the length of each list.
+    :param total_length: the total number of list elements, i.e. length.sum(). Passing it avoids a host sync.
+    :return: Tensor of shape (total_length,) with the index of the list that each list element belongs to.
+    """
+    return torch.repeat_interleave(torch.arange(length.shape[0], device=length.device), length,
+                                   output_size=total_length)
+
+
+def segment_sum(values, length):
+    """ Sums the rows of values per list, returning a Tensor with B rows. """
+    ids = segment_ids(length, values.shape[0])
+    return values.new_zeros((length.shape[0],) + values.shape[1:]).index_add(0, ids, values)
+
+
+def segment_max(values, length):
+    """ Maximum of the (1-dimensional) values per list, returning a Tensor of shape (B,). """
+    ids = segment_ids(length, values.shape[0])
+    return values.new_zeros(length.shape[0]).scatter_reduce(0, ids, values, 'amax', include_self=False)
+
+
 class BaseRankLoss(torch.nn.Module):
     def forward(self, score, target):
         raise NotImplementedError
 
-    def forward_per_list(self, score, target, length):
+    def per_list(self, score, target, length):
+        """
+        :return: Tensor of shape (B,) with the loss of each list. Subclasses can override this with a segment-wise
+        implementation; by default, the loss is computed for each list separately.
+        """
         # Split score and target into lists
         length_per_list = length.tolist()
         score_per_list = score.split(length_per_list)
         target_per_list = target.split(length_per_list)
 
-        # Compute loss per list, giving each list equal weight (regardless of length)
         loss_per_list = [
             self(score_of_list, target_of_list)
             for score_of_list, target_of_list in zip(score_per_list, target_per_list)
         ]
-        losses = torch.stack(loss_per_list)
+        return torch.stack(loss_per_list)
+
+    def forward_per_list(self, score, target, length):
+        # Compute loss per list, giving each list equal weight (regardless of length)
+        losses = self.per_list(score, target, length)
 
         # Remove losses that are zero (e.g. all item labels are zero)
         losses = losses[torch.abs(losses) > 0.]
@@ -32,22 +61,41 @@ class MSELoss(BaseRankLoss):
     def forward(self, score, target):
         return torch.nn.functional.mse_loss(score, target)
 
+    def per_list(self, score, target, length):
+        return segment_sum((score - target) ** 2, length) / length
+
 
 class OrdinalLoss(BaseRankLoss):
     # See A Neural Network Approach to Ordinal Regression
 
-    def forward(self, score, target):
+    @staticmethod
+    def encode_target(score, target):
         # Prepare a target column for each ordinal value
-        encoded_target = torch.zeros(score.shape).to(score.device)
-        for col in range(score.shape[1]):
-            encoded_target[:, col] = (target > col).int()
+        ordinal_values = torch.arange(score.shape[1], device=score.device)
+        return (target.unsqueeze(1) > ordinal_values).to(score.dtype)
 
-        loss = torch.nn.functional.binary_cross_entropy_with_logits(score, encoded_target)
+    def forward(self, score, target):
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(score, self.encode_target(score, target))
         return loss
 
+    def per_list(self, score, target, length):
+        loss = torch.nn.functional.binary_cross_entropy_with_logits(score, self.encode_target(score, target),
+                                                                    reduction='none')
+        return segment_sum(loss.mean(dim=1), length) / length
+
 
 class SoftmaxLoss(BaseRankLoss):
     def forward(self, score, target):
         softmax_score = torch.nn.functional.log_softmax(score, dim=-1)
         loss = -(softmax_score * target).mean()
         return loss
+
+    def per_list(self, score, target, length):
+        # log_softmax within each list: subtract the list's logsumexp, computed relative to the list maximum for
+        # numerical stability. The maximum is a constant shift, so it needs no gradient.
+        ids = segment_ids(length, score.shape[0])
+        list_max = segment_max(score.detach(), length)
+        shifted = score - list_max[ids]
+        log_norm = torch.log(segment_sum(torch.exp(shifted), length))
+        softmax_score = shifted - log_norm[ids]
+        return -segment_sum(softmax_score * target, length) / length
@@ -1,12 +1,13 @@
+import argparse
 import os
 import random
 import numpy as np
-import pandas as pd
 from sklearn.preprocessing import QuantileTransformer
 import torch
 from torch.utils.data import DataLoader
 from tqdm import tqdm
 
+from letor import NUM_FEATURES, letor_dataframe
 from ltr_dataset import LearningToRankDataset
 from metrics import NDCG, TopNDCG, Average
 from model import RankFormer, MLP
@@ -19,18 +20,21 @@ print(cuda)
 DEVICE = 'cuda:0' if cuda else 'cpu'
 NUM_WORKERS = 0
 CHECKPOINT_PATH = os.path.join(ROOT_DIR, 'model_checkpoint.pth')
+# Training metrics are only computed on every METRICS_EVERY-th batch
+METRICS_EVERY = 1
 
 
-def main():
+def main(data_dir=None, num_features=NUM_FEATURES, raw_features=False, simulate_labels=True):
     random.seed(SEED)
     np.random.seed(SEED)
     torch.manual_seed(SEED)
 
     print("Loading data...")
-    data_dir = os.path.join(ROOT_DIR, 'MSLR-WEB30K', f"Fold{SEED % 5 + 1}")
-    transform = QuantileTransformer(output_distribution='normal')
-    train_data = load_web30k_data(data_dir, transform, 'train')
-    test_data = load_web30k_data(data_dir, transform, 'test')
+    data_dir = data_dir or os.path.join(ROOT_DIR, 'MSLR-WEB30K', f"Fold{SEED % 5 + 1}")
+    # Without the transform, the model sees features as they are computed at serving time (e.g. by web/rerank.py)
+    transform = None if raw_features else QuantileTransformer(output_distribution='normal')
+    train_data = load_web30k_data(data_dir, transform, 'train', num_features, simulate_labels)
+    test_data = load_web30k_data(data_dir, transform, 'test', num_features, simulate_labels)
     train_loader = DataLoader(train_data, batch_size=2048, shuffle=True, collate_fn=LearningToRankDataset.collate_fn,
                               num_workers=NUM_WORKERS)
     test_loader = DataLoader(test_data, batch_size=2048, shuffle=False, collate_fn=LearningToRankDataset.collate_fn,
@@ -65,7 +69,7 @@ def main():
         }
         loop = tqdm(range(200))
         for _epoch in loop:
-            for batch in train_loader:
+            for step, batch in enumerate(train_loader):
                 optimizer.zero_grad()
                 feat, length, target = batch['feat'].to(DEVICE), batch['length'].to(DEVICE), batch['target'].to(DEVICE)
                 score = model(feat, length)
@@ -73,9 +77,10 @@ def main():
                 loss.backward()
                 optimizer.step()
 
-                if isinstance(score, tuple):
-                    score = score[0]
-                update_metrics(batch, score.detach(), loss, train_metrics)
+                if step % METRICS_EVERY == 0:
+                    if isinstance(score, tuple):
+                        score = score[0]
+                    update_metrics(batch, score.detach(), loss, train_metrics)
             scheduler.step()
 
             # Save checkpoint
@@ -109,14 +114,11 @@ def main():
     print({f"test_{key}": val for key, val in agg.items()})
 
 
-def load_web30k_data(data_dir, transform, stage):
+def load_web30k_data(data_dir, transform, stage, num_features=NUM_FEATURES, simulate_labels=True):
     path = os.path.join(data_dir, f"{stage}.txt")
     nrows = 1000 if DEBUG else None
-    df = pd.read_csv(path, sep=' ', header=None, nrows=nrows).dropna(axis=1)
-    df.loc[:, 1:] = df.loc[:, 1:].apply(lambda row: [el.split(':')[1] for el in row])
-    df.columns = ['target'] + ['qid'] + [f'feat_{i}' for i in range(1, 137)]
-    df = df.astype(float)
-    df[['target', 'qid']] = df[['target', 'qid']].astype(int)
+    # The first full load parses the file into a binary cache next to it (see letor.py), later loads map that cache
+    df = letor_dataframe(path, num_features=num_features, max_rows=nrows)
 
     user_model = {
         'seen_max': 16,
@@ -125,7 +127,8 @@ def load_web30k_data(data_dir, transform, stage):
         'purchase_intent_kappa': .1,
         'purchase_noise': 0.
     }
-    # user_model = None
+    if not simulate_labels:
+        user_model = None
     data = LearningToRankDataset(df, label_column='target', list_id_column='qid', transform=transform,
                                  user_model=user_model, seed=SEED)
     return data
@@ -148,4 +151,11 @@ def compute_metrics(metrics):
 
 
 if __name__ == '__main__':
-    main()
+    parser = argparse.ArgumentParser(description="Train and test a RankFormer on a LETOR dataset")
+    parser.add_argument('--data-dir', help="directory with train.txt and test.txt (default: MSLR-WEB30K fold)")
+    parser.add_argument('--num-features', type=int, default=NUM_FEATURES)
+    parser.add_argument('--raw-features', action='store_true', help="do not quantile-transform the features")
+    parser.add_argument('--explicit-labels', action='store_true',
+                        help="train on the labels in the files instead of simulated implicit labels")
+    args = parser.parse_args()
+    main(args.data_dir, args.num_features, raw_features=args.raw_features, simulate_labels=not args.explicit_labels)
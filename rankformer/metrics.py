@@ -1,7 +1,6 @@
 import torch
 
-import numpy as np
-from sklearn.metrics import ndcg_score
+from loss import segment_ids
 
 
 class Average:
@@ -29,35 +28,53 @@ class NDCG:
         self.total = 0.
 
     def update(self, score, target, length):
-        cum_length = np.cumsum(length.cpu().numpy())
-        score_per_list = np.split(score.cpu().numpy(), cum_length[:-1])
-        target_per_list = np.split(target.cpu().numpy(), cum_length[:-1])
-
-        for score_of_list, target_of_list in zip(score_per_list, target_per_list):
-            if self._should_count_list(target_of_list):
-                gain_of_list = self._compute_gain(target_of_list)
-                self.ndcg_sum += ndcg_score([gain_of_list], [score_of_list], k=self.k)
-                self.total += 1
+        """
+        Adds the NDCG@k of every list in the batch, computed at once on the device of score. Consistent with
+        sklearn's ndcg_score: list elements with tied scores share the average gain of their group.
+        """
+        target = target.to(score.device)
+        length = length.to(score.device)
+        mask = pad_lists(torch.ones_like(score, dtype=torch.bool), length, False)
+        # Padding is sorted behind all list elements and forms its own tie group
+        score = pad_lists(score.double(), length, -torch.inf)
+        target = pad_lists(target.double(), length, 0.)
+
+        gain = self._compute_gain(target).masked_fill(~mask, 0.)
+        positions = torch.arange(score.shape[1], device=score.device, dtype=torch.float64)
+        discount = torch.where(positions < self.k, 1. / torch.log2(positions + 2.), 0.)
+        dcg = tie_averaged_dcg(score, gain, mask, discount)
+        # The ideal ranking sorts by the gains themselves, so ties don't matter there
+        top_k = min(self.k, score.shape[1])
+        ideal_gain = gain.masked_fill(~mask, -torch.inf).topk(top_k, dim=1).values
+        idcg = (ideal_gain.masked_fill(ideal_gain == -torch.inf, 0.) * discount[:top_k]).sum(dim=1)
+        ndcg = torch.where(idcg > 0., dcg / idcg, 0.)
+
+        counted = self._should_count_list(target, mask)
+        self.ndcg_sum += ndcg[counted].sum()
+        self.total += counted.sum()
 
     def _compute_gain(self, target):
         if self.kind == "exponential":
-            return np.power(2, target) - 1
+            return torch.pow(2., target) - 1
         elif self.kind == "linear":
             return target
         else:
             raise ValueError(f"kind={self.kind} is not supported")
 
-    def _should_count_list(self, target):
+    def _should_count_list(self, target, mask):
+        """
+        :param target: Tensor of shape (B, max_len) with the padded target labels.
+        :param mask: Tensor of shape (B, max_len) that is False at padding positions.
+        :return: boolean Tensor of shape (B,) that marks the lists to count.
+        """
         # If the list is constant, don't count it.
-        if np.all(target == target[0]):
-            return False
-        return True
+        return list_max(target, mask) > -list_max(-target, mask)
 
     def compute(self):
         if self.total == 0:
             return torch.nan
 
-        agg = self.ndcg_sum / self.total
+        agg = float(self.ndcg_sum / self.total)
         self.ndcg_sum = 0.
         self.total = 0.
         return agg
@@ -68,7 +85,41 @@ class TopNDCG(NDCG):
         super().__init__(**kwargs)
         self.max_target = max_target
 
-    def _should_count_list(self, target):
-        if target.max() < self.max_target:
-            return False
-        return super()._should_count_list(target)
+    def _should_count_list(self, target, mask):
+        return (list_max(target, mask) >= self.max_target) & super()._should_count_list(target, mask)
+
+
+def pad_lists(values, length, padding_value):
+    """ Stacks the lists in values (of shape (N,)) as rows of a (B, max_len) Tensor filled with padding_value. """
+    ids = segment_ids(length, values.shape[0])
+    positions = torch.arange(values.shape[0], device=values.device) - (torch.cumsum(length, dim=0) - length)[ids]
+    padded = values.new_full((length.shape[0], int(length.max())), padding_value)
+    return padded.index_put((ids, positions), values)
+
+
+def list_max(values, mask):
+    return values.masked_fill(~mask, -torch.inf).max(dim=1).values
+
+
+def tie_averaged_dcg(score, gain, mask, discount):
+    """
+    DCG of each row when ranked by score, where each group of tied scores gets the average gain of the group at all
+    of its positions (as in sklearn's _tie_averaged_dcg).
+
+    :param score: Tensor of shape (B, max_len), with -inf at the padding positions.
+    :param gain: Tensor of shape (B, max_len), with 0 at the padding positions.
+    :param mask: Tensor of shape (B, max_len) that is False at padding positions.
+    :param discount: Tensor of shape (max_len,) with the discount of each rank (0 beyond k).
+    """
+    sorted_score, order = score.sort(dim=1, descending=True, stable=True)
+    valid = mask.gather(1, order).double()
+    # Number the groups of equal scores within each row
+    new_group = torch.ones_like(sorted_score, dtype=torch.long)
+    new_group[:, 1:] = (sorted_score[:, 1:] != sorted_score[:, :-1]).long()
+    group = new_group.cumsum(dim=1) - 1
+
+    zeros = torch.zeros_like(sorted_score)
+    group_gain = zeros.scatter_add(1, group, gain.gather(1, order))
+    group_size = zeros.scatter_add(1, group, valid)
+    group_discount = zeros.scatter_add(1, group, discount.expand_as(valid) * valid)
+    return (group_gain / group_size.clamp(min=1.) * group_discount).sum(dim=1)
@@ -1,7 +1,6 @@
 import torch
-from torch.nn.utils.rnn import pad_sequence
 
-from loss import OrdinalLoss, SoftmaxLoss
+from loss import OrdinalLoss, SoftmaxLoss, segment_ids, segment_max
 
 
 class RankFormer(torch.nn.Module):
@@ -73,28 +72,25 @@ class RankFormer(torch.nn.Module):
         listwide score for each list.
         """
 
-        # Split up the features per list
-        feat_per_list = feat.split(length.tolist())
-        if self.list_emb is not None:
-            # Add a generic list embedding as an element to each list
-            list_emb = self.list_emb.weight[0].unsqueeze(0)
-            feat_per_list = [torch.cat([list_emb, feat_of_list], dim=0) for feat_of_list in feat_per_list]
-            length = length + 1
-
         # Stack all lists as separate batch elements in a large tensor and add padding where needed
-        feat = pad_sequence(feat_per_list, batch_first=True, padding_value=0)
-        padding_mask = torch.ones((feat.shape[0], feat.shape[1]), dtype=torch.bool).to(feat.device)
-        for i, list_len in enumerate(length):
-            padding_mask[i, :list_len] = False
+        list_idx, elem_idx = pack_indices(length, feat.shape[0])
+        max_len = int(length.max())
+        padded_feat = feat.new_zeros((length.shape[0], max_len, feat.shape[1]))
+        padded_feat = padded_feat.index_put((list_idx, elem_idx), feat)
+        padding_mask = torch.arange(max_len, device=feat.device).unsqueeze(0) >= length.unsqueeze(1)
+        if self.list_emb is not None:
+            # Add a generic list embedding as the first element of each list
+            list_emb = self.list_emb.weight[:1].unsqueeze(0).expand(length.shape[0], -1, -1)
+            padded_feat = torch.cat([list_emb, padded_feat], dim=1)
+            padding_mask = torch.cat([padding_mask.new_zeros((length.shape[0], 1)), padding_mask], dim=1)
 
-        tf_embs = self.transformer(feat, src_key_padding_mask=padding_mask)
+        tf_embs = self.transformer(padded_feat, src_key_padding_mask=padding_mask)
 
         tf_list_emb = None
         if self.list_emb is not None:
             # Extract the list embeddings
             tf_list_emb = tf_embs[:, 0]
             tf_embs = tf_embs[:, 1:]
-            padding_mask = padding_mask[:, 1:]
 
             if self.list_pred_strength > 0.:
                 # Concatenate the list embeddings to the individual list element embeddings
@@ -102,7 +98,7 @@ class RankFormer(torch.nn.Module):
                 tf_embs = torch.cat([tf_embs, tf_list_emb_expanded], dim=-1)
 
         # Only keep the non-padded list elements and concatenate all embedded list features again
-        tf_embs = tf_embs[~padding_mask]
+        tf_embs = tf_embs[list_idx, elem_idx]
 
         rank_score = self.rank_score_net(tf_embs)
         if self.list_score_net is not None:
@@ -136,14 +132,28 @@ class RankFormer(torch.nn.Module):
         if list_score is None:
             raise ValueError('List scores are required when using the listwide loss')
 
-        target_per_list = target.split(length.tolist())
-        list_target = torch.stack([target_of_list.max() for target_of_list in target_per_list])
+        list_target = segment_max(target, length)
         list_loss = self.list_loss_fn(list_score, list_target)
 
         loss = rank_loss + self.list_pred_strength * list_loss
         return loss
 
 
+def pack_indices(length, total_length):
+    """
+    Computes where each list element ends up when the lists are stacked as rows of a padded tensor.
+
+    :param length: Tensor of shape (B,) with the length of each list.
+    :param total_length: the total number of list elements, i.e. length.sum(). Passing it avoids a host sync.
+    :return: a tuple of two Tensors of shape (total_length,) with the row (list) and column (position in the list) of
+    each list element.
+    """
+    list_idx = segment_ids(length, total_length)
+    list_start = torch.cumsum(length, dim=0) - length
+    elem_idx = torch.arange(total_length, device=length.device) - list_start[list_idx]
+    return list_idx, elem_idx
+
+
 class MLP(torch.nn.Module):
     def __init__(self, input_dim,
                  hidden_layers=None,
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+from loss import BaseRankLoss, MSELoss, OrdinalLoss, SoftmaxLoss
+
+# A singleton list, an all-zero list and a few regular lists
+LENGTH = [1, 4, 7, 1, 3]
+ZERO_LIST = 1
+MAX_TARGET = 4
+LOSSES = [SoftmaxLoss(), MSELoss(), OrdinalLoss()]
+
+
+def make_batch(loss_fn, seed=0):
+    generator = torch.Generator().manual_seed(seed)
+    length = torch.tensor(LENGTH)
+    target = torch.randint(0, MAX_TARGET + 1, (sum(LENGTH),), generator=generator)
+    start = sum(LENGTH[:ZERO_LIST])
+    target[start:start + LENGTH[ZERO_LIST]] = 0
+
+    if isinstance(loss_fn, OrdinalLoss):
+        score = torch.randn(sum(LENGTH), MAX_TARGET, generator=generator, dtype=torch.float64)
+    else:
+        score = torch.randn(sum(LENGTH), generator=generator, dtype=torch.float64)
+        target = target.to(torch.float64)
+    return score, target, length
+
+
+@pytest.mark.parametrize('loss_fn', LOSSES, ids=lambda loss_fn: type(loss_fn).__name__)
+def test_per_list_matches_split_loop(loss_fn):
+    score, target, length = make_batch(loss_fn)
+
+    segment_score = score.clone().requires_grad_()
+    segment_losses = loss_fn.per_list(segment_score, target, length)
+    loop_score = score.clone().requires_grad_()
+    loop_losses = BaseRankLoss.per_list(loss_fn, loop_score, target, length)
+    torch.testing.assert_close(segment_losses, loop_losses)
+
+    # Weighting the lists differently checks the gradient of every list loss, not only of their sum
+    weights = torch.arange(1, len(LENGTH) + 1, dtype=torch.float64)
+    (segment_losses * weights).sum().backward()
+    (loop_losses * weights).sum().backward()
+    torch.testing.assert_close(segment_score.grad, loop_score.grad)
+
+
+@pytest.mark.parametrize('loss_fn', LOSSES, ids=lambda loss_fn: type(loss_fn).__name__)
+def test_forward_per_list_gradient(loss_fn):
+    score, target, length = make_batch(loss_fn, seed=1)
+
+    segment_score = score.clone().requires_grad_()
+    loss_fn.forward_per_list(segment_score, target, length).backward()
+
+    # Reference: the split-and-loop implementation that forward_per_list used before the segment-wise losses
+    loop_score = score.clone().requires_grad_()
+    losses = BaseRankLoss.per_list(loss_fn, loop_score, target, length)
+    losses[torch.abs(losses) > 0.].mean().backward()
+
+    torch.testing.assert_close(segment_score.grad, loop_score.grad)
@@ -0,0 +1,69 @@
+import numpy as np
+import pytest
+import torch
+from sklearn.metrics import ndcg_score
+
+from metrics import NDCG, TopNDCG
+
+MAX_TARGET = 4
+METRICS = [
+    lambda kind, k: NDCG(kind=kind, k=k),
+    lambda kind, k: TopNDCG(max_target=MAX_TARGET, kind=kind, k=k),
+]
+
+
+def make_batch(seed, num_lists=40):
+    """ Random lists with few distinct scores (so that ties are common), plus constant and singleton lists """
+    rng = np.random.default_rng(seed)
+    length = rng.integers(1, 25, size=num_lists)
+    length[:3] = 1
+    target = rng.integers(0, MAX_TARGET + 1, size=length.sum())
+    score = rng.integers(0, 4, size=length.sum()).astype(np.float32)
+    starts = np.cumsum(length) - length
+    for i in (3, 4):
+        target[starts[i]:starts[i] + length[i]] = i - 2
+    return torch.from_numpy(score), torch.from_numpy(target), torch.from_numpy(length)
+
+
+def reference_ndcg(score, target, length, kind, k, max_target=None):
+    """ sklearn's ndcg_score for every list that the metric counts, in order """
+    values = []
+    for list_score, list_target in zip(score.split(length.tolist()), target.split(length.tolist())):
+        list_target = list_target.double().numpy()
+        # Constant lists (which include singletons) are not counted, nor are lists without a top target for TopNDCG
+        if list_target.min() == list_target.max() or (max_target is not None and list_target.max() < max_target):
+            continue
+        gain = 2. ** list_target - 1 if kind == 'exponential' else list_target
+        values.append(ndcg_score(gain[None], list_score.double().numpy()[None], k=k, ignore_ties=False))
+    return values
+
+
+@pytest.mark.parametrize('make_metric', METRICS, ids=['NDCG', 'TopNDCG'])
+@pytest.mark.parametrize('kind', ['exponential', 'linear'])
+@pytest.mark.parametrize('k', [1, 5, 10])
+def test_ndcg_matches_sklearn(make_metric, kind, k):
+    metric = make_metric(kind, k)
+    max_target = getattr(metric, 'max_target', None)
+    expected = []
+    for seed in range(3):
+        score, target, length = make_batch(seed)
+        metric.update(score, target, length)
+        expected += reference_ndcg(score, target, length, kind, k, max_target)
+
+    assert metric.compute() == pytest.approx(np.mean(expected), abs=1e-9)
+
+
+@pytest.mark.parametrize('make_metric', METRICS, ids=['NDCG', 'TopNDCG'])
+def test_ndcg_per_list(make_metric):
+    score, target, length = make_batch(seed=3)
+    starts = (torch.cumsum(length, dim=0) - length).tolist()
+    for start, list_length in zip(starts, length.tolist()):
+        metric = make_metric('exponential', 10)
+        list_score, list_target = score[start:start + list_length], target[start:start + list_length]
+        metric.update(list_score, list_target, torch.tensor([list_length]))
+        expected = reference_ndcg(list_score, list_target, torch.tensor([list_length]), 'exponential', 10,
+                                  getattr(metric, 'max_target', None))
+        if expected:
+            assert metric.compute() == pytest.approx(expected[0], abs=1e-9)
+        else:
+            assert np.isnan(metric.compute())
@@ -0,0 +1,59 @@
+import pytest
+import torch
+from torch.nn.utils.rnn import pad_sequence
+
+from model import RankFormer
+
+INPUT_DIM = 8
+MAX_TARGET = 4
+LENGTH = [3, 1, 7, 2, 5]
+
+
+def reference_forward(model, feat, length):
+    """ The split / pad_sequence / mask-loop packing that RankFormer.forward used before pack_indices """
+    feat_per_list = feat.split(length.tolist())
+    if model.list_emb is not None:
+        list_emb = model.list_emb.weight[0].unsqueeze(0)
+        feat_per_list = [torch.cat([list_emb, feat_of_list], dim=0) for feat_of_list in feat_per_list]
+        length = length + 1
+
+    feat = pad_sequence(feat_per_list, batch_first=True, padding_value=0)
+    padding_mask = torch.ones((feat.shape[0], feat.shape[1]), dtype=torch.bool)
+    for i, list_len in enumerate(length):
+        padding_mask[i, :list_len] = False
+
+    tf_embs = model.transformer(feat, src_key_padding_mask=padding_mask)
+
+    tf_list_emb = None
+    if model.list_emb is not None:
+        tf_list_emb = tf_embs[:, 0]
+        tf_embs = tf_embs[:, 1:]
+        padding_mask = padding_mask[:, 1:]
+        if model.list_pred_strength > 0.:
+            tf_embs = torch.cat([tf_embs, tf_list_emb.unsqueeze(1).expand(-1, tf_embs.shape[1], -1)], dim=-1)
+
+    rank_score = model.rank_score_net(tf_embs[~padding_mask])
+    if model.list_score_net is not None:
+        return rank_score, model.list_score_net(tf_list_emb)
+    return rank_score
+
+
+@pytest.mark.parametrize('list_pred_strength', [0., 1.], ids=['without_list_emb', 'with_list_emb'])
+def test_forward_matches_reference_packing(list_pred_strength):
+    torch.manual_seed(0)
+    model = RankFormer(INPUT_DIM, max_target=MAX_TARGET, tf_dim_feedforward=16, tf_nhead=2,
+                       list_pred_strength=list_pred_strength).eval()
+    feat = torch.randn(sum(LENGTH), INPUT_DIM)
+    length = torch.tensor(LENGTH)
+
+    with torch.no_grad():
+        output = model(feat, length)
+        expected = reference_forward(model, feat, length)
+
+    if list_pred_strength > 0.:
+        assert model.list_emb is not None
+        torch.testing.assert_close(output[0], expected[0])
+        torch.testing.assert_close(output[1], expected[1])
+    else:
+        assert model.list_emb is None
+        torch.testing.assert_close(output, expected)
@@ -0,0 +1,357 @@
+# Локальный ANN-индекс (faiss) с гибридным поиском, отдающий ответ в формате Elasticsearch.
+# Построение индекса по уже заполненному индексу Elasticsearch:
+#     python -m web.ann --model mpnet --out ann_index/mpnet
+# С --kind int8 или --kind binary в памяти сервиса держатся только сжатые векторы
+import argparse
+import json
+import math
+import os
+import shutil
+import time
+from collections import defaultdict
+
+import faiss
+import numpy as np
+import requests
+
+from encoding.quantized import MODES as QUANTIZED_KINDS, QuantizedIndex
+from web.hybrid import MAX_TEXT_SCORE, TEXT_WEIGHT, VECTOR_WEIGHT, tokenize
+from web.product_store import ProductStore
+
+# Поля и веса полнотекстового поиска -- как в generate_all_multi_match_queries
+TEXT_FIELDS = {'name': 2., 'categories': 3., 'params_str': 1., 'n_grams': 1.}
+
+
+class Bm25Index:
+    """ Инвертированный индекс по нескольким полям с оценкой BM25, аналог multi_match most_fields """
+
+    def __init__(self, fields=None, k1=1.2, b=0.75):
+        self.fields = TEXT_FIELDS if fields is None else fields
+        self.k1 = k1
+        self.b = b
+        self.size = 0
+        self._postings = {field: defaultdict(list) for field in self.fields}
+        self._lengths = {field: [] for field in self.fields}
+
+    def add(self, sources):
+        for source in sources:
+            for field in self.fields:
+                tokens = tokenize(source.get(field))
+                self._lengths[field].append(len(tokens))
+                counts = defaultdict(int)
+                for token in tokens:
+                    counts[token] += 1
+                for token, tf in counts.items():
+                    self._postings[field][token].append((self.size, tf))
+            self.size += 1
+
+    def search(self, query, k):
+        """ Возвращает top-k (оценки, номера документов), у которых совпало хотя бы одно слово """
+        scores = np.zeros(self.size, dtype=np.float32)
+        terms = set(tokenize(query))
+        for field, boost in self.fields.items():
+            lengths = np.asarray(self._lengths[field], dtype=np.float32)
+            avg_length = lengths.mean() if self.size and lengths.mean() > 0 else 1.
+            for term in terms:
+                postings = self._postings[field].get(term)
+                if not postings:
+                    continue
+                docs, tf = np.asarray(postings).T
+                idf = math.log(1 + (self.size - len(docs) + 0.5) / (len(docs) + 0.5))
+                norm = self.k1 * (1 - self.b + self.b * lengths[docs] / avg_length)
+                scores[docs] += boost * idf * tf * (self.k1 + 1) / (tf + norm)
+
+        matched = np.flatnonzero(scores)
+        if len(matched) > k:
+            matched = matched[np.argpartition(-scores[matched], k - 1)[:k]]
+        return scores[matched], matched
+
+
+class AnnIndex:
+    """
+    Векторный индекс faiss (HNSW, IVF или сжатые int8/бинарные векторы) и документы для гибридного поиска
+    без обращения к Elasticsearch
+    """
+
+    def __init__(self, dim, kind='hnsw', hnsw_m=32, ef_construction=200, ef_search=128, nlist=1024, nprobe=16,
+                 rescore_factor=4, index=None):
+        """
+        :param dim: размерность эмбеддингов.
+        :param kind: 'hnsw', 'ivf', 'int8' или 'binary'. В режимах int8 и binary в памяти лежат только сжатые
+            векторы (encoding.quantized.QuantizedIndex), а лучшие кандидаты пересчитываются по исходным,
+            которые после загрузки читаются с диска через np.memmap.
+        :param hnsw_m: число связей вершины графа HNSW.
+        :param ef_construction: ширина поиска при построении HNSW.
+        :param ef_search: ширина поиска при запросе к HNSW.
+        :param nlist: число кластеров IVF. Индекс обучается на первой добавленной порции векторов.
+        :param nprobe: сколько кластеров IVF просматривается при запросе.
+        :param rescore_factor: во сколько раз больше кандидатов, чем нужно, пересчитывается в режимах int8 и binary.
+        :param index: готовый индекс faiss или QuantizedIndex (используется при загрузке с диска).
+        """
+        self.dim = dim
+        self.kind = kind
+        self.nprobe = nprobe
+        self.ef_search = ef_search
+        self.rescore_factor = rescore_factor
+        if index is None:
+            if kind == 'hnsw':
+                index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+                index.hnsw.efConstruction = ef_construction
+            elif kind == 'ivf':
+                index = faiss.IndexIVFFlat(faiss.IndexFlatIP(dim), dim, nlist, faiss.METRIC_INNER_PRODUCT)
+                # Прямое отображение нужно, чтобы восстанавливать векторы кандидатов, найденных по тексту
+                index.make_direct_map()
+            elif kind in QUANTIZED_KINDS:
+                index = QuantizedIndex(np.empty((0, dim), dtype=np.float32), mode=kind, rescore_factor=rescore_factor)
+            else:
+                raise ValueError(f"kind={kind} is not supported")
+            if kind not in QUANTIZED_KINDS:
+                index = faiss.IndexIDMap2(index)
+        self.index = index
+        self._set_search_params()
+
+        self.doc_ids = []
+        self.sources = []
+        # После загрузки с диска документы читаются из хранилища по номерам строк, а не держатся в памяти;
+        # в sources тогда только документы, добавленные после загрузки (строки начиная с len(products))
+        self.products = None
+        self.text_index = Bm25Index()
+
+    def _set_search_params(self):
+        if self.kind in QUANTIZED_KINDS:
+            return
+        base = faiss.downcast_index(self.index.index)
+        if isinstance(base, faiss.IndexHNSW):
+            base.hnsw.efSearch = self.ef_search
+        elif isinstance(base, faiss.IndexIVF):
+            base.nprobe = self.nprobe
+
+    def __len__(self):
+        return len(self.doc_ids)
+
+    def add(self, doc_ids, embeddings, sources):
+        """ Добавляет документы в индекс; векторы нормализуются, чтобы скалярное произведение было косинусом """
+        embeddings = np.ascontiguousarray(embeddings, dtype=np.float32)
+        faiss.normalize_L2(embeddings)
+        if not self.index.is_trained:
+            self.index.train(embeddings)
+        if self.kind in QUANTIZED_KINDS:
+            # Строки сжатого индекса нумеруются по порядку добавления. После загрузки исходные векторы --
+            # np.memmap, и добавление переносит их в память
+            self.index.vectors = np.concatenate([self.index.vectors, embeddings])
+            self.index.add_codes(embeddings)
+        else:
+            rows = np.arange(len(self.doc_ids), len(self.doc_ids) + len(doc_ids), dtype=np.int64)
+            self.index.add_with_ids(embeddings, rows)
+        self.doc_ids.extend(doc_ids)
+        self.sources.extend(sources)
+        self.text_index.add(sources)
+
+    def vector_search(self, query_vector, k):
+        query = np.asarray([query_vector], dtype=np.float32)
+        faiss.normalize_L2(query)
+        if self.kind in QUANTIZED_KINDS:
+            return self.index.search(query[0], k)
+        scores, rows = self.index.search(query, k)
+        found = rows[0] >= 0
+        return scores[0][found], rows[0][found]
+
+    def reconstruct(self, rows):
+        """ Нормализованные векторы строк rows """
+        if self.kind in QUANTIZED_KINDS:
+            return np.asarray(self.index.vectors[rows], dtype=np.float32)
+        return self.index.reconstruct_batch(rows)
+
+    def get_sources(self, rows, fields=None):
+        """ Документы строк rows; fields -- какие поля вернуть, по умолчанию все """
+        rows = list(rows)
+        stored = len(self.products) if self.products is not None else 0
+        docs = iter(self.products.get_rows([row for row in rows if row < stored], fields) if stored else [])
+        return [next(docs) if row < stored else self._source(row - stored, fields) for row in rows]
+
+    def _source(self, i, fields):
+        source = self.sources[i]
+        if not fields:
+            return source
+        return {field: source[field] for field in fields if field in source}
+
+    def search(self, query, query_vector, size=10, num_candidates=100, index_name='', fields=None):
+        """
+        Гибридный поиск: кандидаты из ANN и BM25 объединяются и ранжируются той же формулой, что и
+        script_score в build_search_payload. Возвращает ответ в формате _search Elasticsearch,
+        _source содержит только поля fields (по умолчанию все).
+        """
+        started = time.perf_counter()
+        vector_scores, vector_rows = self.vector_search(query_vector, num_candidates)
+        text_scores, text_rows = self.text_index.search(query, num_candidates)
+
+        candidates = np.union1d(vector_rows, text_rows).astype(np.int64)
+        cosine = dict(zip(vector_rows.tolist(), vector_scores.tolist()))
+        missing = [row for row in candidates.tolist() if row not in cosine]
+        if missing:
+            # Для кандидатов, найденных только по тексту, косинус считается по сохранённым векторам
+            query = np.asarray(query_vector, dtype=np.float32)
+            vectors = self.reconstruct(np.asarray(missing, dtype=np.int64))
+            cosine.update(zip(missing, (vectors @ query / (np.linalg.norm(query) or 1.)).tolist()))
+        bm25 = dict(zip(text_rows.tolist(), text_scores.tolist()))
+
+        hits = []
+        for row in candidates.tolist():
+            vector_score = (cosine[row] + 1.) / 2.
+            text_score = min(bm25.get(row, 0.), MAX_TEXT_SCORE) / MAX_TEXT_SCORE
+            hits.append((VECTOR_WEIGHT * vector_score + TEXT_WEIGHT * text_score, row))
+        hits.sort(reverse=True)
+        hits = hits[:size]
+        sources = self.get_sources([row for _, row in hits], fields)
+
+        return {
+            'took': int((time.perf_counter() - started) * 1000),
+            'timed_out': False,
+            'hits': {
+                'total': {'value': len(candidates), 'relation': 'eq'},
+                'max_score': hits[0][0] if hits else None,
+                'hits': [
+                    {'_index': index_name, '_id': self.doc_ids[row], '_score': score, '_source': source}
+                    for (score, row), source in zip(hits, sources)
+                ]
+            }
+        }
+
+    def save(self, path):
+        """
+        Записывает индекс в новый каталог поколения path/data.N и затем атомарно переключает на него meta.json.
+        Файлы текущего поколения (векторы, хранилище товаров) отображены в память этим и другими процессами,
+        поэтому не перезаписываются: после сбоя или при одновременном чтении виден либо старый, либо новый индекс.
+        """
+        os.makedirs(path, exist_ok=True)
+        meta_path = os.path.join(path, 'meta.json')
+        previous = None
+        if os.path.exists(meta_path):
+            with open(meta_path) as f:
+                previous = json.load(f).get('generation', -1)
+        generation = 0 if previous is None else previous + 1
+        data_path = os.path.join(path, f'data.{generation}')
+        # Остаток прерванного сохранения
+        shutil.rmtree(data_path, ignore_errors=True)
+        os.makedirs(data_path)
+
+        if self.kind in QUANTIZED_KINDS:
+            self.index.write(data_path)
+            np.asarray(self.index.vectors, dtype=np.float32).tofile(os.path.join(data_path, 'vectors.f32'))
+        else:
+            faiss.write_index(self.index, os.path.join(data_path, 'index.faiss'))
+        sources = self.get_sources(range(len(self)))
+        products = ProductStore.build(os.path.join(data_path, 'products'), zip(self.doc_ids, sources),
+                                      fields=sorted({field for source in sources for field in source}))
+        fsync_tree(data_path)
+
+        with open(meta_path + '.tmp', 'w') as f:
+            json.dump({'dim': self.dim, 'kind': self.kind, 'ef_search': self.ef_search, 'nprobe': self.nprobe,
+                       'rescore_factor': self.rescore_factor, 'generation': generation}, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(meta_path + '.tmp', meta_path)
+        if self.products is not None:
+            # Все документы теперь в новом хранилище, в том числе добавленные после загрузки
+            self.products = products
+            self.sources = []
+
+        # Предыдущее поколение остаётся для процессов, которые как раз его загружают; более старые удаляются.
+        # Уже отображённые в память файлы удалённых поколений остаются доступны загрузившим их процессам
+        keep = {f'data.{generation}', f'data.{previous}'}
+        for name in os.listdir(path):
+            if name.startswith('data.') and name not in keep:
+                shutil.rmtree(os.path.join(path, name), ignore_errors=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(os.path.join(path, 'meta.json')) as f:
+            meta = json.load(f)
+        # Индексы, сохранённые до появления поколений, лежат прямо в path
+        if 'generation' in meta:
+            path = os.path.join(path, f"data.{meta['generation']}")
+        rescore_factor = meta.get('rescore_factor', 4)
+        if meta['kind'] in QUANTIZED_KINDS:
+            vectors_path = os.path.join(path, 'vectors.f32')
+            size = os.path.getsize(vectors_path) // (4 * meta['dim'])
+            vectors = (np.memmap(vectors_path, dtype=np.float32, mode='r', shape=(size, meta['dim'])) if size
+                       else np.empty((0, meta['dim']), dtype=np.float32))
+            index = QuantizedIndex.read(path, vectors, meta['kind'], rescore_factor)
+        else:
+            index = faiss.read_index(os.path.join(path, 'index.faiss'))
+        ann = cls(meta['dim'], kind=meta['kind'], ef_search=meta['ef_search'], nprobe=meta['nprobe'],
+                  rescore_factor=rescore_factor, index=index)
+        products_path = os.path.join(path, 'products')
+        if os.path.exists(products_path):
+            ann.products = ProductStore(products_path)
+            # Копия: add() дополняет doc_ids, а список id хранилища должен соответствовать его файлам
+            ann.doc_ids = list(ann.products.ids)
+            # Для BM25 нужны только текстовые поля; документы читаются порциями
+            for start in range(0, len(ann.doc_ids), 65536):
+                rows = range(start, min(start + 65536, len(ann.doc_ids)))
+                ann.text_index.add(ann.products.get_rows(rows, list(TEXT_FIELDS)))
+            return ann
+
+        # Индексы, сохранённые до появления хранилища товаров
+        with open(os.path.join(path, 'docs.jsonl'), encoding='utf-8') as f:
+            docs = [json.loads(line) for line in f]
+        ann.doc_ids = [doc['_id'] for doc in docs]
+        ann.sources = [doc['_source'] for doc in docs]
+        ann.text_index.add(ann.sources)
+        return ann
+
+
+def fsync_tree(path):
+    """ Сбрасывает на диск все файлы каталога path """
+    for root, _, names in os.walk(path):
+        for name in names:
+            with open(os.path.join(root, name), 'rb') as f:
+                os.fsync(f.fileno())
+
+
+def scroll_index(es_url, index_name, batch_size=1000):
+    """ Выгружает все документы индекса Elasticsearch порциями через scroll API """
+    session = requests.Session()
+    response = session.post(f"{es_url}/{index_name}/_search", params={'scroll': '5m'},
+                            json={'size': batch_size, 'sort': ['_doc']})
+    response.raise_for_status()
+    body = response.json()
+    while body['hits']['hits']:
+        yield body['hits']['hits']
+        response = session.post(f"{es_url}/_search/scroll", json={'scroll': '5m', 'scroll_id': body['_scroll_id']})
+        response.raise_for_status()
+        body = response.json()
+    session.delete(f"{es_url}/_search/scroll", json={'scroll_id': body['_scroll_id']})
+
+
+def build_from_elasticsearch(es_url, model_name, kind='hnsw', batch_size=1000):
+    """ Строит AnnIndex по документам индекса products_{model_name} """
+    doc_ids, embeddings, sources = [], [], []
+    for hits in scroll_index(es_url, f"products_{model_name}", batch_size):
+        for hit in hits:
+            doc_ids.append(hit['_id'])
+            embeddings.append(hit['_source'].pop('embedding'))
+            sources.append(hit['_source'])
+    if not doc_ids:
+        return None
+
+    # IVF обучается на первой добавленной порции, поэтому все векторы добавляются разом
+    embeddings = np.asarray(embeddings, dtype=np.float32)
+    ann = AnnIndex(embeddings.shape[1], kind=kind, nlist=min(1024, max(1, len(doc_ids) // 40)))
+    ann.add(doc_ids, embeddings, sources)
+    return ann
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Построение локального ANN-индекса по индексу Elasticsearch")
+    parser.add_argument('--model', required=True, help="имя модели, индекс products_{model}")
+    parser.add_argument('--out', required=True, help="каталог для файлов индекса")
+    parser.add_argument('--kind', default='hnsw', choices=['hnsw', 'ivf', *QUANTIZED_KINDS])
+    parser.add_argument('--es-url', default='http://localhost:9200')
+    args = parser.parse_args()
+
+    ann = build_from_elasticsearch(args.es_url, args.model, kind=args.kind)
+    if ann is None:
+        raise ValueError(f"Индекс products_{args.model} пуст")
+    ann.save(args.out)
+    print(f"Сохранено {len(ann)} документов в {args.out}")
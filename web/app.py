@@ -1,136 +1,117 @@
 import json
+import time
+
 import flask
 import requests
-from flask import Flask, jsonify, request
-from sentence_transformers import SentenceTransformer
-import torch
+from flask import Flask, g, jsonify, request
+
+from web.batch_search import batch_search
+from web.metrics import CONTENT_TYPE, observe_es_took, render_metrics, request_seconds, stage_seconds
+from web.projection import gzip_body
+from web.search import (DEFAULT_MODEL, FUSION, FUSIONS, MODELS, RESULT_SIZE, SEARCH_MODE, SEARCH_MODES, SearchError,
+                        SearchRequest, batcher_stats, encode_query, encode_query_many, query_cache, reranker)
 
 app = Flask(__name__)
 
-# Список моделей для эмбеддингов
-MODELS = {
-    'mpnet': 'sentence-transformers/all-mpnet-base-v2',
-    'minilm': 'sentence-transformers/all-MiniLM-L6-v2',
-    'qa-mpnet': 'sentence-transformers/multi-qa-mpnet-base-dot-v1',
-    'multilingual': 'sentence-transformers/paraphrase-multilingual-mpnet-base-v2'
-}
-
-# Загрузка моделей
-models = {}
-for model_name, model_path in MODELS.items():
-    print(f"Загрузка модели {model_name}...")
-    models[model_name] = SentenceTransformer(model_path)
-    if torch.cuda.is_available():
-        models[model_name] = models[model_name].to('cuda')
-
-def generate_query_vector_search(vector, size, min_score):
-    return {
-        "knn": {
-            "field": "embedding",
-            "query_vector": vector,
-            "k": size,
-            "num_candidates": 100
-        },
-        "size": size,
-        "min_score": min_score
-    }
-
-def generate_all_multi_match_queries(word):
-    search_type = "most_fields"
-    fields = [
-        "name^2",
-        "categories^3",
-        "params_str",
-        "n_grams"
-    ]
-    return {
-        "multi_match": {
-            "query": word,
-            "fields": fields,
-            "type": search_type,
-            "operator": "or",
-        }
-    }
-
-#def generate_query_vector_search(vector, size, min_score):
-#    return {
-#        "query": {
-#            "script_score": {
-#                "query": {
-#                    "match_all": {}
-#                },
-#                "script": {
-#                    "source": "cosineSimilarity(params.vector, 'vector') + 1",
-#                    "lang": "painless",
-#                    "params": {
-#                        "vector": vector
-#                    }
-#                }
-#            }
-#        },
-#        "size": size,
-#        "min_score": min_score
-#    }
-#
-
-def encode_text(text, model_name):
-    """ Кодирует текст в эмбеддинг с использованием указанной модели """
-    model = models[model_name]
-    embeddings = model.encode(text)
-    return embeddings.squeeze().tolist()
+# Одна сессия на процесс, чтобы соединения с Elasticsearch переиспользовались
+session = requests.Session()
+
+
+@app.before_request
+def start_timer():
+    g.started = time.perf_counter()
+
+@app.after_request
+def observe_request(response):
+    # Время учитывается только для запросов /search, прошедших проверку параметров
+    if 'model_label' in g:
+        request_seconds.observe(time.perf_counter() - g.started, model=g.model_label)
+    return response
 
 
 @app.route('/search', methods=['POST'])
 def search():
+    try:
+        params = SearchRequest(request.json)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    g.model_label = params.model_label
+    with stage_seconds.time(stage='encode', model=g.model_label):
+        if params.fanout:
+            query_vectors = encode_query_many(params.query, params.model_names)
+        else:
+            query_vectors = {params.model_name: encode_query(params.query, params.model_name)}
+    if params.local:
+        with stage_seconds.time(stage='ann_search', model=g.model_label):
+            result = params.ann_search(query_vectors)
+        return finish(params, result)
+
+    url, body, content_type, filter_path = params.es_request(query_vectors)
+    with stage_seconds.time(stage='es_request', model=g.model_label):
+        response = session.post(url, headers={'Content-Type': content_type}, data=body,
+                                params={'filter_path': filter_path})
+    if response.status_code != 200:
+        return jsonify({'error': 'Failed to fetch results'}), response.status_code
+    if params.passthrough:
+        observe_es_took(response.content, g.model_label)
+        # Полный ответ передаётся как есть, без повторного разбора JSON
+        return json_response(response.content)
+    try:
+        result = params.es_result(response.json())
+    except SearchError as e:
+        return jsonify({'error': 'Failed to fetch results'}), e.status
+    observe_es_took(result, g.model_label)
+    return finish(params, result)
+
+@app.route('/search/batch', methods=['POST'])
+def search_batch():
+    """ Пакетный поиск: результаты отдаются потоком NDJSON по мере готовности, в порядке запросов """
     data = request.json
-    query = data.get('query', '')
-    model_name = data.get('model', 'mpnet')  # По умолчанию используем mpnet
-    
+    queries = data.get('queries', [])
+    model_name = data.get('model', DEFAULT_MODEL)
+    mode = data.get('mode', SEARCH_MODE)
+    fusion = data.get('fusion', FUSION)
+
     if model_name not in MODELS:
         return jsonify({'error': f'Model {model_name} not found'}), 400
-        
-    url = f"http://localhost:9200/products_{model_name}/_search"
-    headers = {'Content-Type': 'application/json'}
-
-    # Создаем комбинированный запрос с взвешенной суммой оценок
-    payload = {
-        "query": {
-            "script_score": {
-                "query": generate_all_multi_match_queries(query),
-                "script": {
-                    "source": """
-                    // Нормализация векторного поиска (косинусное сходство в диапазоне [-1, 1])
-                    double vectorScore = (cosineSimilarity(params.query_vector, 'embedding') + 1.0) / 2.0;
-                    
-                    // Нормализация полнотекстового поиска
-                    // Используем min-max нормализацию для _score
-                    double textScore = _score;
-                    if (textScore > params.max_score) {
-                        textScore = params.max_score;
-                    }
-                    textScore = textScore / params.max_score;
-                    
-                    // Взвешенная сумма нормализованных оценок
-                    return params.vector_weight * vectorScore + params.text_weight * textScore;
-                    """,
-                    "params": {
-                        "query_vector": encode_text(query, model_name),
-                        "vector_weight": 0.7,  # Вес для векторного поиска
-                        "text_weight": 0.3,    # Вес для полнотекстового поиска
-                        "max_score": 10.0      # Максимальная ожидаемая оценка для полнотекстового поиска
-                    }
-                }
-            }
-        },
-        "size": 10
-    }
-    
-    response = requests.post(url, headers=headers, json=payload)
+    if mode not in SEARCH_MODES or fusion not in FUSIONS:
+        return jsonify({'error': f'Mode {mode} with fusion {fusion} not supported'}), 400
 
-    if response.status_code != 200:
-        return jsonify({'error': 'Failed to fetch results'}), response.status_code
+    results = batch_search(queries, model_name, mode=mode, fusion=fusion, session=session)
+    lines = (json.dumps(result, ensure_ascii=False) + '\n' for result in results)
+    return flask.Response(flask.stream_with_context(lines), mimetype='application/x-ndjson')
+
+def finish(params, result):
+    """ Переранжирует результат, если нужно, и отдаёт его клиенту """
+    if params.rerank:
+        with stage_seconds.time(stage='rerank', model=g.model_label):
+            result = reranker.rerank(result, params.query, RESULT_SIZE)
+    return json_response(params.output(result))
+
+def json_response(result):
+    """ JSON-ответ, сжатый gzip, если он большой и клиент это поддерживает """
+    with stage_seconds.time(stage='serialize', model=g.model_label):
+        body = result if isinstance(result, bytes) else json.dumps(result, ensure_ascii=False).encode('utf-8')
+        body, compressed = gzip_body(body, request.headers.get('Accept-Encoding'))
+    response = flask.Response(body, mimetype='application/json')
+    response.headers['Vary'] = 'Accept-Encoding'
+    if compressed:
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
+
+@app.get("/cache")
+def cache_stats():
+    return jsonify(query_cache.stats())
+
+@app.get("/batcher")
+def get_batcher_stats():
+    return jsonify(batcher_stats())
 
-    return jsonify(response.json())
+@app.get("/metrics")
+def metrics():
+    return flask.Response(render_metrics(query_cache.stats(), batcher_stats(), reranker and reranker.stats()),
+                          content_type=CONTENT_TYPE)
 
 @app.get("/")
 def get():
@@ -0,0 +1,144 @@
+# Асинхронный режим сервиса поиска с тем же контрактом /search, что и web/app.py.
+# Запуск из корня репозитория: python -m web.async_app
+import asyncio
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import aiohttp
+from aiohttp import web
+
+from web.metrics import CONTENT_TYPE, observe_es_took, render_metrics, request_seconds, stage_seconds
+from web.projection import GZIP_MIN_BYTES
+from web.query_cache import normalize_query
+from web.search import (ENCODE_BATCH_WINDOW_MS, RESULT_SIZE, SearchError, SearchRequest, batcher_stats, encode_query,
+                        get_batcher, query_cache, reranker)
+
+# Пул keep-alive соединений с Elasticsearch
+ES_POOL_SIZE = int(os.environ.get('ES_POOL_SIZE', 100))
+ES_KEEPALIVE = float(os.environ.get('ES_KEEPALIVE', 30))
+ES_CONNECT_TIMEOUT = float(os.environ.get('ES_CONNECT_TIMEOUT', 1))
+ES_TIMEOUT = float(os.environ.get('ES_TIMEOUT', 10))
+# Кодирование запросов занимает CPU, поэтому выполняется в ограниченном пуле потоков, а не в цикле событий
+ENCODE_WORKERS = int(os.environ.get('ENCODE_WORKERS', os.cpu_count() or 1))
+
+
+async def encode_query_async(app, query, model_name):
+    if ENCODE_BATCH_WINDOW_MS <= 0:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(app['encode_executor'], encode_query, query, model_name)
+
+    # С микробатчингом ожидание эмбеддинга не занимает поток пула: кодирует поток батчера
+    query = normalize_query(query)
+    query_vector = query_cache.get((model_name, query))
+    if query_vector is None:
+        query_vector = await asyncio.wrap_future(get_batcher(model_name).submit(query))
+        query_cache.put((model_name, query), query_vector)
+    return query_vector
+
+
+async def search(request):
+    try:
+        params = SearchRequest(await request.json())
+    except ValueError as e:
+        return web.json_response({'error': str(e)}, status=400)
+
+    label = request['model_label'] = params.model_label
+    with stage_seconds.time(stage='encode', model=label):
+        vectors = await asyncio.gather(*[encode_query_async(request.app, params.query, name)
+                                         for name in params.model_names])
+    query_vectors = dict(zip(params.model_names, vectors))
+    if params.local:
+        # Поиск в локальном индексе занимает CPU, поэтому тоже выполняется в пуле потоков
+        loop = asyncio.get_running_loop()
+        with stage_seconds.time(stage='ann_search', model=label):
+            result = await loop.run_in_executor(request.app['encode_executor'], params.ann_search, query_vectors)
+        return await finish(params, result)
+
+    url, body, content_type, filter_path = params.es_request(query_vectors)
+    with stage_seconds.time(stage='es_request', model=label):
+        async with request.app['es_session'].post(url, data=body, headers={'Content-Type': content_type},
+                                                  params={'filter_path': filter_path}) as response:
+            if response.status != 200:
+                return web.json_response({'error': 'Failed to fetch results'}, status=response.status)
+            body = await response.read()
+    if params.passthrough:
+        observe_es_took(body, label)
+        # Полный ответ Elasticsearch передаётся клиенту как есть, без повторного разбора JSON
+        return json_response(body, label)
+    try:
+        result = params.es_result(json.loads(body))
+    except SearchError as e:
+        return web.json_response({'error': 'Failed to fetch results'}, status=e.status)
+    observe_es_took(result, label)
+    return await finish(params, result)
+
+
+async def finish(params, result):
+    """ Переранжирует результат, если нужно, и отдаёт его клиенту """
+    if params.rerank:
+        with stage_seconds.time(stage='rerank', model=params.model_label):
+            result = await reranker.rerank_async(result, params.query, RESULT_SIZE)
+    return json_response(params.output(result), params.model_label)
+
+
+def json_response(result, model_label):
+    """ JSON-ответ, сжатый gzip, если он большой и клиент это поддерживает """
+    with stage_seconds.time(stage='serialize', model=model_label):
+        body = result if isinstance(result, bytes) else json.dumps(result, ensure_ascii=False).encode('utf-8')
+    response = web.Response(body=body, content_type='application/json')
+    if len(body) >= GZIP_MIN_BYTES:
+        response.enable_compression()
+    return response
+
+
+async def cache_stats(request):
+    return web.json_response(query_cache.stats())
+
+
+async def get_batcher_stats(request):
+    return web.json_response(batcher_stats())
+
+
+async def metrics(request):
+    metrics_text = render_metrics(query_cache.stats(), batcher_stats(), reranker and reranker.stats())
+    return web.Response(body=metrics_text.encode('utf-8'),
+                        headers={'Content-Type': CONTENT_TYPE})
+
+
+@web.middleware
+async def observe_request(request, handler):
+    # Время учитывается только для запросов /search, прошедших проверку параметров
+    started = time.perf_counter()
+    response = await handler(request)
+    if 'model_label' in request:
+        request_seconds.observe(time.perf_counter() - started, model=request['model_label'])
+    return response
+
+
+async def on_startup(app):
+    connector = aiohttp.TCPConnector(limit=ES_POOL_SIZE, keepalive_timeout=ES_KEEPALIVE)
+    timeout = aiohttp.ClientTimeout(total=ES_TIMEOUT, connect=ES_CONNECT_TIMEOUT)
+    app['es_session'] = aiohttp.ClientSession(connector=connector, timeout=timeout)
+    app['encode_executor'] = ThreadPoolExecutor(max_workers=ENCODE_WORKERS)
+
+
+async def on_cleanup(app):
+    await app['es_session'].close()
+    app['encode_executor'].shutdown()
+
+
+def create_app():
+    app = web.Application(middlewares=[observe_request])
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    app.router.add_post('/search', search)
+    app.router.add_get('/cache', cache_stats)
+    app.router.add_get('/batcher', get_batcher_stats)
+    app.router.add_get('/metrics', metrics)
+    return app
+
+
+if __name__ == '__main__':
+    web.run_app(create_app(), port=5000)
@@ -0,0 +1,113 @@
+# Пакетный поиск для офлайн-оценки и воспроизведения логов запросов.
+# Результаты выдаются в формате NDJSON по одной строке на запрос в порядке входного списка.
+# CLI (обращается к Elasticsearch напрямую, без веб-сервиса):
+#     python -m web.batch_search queries.txt --model mpnet --out results.ndjson
+import argparse
+import json
+import sys
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from web.hybrid import msearch_body
+from web.search import (RESULT_SIZE, SearchError, build_hybrid_body, build_search_payload, encode_queries,
+                        hybrid_result, hydrate, msearch_url)
+
+ENCODE_BATCH_SIZE = 256
+MSEARCH_SIZE = 100
+CONCURRENCY = 4
+
+
+def query_body(query, query_vector, mode, size=RESULT_SIZE):
+    if mode == 'hybrid':
+        return build_hybrid_body(query, query_vector)
+    return msearch_body([({}, build_search_payload(query, query_vector, size=size))])
+
+
+def run_chunk(session, model_name, mode, fusion, offset, queries, query_vectors, size=RESULT_SIZE):
+    """ Отправляет один _msearch для части запросов и возвращает строки результата """
+    searches_per_query = 2 if mode == 'hybrid' else 1
+    body = b''.join(query_body(query, vector, mode, size) for query, vector in zip(queries, query_vectors))
+    try:
+        response = session.post(msearch_url(model_name), data=body, headers={'Content-Type': 'application/x-ndjson'})
+        response.raise_for_status()
+        responses = response.json()['responses']
+    except requests.RequestException as e:
+        return [{'index': offset + i, 'query': query, 'error': str(e)} for i, query in enumerate(queries)]
+
+    results = []
+    for i, query in enumerate(queries):
+        query_responses = responses[i * searches_per_query:(i + 1) * searches_per_query]
+        try:
+            if mode == 'hybrid':
+                result = hybrid_result({'responses': query_responses}, fusion, size)
+            elif 'error' in query_responses[0]:
+                raise SearchError(query_responses[0].get('status', 500))
+            else:
+                result = hydrate(query_responses[0])
+            results.append({'index': offset + i, 'query': query, 'response': result})
+        except SearchError as e:
+            results.append({'index': offset + i, 'query': query, 'error': str(e)})
+    return results
+
+
+def batch_search(queries, model_name, mode='script_score', fusion='rrf', session=None,
+                 encode_batch_size=ENCODE_BATCH_SIZE, msearch_size=MSEARCH_SIZE, concurrency=CONCURRENCY,
+                 size=RESULT_SIZE):
+    """
+    Генератор результатов для списка запросов. Запросы кодируются батчами по encode_batch_size,
+    в Elasticsearch уходят _msearch по msearch_size запросов, одновременно выполняется не больше
+    concurrency _msearch. Результаты выдаются в порядке запросов, по size документов на запрос.
+    """
+    session = session or requests.Session()
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    pending = deque()
+    try:
+        for start in range(0, len(queries), encode_batch_size):
+            batch = queries[start:start + encode_batch_size]
+            vectors = encode_queries(batch, model_name)
+            for chunk_start in range(0, len(batch), msearch_size):
+                # Не больше concurrency запросов в полёте: прежде чем отправить новый, выдаём самый старый
+                while len(pending) >= concurrency:
+                    yield from pending.popleft().result()
+                pending.append(executor.submit(run_chunk, session, model_name, mode, fusion, start + chunk_start,
+                                               batch[chunk_start:chunk_start + msearch_size],
+                                               vectors[chunk_start:chunk_start + msearch_size], size))
+        while pending:
+            yield from pending.popleft().result()
+    finally:
+        executor.shutdown(cancel_futures=True)
+
+
+def read_queries(path):
+    """ Читает запросы: по одному на строку или NDJSON с полем query """
+    queries = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            queries.append(json.loads(line)['query'] if line.startswith('{') else line)
+    return queries
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Пакетный поиск по списку запросов")
+    parser.add_argument('queries', help="файл с запросами: по одному на строку или NDJSON с полем query")
+    parser.add_argument('--model', default='mpnet')
+    parser.add_argument('--mode', default='script_score', choices=['script_score', 'hybrid'])
+    parser.add_argument('--fusion', default='rrf', choices=['rrf', 'minmax'])
+    parser.add_argument('--out', help="файл для результатов, по умолчанию stdout")
+    parser.add_argument('--encode-batch-size', type=int, default=ENCODE_BATCH_SIZE)
+    parser.add_argument('--msearch-size', type=int, default=MSEARCH_SIZE)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    out = open(args.out, 'w', encoding='utf-8') if args.out else sys.stdout
+    for result in batch_search(read_queries(args.queries), args.model, mode=args.mode, fusion=args.fusion,
+                               encode_batch_size=args.encode_batch_size, msearch_size=args.msearch_size,
+                               concurrency=args.concurrency):
+        out.write(json.dumps(result, ensure_ascii=False) + '\n')
+    if args.out:
+        out.close()
@@ -0,0 +1,85 @@
+import queue
+import threading
+import time
+from concurrent.futures import Future
+
+
+class EncodeBatcher:
+    """
+    Собирает запросы на кодирование, пришедшие почти одновременно, и кодирует их одним батчем.
+
+    Батч отправляется, когда набралось max_batch_size текстов или с момента прихода первого
+    текста прошло max_wait секунд.
+    """
+
+    def __init__(self, encode_batch, max_batch_size=32, max_wait=0.003):
+        """
+        :param encode_batch: функция, которая принимает список текстов и возвращает список эмбеддингов.
+        :param max_batch_size: максимальный размер батча.
+        :param max_wait: сколько секунд ждать новых текстов после прихода первого.
+        """
+        self.encode_batch = encode_batch
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait
+        self._queue = queue.Queue()
+        self._lock = threading.Lock()
+        self._batches = 0
+        self._requests = 0
+        self._max_batch = 0
+        self._delay_sum = 0.
+        self._delay_max = 0.
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def submit(self, text):
+        """ Ставит текст в очередь и возвращает Future с его эмбеддингом """
+        future = Future()
+        self._queue.put((text, future, time.monotonic()))
+        return future
+
+    def encode(self, text):
+        return self.submit(text).result()
+
+    def stats(self):
+        with self._lock:
+            return {
+                'batches': self._batches,
+                'requests': self._requests,
+                'mean_batch_size': self._requests / self._batches if self._batches else 0.,
+                'max_batch_size': self._max_batch,
+                'mean_queue_delay_ms': 1000 * self._delay_sum / self._requests if self._requests else 0.,
+                'max_queue_delay_ms': 1000 * self._delay_max
+            }
+
+    def _collect(self):
+        batch = [self._queue.get()]
+        deadline = batch[0][2] + self.max_wait
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                # Если окно уже истекло (например, пока кодировался прошлый батч), забираем то, что успело накопиться
+                batch.append(self._queue.get(timeout=timeout) if timeout > 0 else self._queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            started = time.monotonic()
+            delays = [started - enqueued for _, _, enqueued in batch]
+            with self._lock:
+                self._batches += 1
+                self._requests += len(batch)
+                self._max_batch = max(self._max_batch, len(batch))
+                self._delay_sum += sum(delays)
+                self._delay_max = max(self._delay_max, max(delays))
+
+            try:
+                embeddings = self.encode_batch([text for text, _, _ in batch])
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+            else:
+                for (_, future, _), embedding in zip(batch, embeddings):
+                    future.set_result(embedding)
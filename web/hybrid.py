@@ -0,0 +1,110 @@
+import json
+import os
+import re
+
+# Гибридный поиск: kNN и BM25 ищут кандидатов независимо, списки объединяются на стороне сервиса
+KNN_K = int(os.environ.get('HYBRID_KNN_K', 50))
+KNN_NUM_CANDIDATES = int(os.environ.get('HYBRID_KNN_NUM_CANDIDATES', 200))
+TEXT_CANDIDATES = int(os.environ.get('HYBRID_TEXT_CANDIDATES', 50))
+RRF_RANK_CONSTANT = 60
+# Веса векторной и полнотекстовой оценки: в script_score build_search_payload, в web/ann.py и при слиянии списков
+VECTOR_WEIGHT = 0.7
+TEXT_WEIGHT = 0.3
+# Максимальная ожидаемая оценка полнотекстового поиска, по ней оценка BM25 нормализуется в [0, 1]
+MAX_TEXT_SCORE = 10.0
+FUSIONS = ('rrf', 'minmax')
+
+
+def tokenize(text):
+    return re.findall(r'\w+', str(text or '').lower())
+
+
+def msearch_body(searches):
+    """ NDJSON для _msearch из списка пар (заголовок, тело поиска) """
+    lines = []
+    for header, body in searches:
+        lines.append(json.dumps(header, ensure_ascii=False))
+        lines.append(json.dumps(body, ensure_ascii=False))
+    return ('\n'.join(lines) + '\n').encode('utf-8')
+
+
+def knn_search(query_vector, source, knn_k=KNN_K, num_candidates=KNN_NUM_CANDIDATES):
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": query_vector,
+            "k": knn_k,
+            "num_candidates": num_candidates
+        },
+        "size": knn_k,
+        "_source": source
+    }
+
+
+def text_search(text_query, source, text_candidates=TEXT_CANDIDATES):
+    return {
+        "query": text_query,
+        "size": text_candidates,
+        "_source": source
+    }
+
+
+def build_hybrid_msearch(query_vector, text_query, source):
+    """ Тело _msearch из двух поисков: kNN по embedding и полнотекстового text_query """
+    return msearch_body([({}, knn_search(query_vector, source)), ({}, text_search(text_query, source))])
+
+
+def hit_id(hit):
+    return hit['_id']
+
+
+def rrf_scores(hit_lists, weights, key=hit_id, rank_constant=RRF_RANK_CONSTANT):
+    """ Взвешенный reciprocal rank fusion: сумма weight / (rank_constant + rank) по спискам """
+    scores = {}
+    for hits, weight in zip(hit_lists, weights):
+        for rank, hit in enumerate(hits, start=1):
+            scores[key(hit)] = scores.get(key(hit), 0.) + weight / (rank_constant + rank)
+    return scores
+
+
+def minmax_scores(hit_lists, weights, key=hit_id):
+    """ Оценки каждого списка приводятся к [0, 1] по минимуму и максимуму этого запроса и складываются с весами """
+    scores = {}
+    for hits, weight in zip(hit_lists, weights):
+        if not hits:
+            continue
+        list_scores = [hit['_score'] for hit in hits]
+        low, high = min(list_scores), max(list_scores)
+        for hit in hits:
+            normalized = (hit['_score'] - low) / (high - low) if high > low else 1.
+            scores[key(hit)] = scores.get(key(hit), 0.) + weight * normalized
+    return scores
+
+
+def fuse_responses(responses, size, fusion='rrf', weights=(VECTOR_WEIGHT, TEXT_WEIGHT), key=hit_id):
+    """
+    Объединяет ответы поисков _msearch в один ответ в формате _search.
+    key определяет, какие попадания из разных списков считаются одним документом.
+    """
+    if fusion not in FUSIONS:
+        raise ValueError(f"fusion={fusion} is not supported")
+    hit_lists = [response['hits']['hits'] for response in responses]
+    scores = (rrf_scores(hit_lists, weights, key=key) if fusion == 'rrf'
+              else minmax_scores(hit_lists, weights, key=key))
+
+    # Документ берётся из первого списка, где он встретился
+    docs = {}
+    for hits in hit_lists:
+        for hit in hits:
+            docs.setdefault(key(hit), hit)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:size]
+
+    return {
+        'took': max(response.get('took', 0) for response in responses),
+        'timed_out': any(response.get('timed_out', False) for response in responses),
+        'hits': {
+            'total': {'value': len(scores), 'relation': 'eq'},
+            'max_score': scores[ranked[0]] if ranked else None,
+            'hits': [dict(docs[doc_id], _score=scores[doc_id]) for doc_id in ranked]
+        }
+    }
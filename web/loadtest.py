@@ -0,0 +1,195 @@
+# Нагрузочный тест /search с фиксированной частотой запросов.
+# По умолчанию в этом же процессе поднимаются заглушка Elasticsearch с заданной задержкой и сервис web/app.py,
+# так что измеряются кодирование запросов и накладные расходы сервиса без влияния настоящего кластера:
+#     python -m web.loadtest --qps 20 --duration 30 --models mpnet minilm
+# Против уже запущенного сервиса:
+#     python -m web.loadtest --url http://localhost:5000 --qps 50 --models mpnet
+import argparse
+import json
+import logging
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+import requests
+
+QUERIES = ['wireless headphones', 'running shoes', 'kitchen knife set', 'phone case', 'gaming laptop',
+           'coffee maker', 'yoga mat', 'desk lamp', 'backpack for travel', 'bluetooth speaker']
+STUB_HITS = 10
+PERCENTILES = (50, 90, 99)
+
+
+class StubElasticsearch(ThreadingHTTPServer):
+    """ Заглушка Elasticsearch: на _search и _msearch отвечает одинаковыми документами через latency секунд """
+
+    daemon_threads = True
+    request_queue_size = 128
+
+    def __init__(self, latency=0.005, port=0):
+        super().__init__(('127.0.0.1', port), StubHandler)
+        self.latency = latency
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server_port}'
+
+    def response(self):
+        hits = [{'_index': 'products', '_id': str(i), '_score': float(STUB_HITS - i),
+                 '_source': {'id': str(i), 'name': f'Product {i}', 'description': 'Stub product', 'picture': ''},
+                 'sort': [float(STUB_HITS - i), str(i)]}
+                for i in range(STUB_HITS)]
+        return {'took': int(1000 * self.latency), 'timed_out': False,
+                'hits': {'total': {'value': STUB_HITS, 'relation': 'eq'}, 'max_score': hits[0]['_score'],
+                         'hits': hits}}
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Заголовки и тело пишутся отдельно; с алгоритмом Нейгла это добавляет десятки миллисекунд к keep-alive запросам
+    disable_nagle_algorithm = True
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        time.sleep(self.server.latency)
+        if self.path.split('?')[0].endswith('_msearch'):
+            searches = len(body.decode('utf-8').strip().splitlines()) // 2
+            result = {'responses': [dict(self.server.response(), status=200) for _ in range(searches)]}
+        else:
+            result = self.server.response()
+        body = json.dumps(result).encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_server(server):
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def start_service(es_url, models):
+    """ Запускает web/app.py в потоке процесса; ES_URL читается при импорте web.search """
+    os.environ['ES_URL'] = es_url
+    os.environ.setdefault('WARMUP_MODELS', ','.join(models))
+    from werkzeug.serving import make_server
+    from web.app import app
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+    server = start_server(make_server('127.0.0.1', 0, app, threaded=True))
+    return f'http://127.0.0.1:{server.server_port}'
+
+
+def run(url, queries, models, qps, duration, concurrency, payload=None, seed=0):
+    """
+    Отправляет qps запросов в секунду в течение duration секунд, модели чередуются по кругу.
+    Нагрузка открытая: запрос уходит по расписанию, даже если предыдущие не завершились, а задержка
+    считается от запланированного времени отправки, чтобы очередь на стороне клиента не скрывала замедление.
+    Возвращает {модель: [(задержка в секундах, успех), ...]} и фактическую длительность теста.
+    """
+    rng = random.Random(seed)
+    session = requests.Session()
+    session.mount('http://', requests.adapters.HTTPAdapter(pool_maxsize=concurrency))
+    results = {model: [] for model in models}
+    lock = threading.Lock()
+
+    def send(model, query, scheduled):
+        try:
+            ok = session.post(f'{url}/search', json=dict(payload or {}, query=query, model=model),
+                              timeout=30).status_code == 200
+        except requests.RequestException:
+            ok = False
+        with lock:
+            results[model].append((time.perf_counter() - scheduled, ok))
+
+    total = int(qps * duration)
+    executor = ThreadPoolExecutor(max_workers=concurrency)
+    started = time.perf_counter()
+    for i in range(total):
+        scheduled = started + i / qps
+        delay = scheduled - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+        executor.submit(send, models[i % len(models)], rng.choice(queries), scheduled)
+    executor.shutdown(wait=True)
+    return results, time.perf_counter() - started
+
+
+def report(results, elapsed):
+    """ Пропускная способность и перцентили задержки по моделям, задержки в миллисекундах """
+    summary = {}
+    for model, samples in results.items():
+        latencies = np.array([latency for latency, ok in samples if ok]) * 1000
+        summary[model] = {
+            'requests': len(samples),
+            'errors': sum(not ok for _, ok in samples),
+            'throughput': len(latencies) / elapsed,
+            **{f'p{p}': float(np.percentile(latencies, p)) if len(latencies) else None for p in PERCENTILES},
+            'max': float(latencies.max()) if len(latencies) else None
+        }
+    return summary
+
+
+def stage_report():
+    """ Среднее время этапов /search по метрикам сервиса (только когда сервис запущен в этом процессе) """
+    from web.metrics import es_took_seconds, stage_seconds
+    stages = {f'{stage}/{model}': 1000 * total / count
+              for (stage, model), (count, total) in stage_seconds.summary().items()}
+    stages.update({f'es_took/{model}': 1000 * total / count
+                   for (model,), (count, total) in es_took_seconds.summary().items()})
+    return stages
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Нагрузочный тест /search с фиксированной частотой запросов")
+    parser.add_argument('--url', help="адрес запущенного сервиса; без него сервис и заглушка Elasticsearch "
+                                      "запускаются в этом процессе")
+    parser.add_argument('--models', nargs='+', default=['mpnet'])
+    parser.add_argument('--qps', type=float, default=20)
+    parser.add_argument('--duration', type=float, default=30, help="длительность в секундах")
+    parser.add_argument('--concurrency', type=int, default=64, help="максимум одновременных запросов")
+    parser.add_argument('--queries', help="файл с запросами: по одному на строку или NDJSON с полем query")
+    parser.add_argument('--es-latency-ms', type=float, default=5, help="задержка ответа заглушки Elasticsearch")
+    parser.add_argument('--payload', default='{}', help="дополнительные поля запроса /search в JSON")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--out', help="файл для отчёта в JSON")
+    args = parser.parse_args()
+
+    url = args.url
+    if url is None:
+        es = start_server(StubElasticsearch(latency=args.es_latency_ms / 1000))
+        url = start_service(es.url, args.models)
+    # web.search читает ES_URL при импорте, поэтому импортируется только после запуска заглушки
+    from web.batch_search import read_queries
+    queries = read_queries(args.queries) if args.queries else QUERIES
+
+    # Прогрев: первые запросы к модели включают её загрузку и не должны попадать в отчёт
+    for model in args.models:
+        requests.post(f'{url}/search', json=dict(json.loads(args.payload), query=queries[0], model=model))
+    if args.url is None:
+        # Иначе в среднее время этапов попала бы и загрузка моделей
+        from web.metrics import es_took_seconds, request_seconds, stage_seconds
+        for histogram in (request_seconds, stage_seconds, es_took_seconds):
+            histogram.reset()
+
+    results, elapsed = run(url, queries, args.models, args.qps, args.duration, args.concurrency,
+                           payload=json.loads(args.payload), seed=args.seed)
+    summary = {'qps': args.qps, 'duration': elapsed, 'models': report(results, elapsed)}
+    for model, stats in summary['models'].items():
+        print(f"{model:>10}: {stats['requests']} запросов, {stats['errors']} ошибок, "
+              f"{stats['throughput']:.1f} запросов/с, " +
+              ', '.join(f"p{p} {stats[f'p{p}']:.1f} мс" for p in PERCENTILES if stats[f'p{p}'] is not None))
+    if args.url is None:
+        summary['stages_ms'] = stage_report()
+        for stage, mean in sorted(summary['stages_ms'].items()):
+            print(f"{stage:>24}: {mean:.2f} мс в среднем")
+    if args.out:
+        with open(args.out, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
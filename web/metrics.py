@@ -0,0 +1,120 @@
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм в секундах: от 1 мс до 10 с
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .075, .1, .25, .5, .75, 1., 2.5, 5., 10.)
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+
+class Histogram:
+    """ Гистограмма в формате Prometheus с произвольными метками """
+
+    def __init__(self, name, help_text, labelnames, buckets=LATENCY_BUCKETS):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = labelnames
+        self.buckets = buckets
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def observe(self, value, **labels):
+        key = tuple(str(labels[name]) for name in self.labelnames)
+        with self._lock:
+            # Для каждой комбинации меток: накопительные счётчики корзин, сумма и число наблюдений
+            series = self._series.setdefault(key, [[0] * len(self.buckets), 0., 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def reset(self):
+        """ Сбрасывает все наблюдения, например после прогрева """
+        with self._lock:
+            self._series.clear()
+
+    def summary(self):
+        """ {значения меток: (число наблюдений, сумма)} """
+        with self._lock:
+            return {key: (count, total) for key, (_, total, count) in self._series.items()}
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            for key, (counts, total, count) in sorted(self._series.items()):
+                labels = list(zip(self.labelnames, key))
+                for bound, bucket_count in zip(self.buckets, counts):
+                    lines.append(f"{self.name}_bucket{label_text(labels + [('le', bound)])} {bucket_count}")
+                lines.append(f"{self.name}_bucket{label_text(labels + [('le', '+Inf')])} {count}")
+                lines.append(f"{self.name}_sum{label_text(labels)} {total}")
+                lines.append(f"{self.name}_count{label_text(labels)} {count}")
+        return '\n'.join(lines)
+
+
+def label_text(labels):
+    """ Метки в формате {name="value",...}, пустая строка без меток """
+    if not labels:
+        return ''
+    return '{' + ','.join(f'{name}="{value}"' for name, value in labels) + '}'
+
+
+# Время этапов /search: encode -- кодирование запроса, es_request -- HTTP-запрос к Elasticsearch
+# (ann_search -- поиск в локальном индексе), rerank -- второй этап ранжирования, serialize -- сборка и сжатие ответа
+stage_seconds = Histogram('search_stage_seconds', 'Duration of /search stages', ('stage', 'model'))
+# Время поиска по данным самого Elasticsearch (поле took); разница с es_request -- сеть и разбор запроса
+es_took_seconds = Histogram('search_es_took_seconds', 'Elasticsearch reported took', ('model',))
+request_seconds = Histogram('search_request_seconds', 'Total /search handling time', ('model',))
+
+_TOOK = re.compile(rb'"took"\s*:\s*(\d+)')
+
+
+def observe_es_took(body, model_name):
+    """ Учитывает поле took ответа Elasticsearch, не разбирая весь JSON """
+    if isinstance(body, bytes):
+        match = _TOOK.search(body[:200])
+        took = int(match.group(1)) if match else None
+    else:
+        took = body.get('took')
+    if took is not None:
+        es_took_seconds.observe(took / 1000, model=model_name)
+
+
+def gauge_lines(name, help_text, values, kind='gauge'):
+    """ Gauge-метрика из словаря {метки: значение} """
+    lines = [f"# HELP {name} {help_text}", f"# TYPE {name} {kind}"]
+    for labels, value in values.items():
+        lines.append(f"{name}{label_text(labels)} {value}")
+    return '\n'.join(lines)
+
+
+def counter_lines(name, help_text, values):
+    """ Counter-метрика: значения только растут, по соглашению Prometheus имя оканчивается на _total """
+    return gauge_lines(name, help_text, values, kind='counter')
+
+
+def render_metrics(query_cache_stats, batcher_stats, rerank_stats=None):
+    """ Все метрики сервиса в текстовом формате Prometheus """
+    parts = [metric.render() for metric in (request_seconds, stage_seconds, es_took_seconds)]
+    parts.append(counter_lines('query_cache_events_total', 'Query embedding cache events',
+                             {(('event', event),): query_cache_stats[event]
+                              for event in ('hits', 'misses', 'evictions', 'expirations')}))
+    parts.append(gauge_lines('query_cache_size', 'Query embedding cache size', {(): query_cache_stats['size']}))
+    parts.append(gauge_lines('encode_batch_mean_size', 'Mean micro-batch size',
+                             {(('model', model),): stats['mean_batch_size'] for model, stats in batcher_stats.items()}))
+    parts.append(gauge_lines('encode_batch_mean_queue_delay_ms', 'Mean micro-batch queueing delay',
+                             {(('model', model),): stats['mean_queue_delay_ms']
+                              for model, stats in batcher_stats.items()}))
+    if rerank_stats is not None:
+        parts.append(counter_lines('rerank_events_total', 'Reranked responses and fallbacks to first-stage order',
+                                 {(('event', event),): rerank_stats[event] for event in ('reranked', 'fallbacks')}))
+    return '\n'.join(parts) + '\n'
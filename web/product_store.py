@@ -0,0 +1,123 @@
+# Хранилище полей товаров по id для заполнения _source результатов без обращения к Elasticsearch.
+# Построение по индексу Elasticsearch (без векторов) или по файлу с JSON-объектом товара в строке:
+#     python -m web.product_store product_store --model mpnet
+#     python -m web.product_store product_store --jsonl products.jsonl
+import argparse
+import itertools
+import json
+import os
+
+import numpy as np
+
+
+class ProductStore:
+    """
+    Колоночное хранилище: для каждого поля файл {поле}.bin со значениями в JSON подряд и {поле}.idx со
+    смещениями начала каждого значения (строка i -- товар i), плюс ids.txt со списком id.
+
+    Файлы открываются через np.memmap, поэтому в память читаются только запрошенные поля запрошенных товаров.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'meta.json')) as f:
+            self.fields = json.load(f)['fields']
+        with open(os.path.join(path, 'ids.txt'), encoding='utf-8') as f:
+            self.ids = f.read().splitlines()
+        self.rows = {doc_id: row for row, doc_id in enumerate(self.ids)}
+        self._offsets = {field: np.load(os.path.join(path, f'{field}.idx'), mmap_mode='r') for field in self.fields}
+        self._data = {}
+        for field in self.fields:
+            data_path = os.path.join(path, f'{field}.bin')
+            # Пустой файл нельзя отобразить в память
+            self._data[field] = (np.memmap(data_path, dtype=np.uint8, mode='r') if os.path.getsize(data_path)
+                                 else np.empty(0, dtype=np.uint8))
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __contains__(self, doc_id):
+        return str(doc_id) in self.rows
+
+    def get_rows(self, rows, fields=None):
+        """ Документы строк rows; fields -- какие поля читать, по умолчанию все """
+        fields = self.fields if not fields else [field for field in fields if field in self._offsets]
+        docs = [{} for _ in rows]
+        rows = np.asarray(rows, dtype=np.int64)
+        for field in fields:
+            offsets, data = self._offsets[field], self._data[field]
+            starts, ends = offsets[rows], offsets[rows + 1]
+            for doc, start, end in zip(docs, starts.tolist(), ends.tolist()):
+                # Пустое значение -- поля у товара нет
+                if end > start:
+                    doc[field] = json.loads(data[start:end].tobytes())
+        return docs
+
+    def get(self, doc_ids, fields=None):
+        """ Документы для списка id в том же порядке; для неизвестных id -- None """
+        rows = [self.rows.get(str(doc_id)) for doc_id in doc_ids]
+        found = [row for row in rows if row is not None]
+        docs = iter(self.get_rows(found, fields))
+        return [next(docs) if row is not None else None for row in rows]
+
+    @classmethod
+    def build(cls, path, products, fields=None):
+        """
+        Записывает хранилище потоково из пар (id, документ). fields -- какие поля сохранить,
+        по умолчанию все поля первого документа, кроме embedding.
+        """
+        products = iter(products)
+        first = next(products, None)
+        if fields is None:
+            fields = [field for field in (first[1] if first else {}) if field != 'embedding']
+        os.makedirs(path, exist_ok=True)
+        offsets = {field: [0] for field in fields}
+        data_files = {field: open(os.path.join(path, f'{field}.bin'), 'wb') for field in fields}
+        try:
+            with open(os.path.join(path, 'ids.txt'), 'w', encoding='utf-8') as ids_file:
+                for doc_id, source in itertools.chain([first] if first else [], products):
+                    ids_file.write(f'{doc_id}\n')
+                    for field, f in data_files.items():
+                        if source.get(field) is not None:
+                            f.write(json.dumps(source[field], ensure_ascii=False).encode('utf-8'))
+                        offsets[field].append(f.tell())
+        finally:
+            for f in data_files.values():
+                f.close()
+
+        for field in fields:
+            with open(os.path.join(path, f'{field}.idx'), 'wb') as f:
+                np.save(f, np.asarray(offsets[field], dtype=np.int64))
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump({'fields': fields, 'size': len(offsets[fields[0]]) - 1 if fields else 0}, f)
+        return cls(path)
+
+
+def read_jsonl(path, id_field):
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                product = json.loads(line)
+                yield str(product[id_field]), product
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Построение хранилища полей товаров")
+    parser.add_argument('out', help="каталог хранилища")
+    parser.add_argument('--model', help="выгрузить документы из индекса products_{model}")
+    parser.add_argument('--jsonl', help="файл с JSON-объектом товара в каждой строке")
+    parser.add_argument('--id-field', default='id')
+    parser.add_argument('--fields', nargs='+', help="какие поля сохранить, по умолчанию все, кроме embedding")
+    parser.add_argument('--es-url', default='http://localhost:9200')
+    args = parser.parse_args()
+
+    if args.model:
+        from web.ann import scroll_index
+        products = ((str(hit['_source'].get(args.id_field, hit['_id'])), hit['_source'])
+                    for hits in scroll_index(args.es_url, f"products_{args.model}") for hit in hits)
+    elif args.jsonl:
+        products = read_jsonl(args.jsonl, args.id_field)
+    else:
+        parser.error("нужно указать --model или --jsonl")
+    store = ProductStore.build(args.out, products, fields=args.fields)
+    print(f"Сохранено {len(store)} товаров, поля: {', '.join(store.fields)}")
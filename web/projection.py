@@ -0,0 +1,80 @@
+import base64
+import gzip
+import json
+import os
+
+# Какие поля _source возвращаются по умолчанию. Векторы не нужны клиенту и занимают большую часть ответа
+SOURCE_INCLUDES = [field for field in os.environ.get('SOURCE_INCLUDES', '').split(',') if field]
+SOURCE_EXCLUDES = [field for field in os.environ.get('SOURCE_EXCLUDES', 'embedding').split(',') if field]
+# Второй ключ сортировки для search_after: у равных по _score документов порядок должен быть однозначным
+TIEBREAKER_SORT = {"id.keyword": {"order": "asc", "unmapped_type": "keyword"}}
+# Elasticsearch не возвращает служебные поля (_shards, _ignored и т.п.)
+FILTER_PATH = 'took,timed_out,hits.total,hits.max_score,hits.hits._index,hits.hits._id,hits.hits._score,' \
+              'hits.hits._source,hits.hits.sort'
+MSEARCH_FILTER_PATH = ','.join(['responses.status', 'responses.error'] +
+                               ['responses.' + path for path in FILTER_PATH.split(',')])
+# Ответы больше GZIP_MIN_BYTES сжимаются, если клиент принимает gzip
+GZIP_MIN_BYTES = int(os.environ.get('GZIP_MIN_BYTES', 1024))
+GZIP_LEVEL = 5
+
+
+def source_filter(data):
+    """ Фильтр _source для Elasticsearch из полей запроса source_includes и source_excludes (списки имён полей) """
+    includes = data.get('source_includes', SOURCE_INCLUDES)
+    excludes = data.get('source_excludes', SOURCE_EXCLUDES)
+    for name, fields in (('source_includes', includes), ('source_excludes', excludes)):
+        if not isinstance(fields, list) or not all(isinstance(field, str) for field in fields):
+            raise ValueError(f'{name} must be a list of field names')
+    if includes and 'id' not in includes:
+        # По id сопоставляются товары при слиянии результатов разных индексов
+        includes = includes + ['id']
+    return {"includes": includes, "excludes": excludes}
+
+
+def project_source(source, source_filter):
+    """ Тот же фильтр для документов, которые отдаются без Elasticsearch (локальный бэкенд) """
+    includes, excludes = source_filter['includes'], source_filter['excludes']
+    return {key: value for key, value in source.items()
+            if (not includes or key in includes) and key not in excludes}
+
+
+def widen_filter(source_filter, fields):
+    """ Фильтр, который вдобавок к source_filter пропускает поля fields """
+    includes = source_filter['includes']
+    return {"includes": includes + [field for field in fields if field not in includes] if includes else includes,
+            "excludes": [field for field in source_filter['excludes'] if field not in fields]}
+
+
+def encode_cursor(sort_values):
+    return base64.urlsafe_b64encode(json.dumps(sort_values).encode('utf-8')).decode('ascii')
+
+
+def decode_cursor(cursor):
+    """ Курсор принимается как строка из поля next или как массив sort последнего документа """
+    if cursor is None or isinstance(cursor, list):
+        return cursor
+    if not isinstance(cursor, str):
+        raise ValueError(f'Invalid cursor {cursor}')
+    try:
+        return json.loads(base64.urlsafe_b64decode(cursor.encode('ascii')))
+    except ValueError:
+        raise ValueError(f'Invalid cursor {cursor}')
+
+
+def compact_response(response):
+    """ Сокращённый ответ: только id, оценка и поля документа, плюс курсор следующей страницы """
+    hits = response['hits']['hits']
+    last_sort = hits[-1].get('sort') if hits else None
+    return {
+        'took': response.get('took'),
+        'total': response['hits'].get('total', {}).get('value'),
+        'hits': [dict(hit.get('_source', {}), _id=hit['_id'], _score=hit['_score']) for hit in hits],
+        'next': encode_cursor(last_sort) if last_sort else None
+    }
+
+
+def gzip_body(body, accept_encoding):
+    """ Сжимает тело ответа, если оно достаточно большое и клиент принимает gzip """
+    if len(body) < GZIP_MIN_BYTES or 'gzip' not in (accept_encoding or ''):
+        return body, False
+    return gzip.compress(body, compresslevel=GZIP_LEVEL), True
@@ -0,0 +1,144 @@
+# Второй этап ранжирования: лучшие кандидаты первого этапа переранжируются моделью RankFormer,
+# экспортированной для CPU скриптом rankformer/export.py (TorchScript без dropout). Модель должна быть обучена
+# на признаках FEATURES в этом порядке, без преобразования признаков; выборку для неё собирает web/rerank_dataset.py.
+# Признаки score и score_ratio -- оценки первого этапа, масштаб которых у разных режимов и бэкендов разный, поэтому
+# при экспорте указывается первый этап обучающей выборки, и по умолчанию переранжируются только такие запросы:
+#     python export.py model_checkpoint.pth reranker.pt --input-dim 7 --features score,score_ratio,... --mode hybrid
+import asyncio
+import json
+import math
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError
+
+import numpy as np
+import torch
+
+from web.hybrid import tokenize
+
+RERANK_MODEL_PATH = os.environ.get('RERANK_MODEL_PATH')
+# Сколько кандидатов первого этапа переранжируется
+RERANK_TOP_N = int(os.environ.get('RERANK_TOP_N', 50))
+# Если переранжирование не уложилось в бюджет, отдаётся порядок первого этапа
+RERANK_BUDGET_MS = float(os.environ.get('RERANK_BUDGET_MS', 20))
+
+FEATURES = ['score', 'score_ratio', 'reciprocal_rank', 'name_overlap', 'description_overlap', 'name_length',
+            'description_length']
+# Поля _source, из которых считаются признаки: они запрашиваются у первого этапа при любом фильтре клиента
+SOURCE_FIELDS = ['name', 'description']
+
+
+def candidate_features(query, hits):
+    """ Матрица признаков (кандидаты, FEATURES) для списка попаданий первого этапа """
+    terms = set(tokenize(query))
+    max_score = max((hit['_score'] or 0. for hit in hits), default=0.) or 1.
+    rows = []
+    for rank, hit in enumerate(hits, start=1):
+        source = hit.get('_source', {})
+        name, description = tokenize(source.get('name')), tokenize(source.get('description'))
+        rows.append([
+            hit['_score'] or 0.,
+            (hit['_score'] or 0.) / max_score,
+            1. / rank,
+            len(terms.intersection(name)) / len(terms) if terms else 0.,
+            len(terms.intersection(description)) / len(terms) if terms else 0.,
+            math.log1p(len(name)),
+            math.log1p(len(description))
+        ])
+    return np.asarray(rows, dtype=np.float32).reshape(len(hits), len(FEATURES))
+
+
+class Reranker:
+    """
+    Переранжирование ответа в формате Elasticsearch одним батчевым проходом модели по всему списку кандидатов.
+
+    Модель выполняется в отдельном потоке, а запрос ждёт её не дольше budget_ms с начала переранжирования.
+    Если бюджет исчерпан, ответ остаётся в порядке первого этапа; задачи, которые дождались очереди уже после
+    дедлайна, не выполняются, чтобы перегрузка не накапливалась.
+    """
+
+    def __init__(self, path, top_n=RERANK_TOP_N, budget_ms=RERANK_BUDGET_MS):
+        extra_files = {'meta.json': ''}
+        self.model = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        meta = json.loads(extra_files['meta.json'] or '{}')
+        if meta.get('features') != FEATURES:
+            raise ValueError(f"Reranker {path} expects features {meta.get('features')}, "
+                             f"the service computes {FEATURES}")
+        if not meta.get('first_stage'):
+            raise ValueError(f"Reranker {path} does not record its first stage, export it again with --backend "
+                             "and --mode")
+        self.first_stage = meta['first_stage']
+        self.top_n = top_n
+        self.budget = budget_ms / 1000
+        # Один поток: forward уже использует потоки torch, а очередь задач ограничивает нагрузку на CPU
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._lock = threading.Lock()
+        self._reranked = 0
+        self._fallbacks = 0
+        # Первые вызовы TorchScript профилируют и оптимизируют граф и занимают десятки миллисекунд
+        with torch.inference_mode():
+            for length in (top_n, top_n, max(top_n // 2, 1)):
+                self.model(torch.zeros(length, len(FEATURES)))
+
+    def matches(self, backend, mode, fusion):
+        """ Тот же ли это первый этап, на кандидатах которого обучалась модель """
+        if backend != self.first_stage['backend']:
+            return False
+        # Локальный индекс ранжирует одинаково в любом режиме
+        if backend == 'ann':
+            return True
+        return mode == self.first_stage['mode'] and (mode != 'hybrid' or fusion == self.first_stage['fusion'])
+
+    def _score(self, query, hits, deadline):
+        if time.perf_counter() > deadline:
+            return None
+        features = torch.from_numpy(candidate_features(query, hits))
+        with torch.inference_mode():
+            return self.model(features).numpy()
+
+    def _submit(self, query, response):
+        hits = response['hits']['hits'][:self.top_n]
+        deadline = time.perf_counter() + self.budget
+        return hits, self._executor.submit(self._score, query, hits, deadline)
+
+    def _apply(self, response, hits, scores, size):
+        """ Упорядочивает кандидатов по оценкам модели; без оценок оставляет порядок первого этапа """
+        with self._lock:
+            if scores is None:
+                self._fallbacks += 1
+            else:
+                self._reranked += 1
+        if scores is not None:
+            order = np.argsort(-scores, kind='stable')
+            # Значения sort первого этапа не соответствуют новому порядку и не годятся как курсор search_after
+            hits = [dict({key: value for key, value in hits[i].items() if key != 'sort'},
+                         _rerank_score=float(scores[i])) for i in order]
+        # Кандидаты сверх top_n не переранжируются и идут после переранжированных
+        hits = (hits + response['hits']['hits'][self.top_n:])[:size]
+        return dict(response, reranked=scores is not None, hits=dict(response['hits'], hits=hits))
+
+    def rerank(self, response, query, size):
+        if not response['hits']['hits']:
+            return response
+        hits, future = self._submit(query, response)
+        try:
+            scores = future.result(timeout=self.budget)
+        except TimeoutError:
+            scores = None
+        return self._apply(response, hits, scores, size)
+
+    async def rerank_async(self, response, query, size):
+        if not response['hits']['hits']:
+            return response
+        hits, future = self._submit(query, response)
+        try:
+            scores = await asyncio.wait_for(asyncio.wrap_future(future), self.budget)
+        except asyncio.TimeoutError:
+            scores = None
+        return self._apply(response, hits, scores, size)
+
+    def stats(self):
+        with self._lock:
+            return {'top_n': self.top_n, 'budget_ms': 1000 * self.budget,
+                    'reranked': self._reranked, 'fallbacks': self._fallbacks}
@@ -0,0 +1,79 @@
+# Обучающая выборка для переранжирования (web/rerank.py): для каждого размеченного запроса берутся кандидаты
+# первого этапа, как их видит /search, и записываются с признаками FEATURES в формате LETOR, который читает
+# rankformer/letor.py. Разметка -- NDJSON со строками {"query": "...", "labels": {"<id товара>": оценка, ...}},
+# товары без оценки считаются нерелевантными (0). Разметка делится на обучающую и тестовую части заранее:
+#     python -m web.rerank_dataset train_judgements.ndjson rerank/train.txt --model mpnet
+#     python -m web.rerank_dataset test_judgements.ndjson rerank/test.txt --model mpnet
+#     cd rankformer && python main.py --data-dir ../rerank --num-features 7 --raw-features --explicit-labels
+#     python export.py model_checkpoint.pth reranker.pt --input-dim 7 --max-target <max оценка> \
+#         --features score,score_ratio,reciprocal_rank,name_overlap,description_overlap,name_length,description_length \
+#         --mode script_score
+# Режим --mode (и --fusion для hybrid) при экспорте -- тот же, что при сборке выборки: сервис по умолчанию
+# переранжирует только запросы с таким первым этапом
+import argparse
+import json
+
+from web.batch_search import CONCURRENCY, batch_search
+from web.rerank import FEATURES, RERANK_TOP_N, candidate_features
+from web.search import product_key
+
+
+def read_judgements(path):
+    """ Читает разметку: список пар (запрос, {id товара: оценка}) """
+    judgements = []
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            if line.strip():
+                item = json.loads(line)
+                judgements.append((item['query'], {str(key): int(value) for key, value in item['labels'].items()}))
+    return judgements
+
+
+def letor_lines(qid, query, hits, labels):
+    """ Строки '<оценка> qid:<qid> 1:<признак> ... 7:<признак>' для кандидатов одного запроса """
+    features = candidate_features(query, hits)
+    for hit, row in zip(hits, features):
+        values = ' '.join(f'{i}:{value:.9g}' for i, value in enumerate(row, start=1))
+        yield f"{labels.get(str(product_key(hit)), 0)} qid:{qid} {values}\n"
+
+
+def build_dataset(judgements, out_path, model_name, mode='script_score', fusion='rrf', top_n=RERANK_TOP_N,
+                  concurrency=CONCURRENCY):
+    """
+    Записывает кандидатов первого этапа для размеченных запросов. Запросы, на которые поиск вернул ошибку или
+    ни одного товара с положительной оценкой, пропускаются: по ним модели нечему учиться.
+
+    :return: число записанных запросов.
+    """
+    queries = [query for query, _ in judgements]
+    written = 0
+    with open(out_path, 'w', encoding='utf-8') as out:
+        for result in batch_search(queries, model_name, mode=mode, fusion=fusion, concurrency=concurrency,
+                                   size=top_n):
+            if 'error' in result:
+                print(f"Запрос {result['query']!r} пропущен: {result['error']}")
+                continue
+            query, labels = judgements[result['index']]
+            hits = result['response']['hits']['hits'][:top_n]
+            if not any(labels.get(str(product_key(hit)), 0) > 0 for hit in hits):
+                continue
+            out.writelines(letor_lines(result['index'] + 1, query, hits, labels))
+            written += 1
+    return written
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Обучающая выборка для переранжирования в формате LETOR")
+    parser.add_argument('judgements', help="NDJSON с полями query и labels (id товара -> оценка)")
+    parser.add_argument('out', help="файл LETOR, например rerank/train.txt")
+    parser.add_argument('--model', default='mpnet')
+    parser.add_argument('--mode', default='script_score', choices=['script_score', 'hybrid'])
+    parser.add_argument('--fusion', default='rrf', choices=['rrf', 'minmax'])
+    parser.add_argument('--top-n', type=int, default=RERANK_TOP_N)
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY)
+    args = parser.parse_args()
+
+    judgements = read_judgements(args.judgements)
+    written = build_dataset(judgements, args.out, args.model, mode=args.mode, fusion=args.fusion, top_n=args.top_n,
+                            concurrency=args.concurrency)
+    print(f"{args.out}: {written} из {len(judgements)} запросов, {len(FEATURES)} признаков")
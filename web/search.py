@@ -0,0 +1,415 @@
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from encoding.registry import MODELS, ModelRegistry
+from web.batcher import EncodeBatcher
+from web.hybrid import (FUSIONS, MAX_TEXT_SCORE, TEXT_WEIGHT, VECTOR_WEIGHT, build_hybrid_msearch, fuse_responses,
+                        knn_search, msearch_body, text_search)
+from web.product_store import ProductStore
+from web.projection import (FILTER_PATH, MSEARCH_FILTER_PATH, SOURCE_EXCLUDES, SOURCE_INCLUDES, TIEBREAKER_SORT,
+                            compact_response, decode_cursor, project_source, source_filter, widen_filter)
+from web.query_cache import QueryCache, normalize_query
+from web.rerank import RERANK_MODEL_PATH, SOURCE_FIELDS as RERANK_FIELDS, Reranker
+
+ES_URL = os.environ.get('ES_URL', 'http://localhost:9200')
+DEFAULT_MODEL = 'mpnet'
+
+# Модели, которые загружаются при старте; остальные -- при первом запросе
+WARMUP_MODELS = [name for name in os.environ.get('WARMUP_MODELS', 'mpnet').split(',') if name]
+# Сколько мегабайт могут занимать загруженные модели, после этого выгружаются давно не использованные
+MODEL_MEMORY_BUDGET_MB = os.environ.get('MODEL_MEMORY_BUDGET_MB')
+# Режим инференса моделей без GPU: fp32, int8 (динамическое квантование) или onnx (ONNX Runtime)
+ENCODER_CPU_MODE = os.environ.get('ENCODER_CPU_MODE', 'fp32')
+
+registry = ModelRegistry(
+    memory_budget=int(MODEL_MEMORY_BUDGET_MB) * 1024 * 1024 if MODEL_MEMORY_BUDGET_MB else None,
+    cpu_mode=ENCODER_CPU_MODE
+)
+registry.warmup(WARMUP_MODELS)
+
+# Кэш эмбеддингов запросов: популярные запросы не кодируются повторно
+QUERY_CACHE_TTL = os.environ.get('QUERY_CACHE_TTL')
+query_cache = QueryCache(
+    maxsize=int(os.environ.get('QUERY_CACHE_SIZE', 10000)),
+    ttl=float(QUERY_CACHE_TTL) if QUERY_CACHE_TTL else None
+)
+
+# Микробатчинг: одновременные запросы к одной модели кодируются одним батчем. 0 -- выключен
+ENCODE_BATCH_WINDOW_MS = float(os.environ.get('ENCODE_BATCH_WINDOW_MS', 0))
+ENCODE_BATCH_SIZE = int(os.environ.get('ENCODE_BATCH_SIZE', 32))
+
+batchers = {}
+_batchers_lock = threading.Lock()
+
+# Бэкенд поиска по умолчанию: 'elasticsearch' или 'ann' (локальный индекс faiss из ANN_INDEX_DIR/<модель>)
+BACKENDS = ('elasticsearch', 'ann')
+SEARCH_BACKEND = os.environ.get('SEARCH_BACKEND', 'elasticsearch')
+ANN_INDEX_DIR = os.environ.get('ANN_INDEX_DIR', 'ann_index')
+
+ann_indexes = {}
+_ann_lock = threading.Lock()
+
+# Режим поиска в Elasticsearch: 'script_score' -- косинус по каждому текстовому совпадению,
+# 'hybrid' -- отдельные kNN и BM25 с ограниченным числом кандидатов и слиянием списков (FUSION: rrf или minmax)
+SEARCH_MODES = ('script_score', 'hybrid')
+SEARCH_MODE = os.environ.get('SEARCH_MODE', 'script_score')
+FUSION = os.environ.get('FUSION', 'rrf')
+RESULT_SIZE = 10
+DEFAULT_SOURCE = {"includes": SOURCE_INCLUDES, "excludes": SOURCE_EXCLUDES}
+
+# Переранжирование кандидатов RankFormer'ом; без RERANK_MODEL_PATH выключено
+reranker = Reranker(RERANK_MODEL_PATH) if RERANK_MODEL_PATH else None
+
+# Хранилище полей товаров (web/product_store.py). Если оно задано, Elasticsearch возвращает только id,
+# а поля документов для ответа читаются из хранилища
+PRODUCT_STORE_DIR = os.environ.get('PRODUCT_STORE_DIR')
+product_store = ProductStore(PRODUCT_STORE_DIR) if PRODUCT_STORE_DIR else None
+
+# Пул для одновременного кодирования запроса несколькими моделями в режиме fan-out
+fanout_executor = ThreadPoolExecutor(max_workers=len(MODELS))
+
+
+class SearchError(Exception):
+    def __init__(self, status):
+        super().__init__(f'Elasticsearch returned {status}')
+        self.status = status
+
+
+def generate_query_vector_search(vector, size, min_score):
+    return {
+        "knn": {
+            "field": "embedding",
+            "query_vector": vector,
+            "k": size,
+            "num_candidates": 100
+        },
+        "size": size,
+        "min_score": min_score
+    }
+
+def generate_all_multi_match_queries(word):
+    search_type = "most_fields"
+    fields = [
+        "name^2",
+        "categories^3",
+        "params_str",
+        "n_grams"
+    ]
+    return {
+        "multi_match": {
+            "query": word,
+            "fields": fields,
+            "type": search_type,
+            "operator": "or",
+        }
+    }
+
+#def generate_query_vector_search(vector, size, min_score):
+#    return {
+#        "query": {
+#            "script_score": {
+#                "query": {
+#                    "match_all": {}
+#                },
+#                "script": {
+#                    "source": "cosineSimilarity(params.vector, 'vector') + 1",
+#                    "lang": "painless",
+#                    "params": {
+#                        "vector": vector
+#                    }
+#                }
+#            }
+#        },
+#        "size": size,
+#        "min_score": min_score
+#    }
+#
+
+def encode_texts(texts, model_name):
+    """ Кодирует список текстов одним батчем """
+    model = registry.get(model_name)
+    embeddings = model.encode(texts, batch_size=len(texts), show_progress_bar=False)
+    return [embedding.tolist() for embedding in embeddings]
+
+def get_batcher(model_name):
+    """ Возвращает батчер кодирования для модели, создавая его при первом обращении """
+    with _batchers_lock:
+        if model_name not in batchers:
+            batchers[model_name] = EncodeBatcher(lambda texts: encode_texts(texts, model_name),
+                                                 max_batch_size=ENCODE_BATCH_SIZE,
+                                                 max_wait=ENCODE_BATCH_WINDOW_MS / 1000)
+        return batchers[model_name]
+
+def encode_text(text, model_name):
+    """ Кодирует текст в эмбеддинг с использованием указанной модели """
+    if ENCODE_BATCH_WINDOW_MS > 0:
+        return get_batcher(model_name).encode(text)
+    model = registry.get(model_name)
+    embeddings = model.encode(text)
+    return embeddings.squeeze().tolist()
+
+def encode_query(query, model_name):
+    """ Кодирует поисковый запрос, используя кэш по (модель, нормализованный запрос) """
+    query = normalize_query(query)
+    return query_cache.get_or_compute((model_name, query), lambda: encode_text(query, model_name))
+
+def encode_queries(queries, model_name):
+    """ Кодирует список запросов: найденные в кэше берутся из него, остальные кодируются одним батчем """
+    keys = [(model_name, normalize_query(query)) for query in queries]
+    vectors = [query_cache.get(key) for key in keys]
+    missing = sorted({key[1] for key, vector in zip(keys, vectors) if vector is None})
+    if missing:
+        encoded = dict(zip(missing, encode_texts(missing, model_name)))
+        for text, vector in encoded.items():
+            query_cache.put((model_name, text), vector)
+        vectors = [encoded[key[1]] if vector is None else vector for key, vector in zip(keys, vectors)]
+    return vectors
+
+def batcher_stats():
+    with _batchers_lock:
+        return {model_name: batcher.stats() for model_name, batcher in batchers.items()}
+
+def build_search_payload(query, query_vector, source=None, search_after=None, size=RESULT_SIZE):
+    """
+    Собирает запрос к Elasticsearch для /search. source -- фильтр _source,
+    search_after -- значения sort последнего документа предыдущей страницы,
+    size -- число кандидатов (больше RESULT_SIZE, если они переранжируются).
+    """
+    # Создаем комбинированный запрос с взвешенной суммой оценок
+    payload = {
+        "query": {
+            "script_score": {
+                "query": generate_all_multi_match_queries(query),
+                "script": {
+                    "source": """
+                    // Нормализация векторного поиска (косинусное сходство в диапазоне [-1, 1])
+                    double vectorScore = (cosineSimilarity(params.query_vector, 'embedding') + 1.0) / 2.0;
+                    
+                    // Нормализация полнотекстового поиска
+                    // Используем min-max нормализацию для _score
+                    double textScore = _score;
+                    if (textScore > params.max_score) {
+                        textScore = params.max_score;
+                    }
+                    textScore = textScore / params.max_score;
+                    
+                    // Взвешенная сумма нормализованных оценок
+                    return params.vector_weight * vectorScore + params.text_weight * textScore;
+                    """,
+                    "params": {
+                        "query_vector": query_vector,
+                        "vector_weight": VECTOR_WEIGHT,  # Вес для векторного поиска
+                        "text_weight": TEXT_WEIGHT,      # Вес для полнотекстового поиска
+                        "max_score": MAX_TEXT_SCORE      # Максимальная ожидаемая оценка для полнотекстового поиска
+                    }
+                }
+            }
+        },
+        "size": size,
+        "_source": es_source(source),
+        "sort": [{"_score": "desc"}, TIEBREAKER_SORT]
+    }
+    if search_after is not None:
+        payload["search_after"] = search_after
+    return payload
+
+def get_ann_index(model_name):
+    """ Загружает локальный ANN-индекс модели при первом обращении """
+    with _ann_lock:
+        if model_name not in ann_indexes:
+            # faiss нужен только для локального бэкенда
+            from web.ann import AnnIndex
+            ann_indexes[model_name] = AnnIndex.load(os.path.join(ANN_INDEX_DIR, model_name))
+        return ann_indexes[model_name]
+
+def ann_search(query, query_vector, model_name, source=None, size=RESULT_SIZE):
+    """ Гибридный поиск в локальном ANN-индексе, ответ в формате Elasticsearch """
+    source = source or DEFAULT_SOURCE
+    result = get_ann_index(model_name).search(query, query_vector, size=size, index_name=f"products_{model_name}",
+                                              fields=source['includes'])
+    for hit in result['hits']['hits']:
+        hit['_source'] = project_source(hit['_source'], source)
+    return result
+
+def es_source(source):
+    """ Фильтр _source для запроса к Elasticsearch: с хранилищем товаров нужен только id """
+    if product_store is not None:
+        return {"includes": ["id"], "excludes": []}
+    return source or DEFAULT_SOURCE
+
+def hydrate(result, source=None):
+    """ Заполняет _source попаданий полями из хранилища товаров, если оно подключено """
+    if product_store is None:
+        return result
+    source = source or DEFAULT_SOURCE
+    hits = result['hits']['hits']
+    for hit, product in zip(hits, product_store.get([product_key(hit) for hit in hits], source['includes'])):
+        if product is not None:
+            hit['_source'] = project_source(product, source)
+    return result
+
+def search_url(model_name):
+    return f"{ES_URL}/products_{model_name}/_search"
+
+def msearch_url(model_name):
+    return f"{ES_URL}/products_{model_name}/_msearch"
+
+def fanout_url():
+    return f"{ES_URL}/_msearch"
+
+def build_hybrid_body(query, query_vector, source=None):
+    """ Тело _msearch для гибридного режима """
+    return build_hybrid_msearch(query_vector, generate_all_multi_match_queries(query), es_source(source))
+
+def hybrid_result(msearch_response, fusion, size=RESULT_SIZE, source=None):
+    """ Слияние ответов kNN и BM25; ошибка любого из поисков превращается в SearchError """
+    responses = msearch_response['responses']
+    for response in responses:
+        if 'error' in response:
+            raise SearchError(response.get('status', 500))
+    return hydrate(fuse_responses(responses, size, fusion=fusion), source)
+
+def candidate_size(rerank):
+    """ Сколько кандидатов запрашивать у первого этапа """
+    return max(reranker.top_n, RESULT_SIZE) if rerank else RESULT_SIZE
+
+def encode_query_many(query, model_names):
+    """ Кодирует запрос несколькими моделями одновременно """
+    futures = {model_name: fanout_executor.submit(encode_query, query, model_name) for model_name in model_names}
+    return {model_name: future.result() for model_name, future in futures.items()}
+
+def product_key(hit):
+    # _id одного товара различается в индексах разных моделей, поэтому товары сопоставляются по id из документа
+    return hit['_source'].get('id', hit['_id']) if '_source' in hit else hit['_id']
+
+def build_fanout_body(query, query_vectors, mode, source=None):
+    """
+    Тело _msearch по индексам всех моделей из query_vectors. В режиме hybrid каждая модель даёт kNN-поиск,
+    а полнотекстовый поиск выполняется один раз по индексу первой модели.
+    """
+    source = es_source(source)
+    searches = []
+    for model_name, query_vector in query_vectors.items():
+        body = (knn_search(query_vector, source) if mode == 'hybrid'
+                else build_search_payload(query, query_vector, source))
+        searches.append(({'index': f"products_{model_name}"}, body))
+    if mode == 'hybrid':
+        first_model = next(iter(query_vectors))
+        searches.append(({'index': f"products_{first_model}"},
+                         text_search(generate_all_multi_match_queries(query), source)))
+    return msearch_body(searches)
+
+def fanout_result(msearch_response, model_names, weights, fusion, mode, source=None):
+    """ Слияние ответов моделей в один список с весами моделей (по умолчанию равными) """
+    responses = msearch_response['responses']
+    for response in responses:
+        if 'error' in response:
+            raise SearchError(response.get('status', 500))
+    list_weights = [weights.get(model_name, 1.) for model_name in model_names]
+    if mode == 'hybrid':
+        # Соотношение текстового и векторных списков такое же, как в гибридном режиме для одной модели
+        list_weights.append(TEXT_WEIGHT / VECTOR_WEIGHT * sum(list_weights))
+    return hydrate(fuse_responses(responses, RESULT_SIZE, fusion=fusion, weights=list_weights, key=product_key),
+                   source)
+
+class SearchRequest:
+    """
+    Проверенные параметры запроса /search и зависящие от них решения: какими моделями кодируется запрос,
+    куда отправляется поиск и переранжируется ли результат. Общая часть web/app.py и web/async_app.py,
+    которые отличаются только вводом-выводом. Ошибка в параметрах -- ValueError с текстом для ответа 400.
+    """
+
+    def __init__(self, data):
+        self.query = data.get('query', '')
+        self.model_name = data.get('model', DEFAULT_MODEL)  # По умолчанию используем mpnet
+        self.backend = data.get('backend', SEARCH_BACKEND)
+        self.mode = data.get('mode', SEARCH_MODE)
+        self.fusion = data.get('fusion', FUSION)
+        self.weights = data.get('weights', {})
+
+        if self.model_name not in MODELS:
+            raise ValueError(f'Model {self.model_name} not found')
+        if self.backend not in BACKENDS:
+            raise ValueError(f'Backend {self.backend} not found')
+        if self.mode not in SEARCH_MODES or self.fusion not in FUSIONS:
+            raise ValueError(f'Mode {self.mode} with fusion {self.fusion} not supported')
+
+        # Какие поля документа вернуть, сокращённый ли формат ответа и с какого места продолжить выдачу
+        self.source = source_filter(data)
+        self.compact = data.get('compact', False)
+        self.search_after = decode_cursor(data.get('search_after'))
+        if self.search_after is not None and (self.backend != 'elasticsearch' or self.mode != 'script_score'
+                                              or data.get('models')):
+            raise ValueError('search_after is only supported in script_score mode for a single model')
+
+        # Второй этап ранжирования включён по умолчанию, если задана модель, запрос можно переранжировать
+        # (fan-out и постраничная выдача по search_after без него) и модель обучена на кандидатах того же первого
+        # этапа, иначе масштаб оценок в признаках другой. Ошибка -- только при явном rerank: true
+        can_rerank = self.search_after is None and not data.get('models')
+        self.rerank = data.get('rerank', reranker is not None and can_rerank
+                               and reranker.matches(self.backend, self.mode, self.fusion))
+        if self.rerank and reranker is None:
+            raise ValueError('Reranker is not configured')
+        if self.rerank and not can_rerank:
+            raise ValueError('rerank is not supported with search_after or several models')
+
+        # Fan-out: запрос кодируется несколькими моделями, поиски по их индексам идут одним _msearch
+        self.fanout = bool(data.get('models'))
+        self.model_names = data.get('models') or [self.model_name]
+        if self.fanout:
+            unknown = [name for name in self.model_names if name not in MODELS]
+            if unknown:
+                raise ValueError(f'Model {unknown[0]} not found')
+            if self.backend != 'elasticsearch':
+                raise ValueError(f'Backend {self.backend} does not support several models')
+        self.model_label = '+'.join(self.model_names)
+        self.size = candidate_size(self.rerank)
+        # Признаки переранжирования считаются по полям, которые клиент мог исключить из ответа: первый этап
+        # возвращает их всегда, а лишние удаляются после переранжирования
+        self.fetch_source = widen_filter(self.source, RERANK_FIELDS) if self.rerank else self.source
+        self.hidden_fields = [field for field in RERANK_FIELDS
+                              if self.rerank and not project_source({field: None}, self.source)]
+
+    @property
+    def local(self):
+        """ Поиск в локальном ANN-индексе, без Elasticsearch """
+        return not self.fanout and self.backend == 'ann'
+
+    @property
+    def passthrough(self):
+        """ Ответ Elasticsearch можно отдать клиенту как есть, без разбора JSON """
+        return (not self.fanout and self.mode == 'script_score' and not self.rerank and not self.compact
+                and product_store is None)
+
+    def ann_search(self, query_vectors):
+        return ann_search(self.query, query_vectors[self.model_name], self.model_name, self.fetch_source, self.size)
+
+    def es_request(self, query_vectors):
+        """ Запрос к Elasticsearch: (url, тело, Content-Type, filter_path) """
+        if self.fanout:
+            return (fanout_url(), build_fanout_body(self.query, query_vectors, self.mode, self.source),
+                    'application/x-ndjson', MSEARCH_FILTER_PATH)
+        query_vector = query_vectors[self.model_name]
+        if self.mode == 'hybrid':
+            return (msearch_url(self.model_name), build_hybrid_body(self.query, query_vector, self.fetch_source),
+                    'application/x-ndjson', MSEARCH_FILTER_PATH)
+        payload = build_search_payload(self.query, query_vector, self.fetch_source, self.search_after, self.size)
+        return search_url(self.model_name), json.dumps(payload).encode('utf-8'), 'application/json', FILTER_PATH
+
+    def es_result(self, response):
+        """ Разобранный ответ Elasticsearch в формате _search; SearchError, если один из поисков не удался """
+        if self.fanout:
+            return fanout_result(response, self.model_names, self.weights, self.fusion, self.mode, self.source)
+        if self.mode == 'hybrid':
+            return hybrid_result(response, self.fusion, self.size, self.fetch_source)
+        return hydrate(response, self.fetch_source)
+
+    def output(self, result):
+        """ Ответ клиенту: без полей, добавленных только для переранжирования, и в сокращённом формате, если нужно """
+        if self.hidden_fields:
+            for hit in result['hits']['hits']:
+                for field in self.hidden_fields:
+                    hit.get('_source', {}).pop(field, None)
+        return compact_response(result) if self.compact else result
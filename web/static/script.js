@@ -10,7 +10,8 @@ async function searchProducts(query, model) {
     const url = 'http://127.0.0.1:5000/search';
     const payload = { 
         query: query,
-        model: model
+        model: model,
+        source_includes: ['name', 'description', 'picture']
     };
 
     console.log(payload);